@@ -0,0 +1,261 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+from typing import List, Optional
+
+import phash
+
+logger = logging.getLogger('discord')
+
+COMPACTION_SLICE = 5000  # Entries formatted per event loop iteration when compacting the log
+
+
+class AvatarHashCache:
+    """
+    Persistent LRU cache of avatar pHashes, consulted before any ImageKit request or local hashing
+    Entries are keyed both by discord's avatar asset key & by the SHA-256 digest of the downloaded image,
+    so a re-uploaded copy of the same picture (common in scam waves) is only hashed once.
+    Stored in its own append-only log (`k <key> <hash>` / `d <digest> <hash>` lines) rather than a state document: new entries
+    are buffered & appended at most every `interval` seconds in an executor, so a write costs the entries added since the last
+    one instead of re-serializing the whole cache. The log is replayed at startup (later lines win) & compacted off the loop
+    once it holds more than twice the live entries.
+    """
+
+    def __init__(self, path: str = 'data/avatar_hashes.log', max_size: int = 100000, interval: float = 5.0):
+        self.path = path
+        self.max_size = max_size
+        self.interval = interval
+        self.hits: int = 0
+        self.digest_hits: int = 0
+        self.misses: int = 0
+
+        # Oldest first, doubling as the LRU order
+        self.keys: OrderedDict = OrderedDict()
+        self.digests: OrderedDict = OrderedDict()
+        self._log_lines: int = 0
+        self._buffer: List[str] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._write_lock: Optional[asyncio.Lock] = None
+        self._replay()
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.digest_hits + self.misses
+        return (self.hits + self.digest_hits) / lookups if lookups else 0.0
+
+    def _replay(self) -> None:
+        legacy = os.path.splitext(self.path)[0] + '.json'
+        if not os.path.exists(self.path) and os.path.exists(legacy):
+            # Carry over the cache from when it was an `avatar_hashes` state document
+            with open(legacy) as f:
+                document = json.load(f)
+            for key, photo_hash in document.get('keys', {}).items():
+                _store(self.keys, key, photo_hash, self.max_size)
+            for digest, photo_hash in document.get('digests', {}).items():
+                _store(self.digests, digest, photo_hash, self.max_size)
+            _rewrite(self.path, [_format('k', self.keys, list(self.keys)), _format('d', self.digests, list(self.digests))])
+            self._log_lines = len(self.keys) + len(self.digests)
+            return
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    kind, key, value = line.split()
+                    photo_hash = int(value, 16)
+                except ValueError:
+                    continue  # Torn final line from a crash mid-write
+                _store(self.keys if kind == 'k' else self.digests, key, photo_hash, self.max_size)
+                self._log_lines += 1
+
+    def get(self, key: str) -> Optional[int]:
+        """pHash for an avatar asset key, None if it hasn't been hashed yet"""
+        photo_hash = _lookup(self.keys, key)
+        if photo_hash is not None:
+            self.hits += 1
+        return photo_hash
+
+    def put(self, key: str, photo_hash: int, digest: Optional[str] = None) -> None:
+        _store(self.keys, key, photo_hash, self.max_size)
+        self._record('k', key, photo_hash)
+        if digest is not None:
+            _store(self.digests, digest, photo_hash, self.max_size)
+            self._record('d', digest, photo_hash)
+
+    async def hash_image(self, data: bytes) -> int:
+        """Hash a downloaded image, reusing the result for identical bytes"""
+        digest = hashlib.sha256(data).hexdigest()
+        photo_hash = _lookup(self.digests, digest)
+        if photo_hash is not None:
+            self.digest_hits += 1
+            return photo_hash
+        self.misses += 1
+        photo_hash = await phash.hash_image(data)
+        _store(self.digests, digest, photo_hash, self.max_size)
+        self._record('d', digest, photo_hash)
+        return photo_hash
+
+    def miss(self) -> None:
+        """Record a lookup that had to go to the ImageKit API"""
+        self.misses += 1
+
+    def _record(self, kind: str, key: str, photo_hash: int) -> None:
+        self._buffer.append(f"{kind} {key} {photo_hash:016x}\n")
+        if self._writer is None or self._writer.done():
+            self._wakeup = asyncio.Event()
+            self._write_lock = asyncio.Lock()
+            self._writer = asyncio.get_event_loop().create_task(self._write_loop())
+        self._wakeup.set()
+
+    async def _write_loop(self):
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.interval)  # Batch a sync's or join wave's entries into one append
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to persist avatar hash cache")
+
+    async def flush(self) -> None:
+        """Append buffered entries to the log now, compacting it instead if it has grown past twice the live entries"""
+        if not self._buffer:
+            return
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+        async with self._write_lock:
+            lines, self._buffer = self._buffer, []
+            loop = asyncio.get_event_loop()
+            live = len(self.keys) + len(self.digests)
+            try:
+                if self._log_lines + len(lines) > 2 * live:
+                    # Format the live entries in slices, yielding between them (a thread would hold the GIL against the loop just the same).
+                    # Only the keys are snapshotted; entries evicted meanwhile are skipped & ones updated meanwhile are also in the buffer
+                    chunks = []
+                    for kind, entries in (('k', self.keys), ('d', self.digests)):
+                        keys = list(entries)
+                        for i in range(0, len(keys), COMPACTION_SLICE):
+                            chunks.append(_format(kind, entries, keys[i:i + COMPACTION_SLICE]))
+                            await asyncio.sleep(0)
+                    await loop.run_in_executor(None, _rewrite, self.path, chunks)
+                    self._log_lines = live
+                else:
+                    await loop.run_in_executor(None, _append, self.path, lines)
+                    self._log_lines += len(lines)
+            except OSError:
+                self._buffer[:0] = lines  # Retry on the next write
+                raise
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.cancel()
+            try:
+                await self._writer
+            except asyncio.CancelledError:
+                pass
+            self._writer = None
+        await self.flush()
+
+
+def _lookup(entries: OrderedDict, key: str) -> Optional[int]:
+    photo_hash = entries.get(key)
+    if photo_hash is not None:
+        entries.move_to_end(key)
+    return photo_hash
+
+
+def _store(entries: OrderedDict, key: str, photo_hash: int, max_size: int) -> None:
+    entries[key] = photo_hash
+    entries.move_to_end(key)
+    while len(entries) > max_size:
+        entries.popitem(last=False)
+
+
+def _append(path: str, lines: List[str]) -> None:
+    with open(path, 'a') as f:
+        f.writelines(lines)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _format(kind: str, entries: OrderedDict, keys: List[str]) -> str:
+    return "".join([f"{kind} {key} {photo_hash:016x}\n" for key in keys if (photo_hash := entries.get(key)) is not None])
+
+
+def _rewrite(path: str, chunks: List[str]) -> None:
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.writelines(chunks)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+if __name__ == '__main__':
+    # Longest event loop stall per write at capacity, vs re-dumping the whole cache as a state document: python avatar_cache.py [entries]
+    import random
+    import sys
+    import time
+
+    async def main(size: int):
+        directory = tempfile.mkdtemp()
+        cache = AvatarHashCache(os.path.join(directory, 'avatar_hashes.log'), max_size=size, interval=3600)
+        for i in range(size):
+            cache.put(f"a_{random.getrandbits(128):032x}", random.getrandbits(64), hashlib.sha256(str(i).encode()).hexdigest())
+        await cache.flush()
+
+        stall = 0.0
+
+        async def ticker():
+            nonlocal stall
+            while True:
+                start = time.perf_counter()
+                await asyncio.sleep(0.001)
+                stall = max(stall, time.perf_counter() - start - 0.001)
+
+        task = asyncio.get_event_loop().create_task(ticker())
+        await asyncio.sleep(0.05)
+
+        start = time.perf_counter()
+        payload = json.dumps({'keys': cache.keys, 'digests': cache.digests}, indent=4)
+        print(f"State document: {(time.perf_counter() - start) * 1000:.0f}ms stall & {len(payload) / 2 ** 20:.1f}MiB per write")
+
+        for i in range(1000):  # A second of a busy sync
+            cache.put(f"b_{i:032x}", random.getrandbits(64))
+        await asyncio.sleep(0.01)
+        stall, start = 0.0, time.perf_counter()
+        await cache.flush()
+        print(f"Append log:     {stall * 1000:.1f}ms stall, {(time.perf_counter() - start) * 1000:.1f}ms total per write of 1000 entries, "
+              f"log {os.path.getsize(cache.path) / 2 ** 20:.1f}MiB")
+
+        cache._log_lines = 4 * size  # Force a compaction
+        cache.put("c", 0)
+        await asyncio.sleep(0.01)
+        stall, start = 0.0, time.perf_counter()
+        await cache.flush()
+        print(f"Compaction:     {stall * 1000:.1f}ms stall, {(time.perf_counter() - start) * 1000:.0f}ms total")
+        task.cancel()
+
+        start = time.perf_counter()
+        reloaded = AvatarHashCache(cache.path, max_size=size)
+        print(f"Replay:         {len(reloaded)} keys & {len(reloaded.digests)} digests in {(time.perf_counter() - start) * 1000:.0f}ms")
+        assert reloaded.keys == cache.keys and reloaded.digests == cache.digests
+        await cache.close()
+
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000))
@@ -0,0 +1,217 @@
+"""
+Per-guild banned name rules from data/banned_patterns.json, matched against a name's confusable skeleton (see confusables.py)
+  {"<guild id>": [{"type": "glob", "pattern": "*burger*king*"},
+                  {"type": "regex", "pattern": "elonmusk.*announce"},
+                  {"type": "fuzzy", "pattern": "MinaProtocol", "k": 2}]}
+Glob & fuzzy patterns are skeletonized like names, so they can be written naturally. Regexes are matched as written against the
+skeleton, which is lowercase with no whitespace, i/1 folded to l & 0 to o.
+Every rule is keyed by trigrams a matching name must contain: one from the longest literal of a glob or regex, & for fuzzy rules
+one from each of k + 1 pieces of the pattern (within k edits, at least one piece survives intact). A name's trigrams are looked up
+once to find the candidate rules, so only those are run, however many rules a guild has. Rules without a usable literal always run.
+The file is reloaded whenever its modification time changes.
+"""
+import fnmatch
+import json
+import os
+import re
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import confusables
+
+try:
+    from re import _parser as sre_parse  # Python 3.11+
+except ImportError:
+    import sre_parse
+
+Q = 3  # Length of the literal keys rules are indexed by
+
+
+class Rule(NamedTuple):
+    type: str
+    pattern: str
+    k: int = 0
+
+    def __str__(self):
+        return f"{self.type}{self.k if self.type == 'fuzzy' else ''}:{self.pattern}"
+
+
+def within_distance(a: str, b: str, k: int) -> bool:
+    """Whether the Levenshtein distance between a & b is at most k, only filling the diagonal band of width 2k + 1"""
+    if abs(len(a) - len(b)) > k:
+        return False
+    inf = k + 1
+    prev = [j if j <= k else inf for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        cur = [inf] * (len(b) + 1)
+        if i <= k:
+            cur[0] = i
+        lo, hi = max(1, i - k), min(len(b), i + k)
+        for j in range(lo, hi + 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (a[i - 1] != b[j - 1]), inf)
+        if min(cur[lo - 1:hi + 1]) > k:
+            return False
+        prev = cur
+    return prev[len(b)] <= k
+
+
+def trigrams(text: str) -> List[str]:
+    return [text[i:i + Q] for i in range(len(text) - Q + 1)]
+
+
+def _glob_literal(pattern: str) -> str:
+    """Longest run of plain characters in a glob"""
+    return max(re.split(r'[*?]|\[[^\]]*\]', pattern), key=len)
+
+
+def _regex_literal(pattern: str) -> str:
+    """Longest run of literal characters at the top level of a regex, which any match must contain"""
+    best = run = ""
+    for op, value in sre_parse.parse(pattern):
+        run = run + chr(value).lower() if op == sre_parse.LITERAL else ""
+        best = max(best, run, key=len)
+    return best
+
+
+class GuildPatterns:
+    def __init__(self, rules: List[Rule]):
+        self.rules = rules
+        self.checks: List[Callable[[str], bool]] = []
+        self.keyed: Dict[str, List[int]] = {}
+        self.unkeyed: List[int] = []
+
+        for i, rule in enumerate(rules):
+            if rule.type == 'glob':
+                skeleton = confusables.skeleton(rule.pattern)
+                self.checks.append(re.compile(fnmatch.translate(skeleton)).match)
+                keys = [trigrams(_glob_literal(skeleton))]
+            elif rule.type == 'regex':
+                self.checks.append(re.compile(rule.pattern).search)
+                keys = [trigrams(_regex_literal(rule.pattern))]
+            else:
+                skeleton = confusables.skeleton(rule.pattern)
+                self.checks.append(lambda name, pattern=skeleton, k=rule.k: within_distance(name, pattern, k))
+                size = len(skeleton) // (rule.k + 1)
+                keys = [trigrams(skeleton[j * size:(j + 1) * size]) for j in range(rule.k + 1)] if size >= Q else [[]]
+
+            if not all(keys):
+                self.unkeyed.append(i)
+                continue
+            # From each required literal pick the trigram shared with the fewest other rules, to keep candidate lists short
+            for grams in keys:
+                key = min(grams, key=lambda gram: len(self.keyed.get(gram, ())))
+                self.keyed.setdefault(key, []).append(i)
+
+    def match(self, skeleton: str) -> Optional[Rule]:
+        candidates = set(self.unkeyed)
+        for gram in trigrams(skeleton):
+            candidates.update(self.keyed.get(gram, ()))
+        for i in sorted(candidates):
+            if self.checks[i](skeleton):
+                return self.rules[i]
+        return None
+
+
+class BannedPatterns:
+    def __init__(self, path: str = 'data/banned_patterns.json'):
+        self.path = path
+        self.guilds: Dict[int, GuildPatterns] = {}
+        self.errors: List[str] = []
+        self.mtime: Optional[float] = None
+
+    def load(self) -> None:
+        """(Re)compile every guild's rules. Invalid rules are skipped & reported in `errors`, the rest stay active"""
+        try:
+            self.mtime = os.path.getmtime(self.path)
+        except OSError:
+            self.mtime = None
+            self.guilds, self.errors = {}, []
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except ValueError as e:
+            # Keep the rules already loaded until the file is fixed
+            self.errors = [f"{self.path}: {e}"]
+            print(f"Invalid banned name patterns file: {e}")
+            return
+
+        guilds, errors = {}, []
+        for gid, entries in data.items():
+            rules = []
+            for entry in entries:
+                try:
+                    rule = Rule(entry['type'], entry['pattern'], int(entry.get('k', 1 if entry['type'] == 'fuzzy' else 0)))
+                    if rule.type not in ('glob', 'regex', 'fuzzy'):
+                        raise ValueError(f"unknown rule type {rule.type!r}")
+                    if rule.type == 'regex':
+                        re.compile(rule.pattern)
+                except (KeyError, ValueError, re.error) as e:
+                    errors.append(f"{gid}: {entry} ({e})")
+                    continue
+                rules.append(rule)
+            guilds[int(gid)] = GuildPatterns(rules)
+        self.guilds, self.errors = guilds, errors
+        for error in errors:
+            print(f"Invalid banned name pattern: {error}")
+
+    def reload_if_changed(self) -> bool:
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        if mtime == self.mtime:
+            return False
+        self.load()
+        return True
+
+    def match(self, guild_id: int, skeleton: str) -> Optional[Rule]:
+        """The first of the guild's rules matching a name skeleton, if any"""
+        self.reload_if_changed()
+        patterns = self.guilds.get(guild_id)
+        return patterns.match(skeleton) if patterns else None
+
+    def __len__(self):
+        return sum(len(patterns.rules) for patterns in self.guilds.values())
+
+
+if __name__ == '__main__':
+    # Benchmark the trigram prefilter against running every rule in turn: python banned_patterns.py [rules] [names]
+    import random
+    import string
+    import sys
+    import time
+
+    def main(rule_count: int, name_count: int):
+        random.seed(0)
+
+        def word(n):
+            return "".join(random.choices(string.ascii_lowercase, k=n))
+        rules = []
+        for i in range(rule_count):
+            kind = random.choice(('glob', 'regex', 'fuzzy'))
+            if kind == 'glob':
+                rules.append(Rule('glob', f"*{word(5)}*{word(4)}*"))
+            elif kind == 'regex':
+                rules.append(Rule('regex', f"{word(4)}[._]?{word(4)}\\d*"))
+            else:
+                rules.append(Rule('fuzzy', word(random.randint(8, 14)), 2))
+        # Mostly random names, with every 20th a near miss of a fuzzy rule
+        fuzzy = [r.pattern for r in rules if r.type == 'fuzzy']
+        names = [random.choice(fuzzy)[:-1] + "x" if i % 20 == 0 else word(random.randint(4, 16)) for i in range(name_count)]
+
+        start = time.perf_counter()
+        patterns = GuildPatterns(rules)
+        print(f"Indexed {rule_count} rules in {(time.perf_counter() - start) * 1000:.0f}ms ({len(patterns.unkeyed)} without a key)")
+
+        start = time.perf_counter()
+        indexed = [patterns.match(name) for name in names]
+        indexed_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        every = [next((rule for check, rule in zip(patterns.checks, rules) if check(name)), None) for name in names]
+        every_s = time.perf_counter() - start
+        assert indexed == every
+        print(f"Trigram prefilter: {indexed_s / name_count * 1e6:.1f}µs / name | Every rule: {every_s / name_count * 1e6:.1f}µs / name "
+              f"| {sum(r is not None for r in indexed)} matches")
+
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 300, int(sys.argv[2]) if len(sys.argv) > 2 else 20000)
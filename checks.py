@@ -10,14 +10,14 @@ def is_staff_check():
 
 def is_staff(client, guild, member):
     db = client.variables.get(guild.id)
-    role = db['min_staff_role']
+    role = db.min_staff_role
     return member.top_role >= role or member.id == 196282885601361920
 
 def is_bots_channel():
     "Check if command is run in bots channel"
     def predicate(ctx):
         db = ctx.bot.variables.get(ctx.guild.id)
-        channel = db['bots_channel']
+        channel = db.bots_channel
         return ctx.channel and ctx.channel == channel
     return commands.check(predicate)
 
@@ -1,6 +1,5 @@
 import asyncio
-import difflib
-import json
+import copy
 import textwrap
 from datetime import datetime, timedelta
 from os import listdir
@@ -8,10 +7,10 @@ from os.path import join, isfile
 
 import discord
 import psutil
-import unidecode as unidecode
 from discord.ext import commands
 
 import checks
+import sql
 from utils import EmbedPaginator
 
 
@@ -52,6 +51,15 @@ class Core(commands.Cog):
         uptime_seconds = round((datetime.now() - self.client.start_time).total_seconds())
         await ctx.send(f"Current Uptime: {'{:0>8}'.format(str(timedelta(seconds=uptime_seconds)))}")
 
+    @commands.command(usage="dbstats", description="Query latency & connection pool statistics.")
+    @commands.is_owner()
+    async def dbstats(self, ctx):
+        pool = self.client.pool
+        embed = discord.Embed(title="Database Stats", description=sql.stats(), color=discord.Color.dark_gold())
+        embed.add_field(name="Connection Pool:", value=f"**`{pool.size}`** open / {pool.maxsize} max, {pool.freesize} idle.")
+        embed.timestamp = datetime.utcnow()
+        await ctx.send(embed=embed)
+
     @commands.command(usage="status", description="Retrieve the bot's status.")
     async def status(self, ctx):
         embed = discord.Embed(title="Bot Status", color=discord.Color.dark_gold())
@@ -71,6 +79,19 @@ class Core(commands.Cog):
                                f"\nDisk: {psutil.disk_usage('/').percent}% utilization."
                                f"\nNetwork: {round(psutil.net_io_counters().bytes_recv * 0.000001)} MB in "
                                f"/ {round(psutil.net_io_counters().bytes_sent * 0.000001)} MB out.```"), inline=False)
+        counter = self.client.msg_counter
+        last_flush = f"{counter.last_flush_latency * 1000:.1f}ms" if counter.last_flush_latency is not None else "N/A"
+        embed.add_field(name="Message Counter:", value=f"**`{counter.backlog}`** pending updates.\nLast flush: **`{last_flush}`** ({counter.last_flush_size} rows)\n"
+                                                            f"Read cache: {counter.cache_hits} hits, {counter.cache_misses} misses", inline=False)
+        cache = self.client.avatar_hashes
+        embed.add_field(name="Avatar Hash Cache:", value=f"**`{len(cache)}`** avatars cached.\nHit rate: **`{cache.hit_rate:.1%}`** ({cache.hits + cache.digest_hits} hits, {cache.misses} misses)",
+                        inline=False)
+        names = self.client.normalized_names
+        embed.add_field(name="Name Normalization Cache:", value=f"**`{len(names)}`** names cached.\nHit rate: **`{names.hit_rate:.1%}`** ({names.hits} hits, {names.misses} misses)",
+                        inline=False)
+        timers = self.client.verification_timers
+        embed.add_field(name="Verification Timers:", value=f"**`{len(timers)}`** pending.\n{timers.fired} fired since startup.", inline=False)
+        embed.add_field(name="Outbound HTTP:", value=self.client.http_client.stats(), inline=False)
         embed.add_field(name="Development Progress", value="To see what I'm working on, click here:\nhttps://github.com/Jacobvs/DiscordCrypto/", inline=False)
         if ctx.guild:
             appinfo = await self.client.application_info()
@@ -192,8 +213,8 @@ class Core(commands.Cog):
     @commands.command(usage='configure', description="Configure the bot's settings for this server")
     @commands.check_any(commands.has_permissions(administrator=True), commands.is_owner())
     async def configure(self, ctx):
-        with open('data/variables.json') as f:
-            variables = json.load(f)
+        # Edit a copy so a cancelled/timed out setup leaves the saved config untouched
+        record = copy.deepcopy(self.client.state['variables'][str(ctx.guild.id)])
 
         embed = discord.Embed(title="Configuration", description="Please mention or type the name of the channel in which captcha verification will occur.", color=discord.Color.teal())
         final_embed = discord.Embed(title="Success!", description="Your configuration settings have been saved! Please review your current settings below.",
@@ -203,8 +224,8 @@ class Core(commands.Cog):
         res = await setup_converter(self.client, ctx, setup_msg)
         if res is None:
             return
-        variables[str(ctx.guild.id)]['channels']['captcha_channel'] = res.id
-        self.client.variables[ctx.guild.id]['captcha_channel'] = res
+        record['channels']['captcha_channel'] = res.id
+        self.client.variables[ctx.guild.id].captcha_channel = res
         final_embed.add_field(name="Captcha Channel", value=res.mention)
 
         embed = discord.Embed(title="Configuration", description="Please mention or type the name of the channel in which bot logs will be posted.", color=discord.Color.teal())
@@ -213,8 +234,8 @@ class Core(commands.Cog):
         res = await setup_converter(self.client, ctx, setup_msg)
         if res is None:
             return
-        variables[str(ctx.guild.id)]['channels']['log_channel'] = res.id
-        self.client.variables[ctx.guild.id]['log_channel'] = res
+        record['channels']['log_channel'] = res.id
+        self.client.variables[ctx.guild.id].log_channel = res
         final_embed.add_field(name="Log Channel", value=res.mention)
 
         embed = discord.Embed(title="Configuration", description="Please mention or type the name of the Role to be given to new members while waiting for captcha completion.",
@@ -224,8 +245,8 @@ class Core(commands.Cog):
         res = await setup_converter(self.client, ctx, setup_msg, is_role=True)
         if res is None:
             return
-        variables[str(ctx.guild.id)]['roles']['temporary_role'] = res.id
-        self.client.variables[ctx.guild.id]['temporary_role'] = res
+        record['roles']['temporary_role'] = res.id
+        self.client.variables[ctx.guild.id].temporary_role = res
         final_embed.add_field(name="Temporary Role", value=res.mention)
 
         embed = discord.Embed(title="Configuration", description="Please mention or type the name of the Role to be given upon captcha completion.", color=discord.Color.teal())
@@ -234,8 +255,8 @@ class Core(commands.Cog):
         res = await setup_converter(self.client, ctx, setup_msg, is_role=True)
         if res is None:
             return
-        variables[str(ctx.guild.id)]['roles']['verified_role'] = res.id
-        self.client.variables[ctx.guild.id]['verified_role'] = res
+        record['roles']['verified_role'] = res.id
+        self.client.variables[ctx.guild.id].verified_role = res
         final_embed.add_field(name="Verified Role", value=res.mention)
 
         embed = discord.Embed(title="Configuration", description="Please mention or type the name of the minimum Role for access to staff commands.", color=discord.Color.teal())
@@ -244,8 +265,8 @@ class Core(commands.Cog):
         res = await setup_converter(self.client, ctx, setup_msg, is_role=True)
         if res is None:
             return
-        variables[str(ctx.guild.id)]['roles']['min_staff_role'] = res.id
-        self.client.variables[ctx.guild.id]['min_staff_role'] = res
+        record['roles']['min_staff_role'] = res.id
+        self.client.variables[ctx.guild.id].min_staff_role = res
         final_embed.add_field(name="Min. Staff Role", value=res.mention)
 
         embed = discord.Embed(title="Configuration", description="Please enter the minimum account age for new members in seconds. (-1 to disable this feature.)",
@@ -255,18 +276,18 @@ class Core(commands.Cog):
         res = await setup_converter(self.client, ctx, setup_msg, integer=True)
         if res is None:
             return
-        variables[str(ctx.guild.id)]['min_account_age_seconds'] = res
-        self.client.variables[ctx.guild.id]['min_account_age_seconds'] = res
+        record['min_account_age_seconds'] = res
+        self.client.variables[ctx.guild.id].min_account_age_seconds = res
         final_embed.add_field(name="Min Account Age", value=str(res))
 
-        with open('data/variables.json', "w") as f:
-            json.dump(variables, f, indent=4)
+        self.client.state['variables'][str(ctx.guild.id)] = record
+        self.client.state.changed('variables')
 
         await setup_msg.edit(embed=final_embed)
 
     @commands.command(usage="testlog", description="Send a test log message in this server.")
     async def testlog(self, ctx):
-        logchannel = self.client.variables[ctx.guild.id]['log_channel']
+        logchannel = self.client.variables[ctx.guild.id].log_channel
         from cogs import log
         await log.send_log(self.client, ctx.guild, logchannel, discord.Embed(title="TEST"), "TEST LOG")
 
@@ -292,15 +313,9 @@ class Core(commands.Cog):
         print("attempting to ban name: " + name)
         name = str(name)
         if similar:
-            nicks = []
-            map = {}
-            for m in ctx.guild.members:
-                n = unidecode.unidecode(m.name)
-                nicks.append(n)
-                map[n] = m
-            res = difflib.get_close_matches(name, nicks, cutoff=0.15)
-            memberlist = [map.get(m) for m in res]
-            desc = f"Similar names also to be banned:\n{' | '.join([m.mention for m in memberlist])}"
+            res = self.client.member_names.get(ctx.guild).fuzzy_ascii(name, limit=3, cutoff=0.2)
+            memberlist = [m for m, _ in res]
+            desc = f"Similar names also to be banned:\n{' | '.join([f'{m.mention} ({score:.0%})' for m, score in res])}"
             lines = textwrap.wrap(desc, width=1024)
             for l in lines:
                 await ctx.send(l)
@@ -1,6 +1,5 @@
 import asyncio
 import datetime
-import difflib
 import functools
 import re
 import shutil
@@ -8,14 +7,19 @@ from autocorrect import Speller
 import aiohttp
 import discord
 from discord.ext import commands
-from unidecode import unidecode
 
+import phash
 import sql
 import utils
 from cogs.log import send_log
 from main import get_prefix
 
 
+def ocr_failed(r) -> bool:
+    """OCR.space answered 200 but errored while processing, or sent a body without parsed text"""
+    return r.get('IsErroredOnProcessing') is not False or not isinstance(r.get('ParsedResults', 0, 'ParsedText'), str)
+
+
 class Events(commands.Cog):
 
     def __init__(self, client):
@@ -53,7 +57,7 @@ class Events(commands.Cog):
     async def on_message(self, msg: discord.Message):
         if msg.guild and not msg.author.bot:
             # Add to sent message queue to be inserted later...
-            self.client.sent_messages[(msg.guild.id, msg.author.id)] = self.client.sent_messages.get((msg.guild.id, msg.author.id), 0) + 1
+            self.client.msg_counter.increment(msg.guild.id, msg.author.id)
 
             if msg.attachments and (msg.channel.id == 396316232124727296 or msg.channel.id == 797960110310686760 or msg.channel.id == 804133361378656287):
                 print("MSG HAS ATTACHMENT")
@@ -94,12 +98,17 @@ class Events(commands.Cog):
                 except discord.NotFound or discord.Forbidden:
                     pass
 
+    async def with_msg_counts(self, gid, members):
+        """Pair members with their message counts, looked up in one batch"""
+        counts = await self.client.msg_counter.get_counts(gid, [m.id for m in members])
+        return [(m, counts[m.id]) for m in members]
+
     async def check_spam_img(self, img, msg, send_to_channel=False):
         if send_to_channel:
             response = await msg.channel.send("Checking Image... Please wait.")
         else:
             response = None
-        file_storage = self.client.variables[msg.guild.id]['file_storage']
+        file_storage = self.client.variables[msg.guild.id].file_storage
         if file_storage:
             try:
                 image_ref = await file_storage.send(content="Image(s) uploaded in support channels:",
@@ -107,35 +116,21 @@ class Events(commands.Cog):
                 img = image_ref.attachments[0]
             except discord.DiscordException:
                 pass
+        async def retrying(attempt, status):
+            if response:
+                await response.edit(content=f"I'm having trouble parsing this image!{f' (Status: {status})' if status else ''}... Retrying ({attempt}/3)")
+
         try:
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(200)) as cs:
-                for i in range(3):
-                    async with cs.get(f'https://api.ocr.space/parse/imageurl?OCREngine=2&apikey={self.client.OCR_TOKEN}&url={img.url}') as r:
-                        if r.status != 200:
-                            if response:
-                                await response.edit(content=f"I'm having trouble parsing this image! (Status: {r.status})... Retrying ({i}/3)")
-                            await asyncio.sleep(60)
-                            continue
-                        data = await r.json()
-                        if data['IsErroredOnProcessing'] is True:
-                            if response:
-                                await response.edit(content=f"I'm having trouble parsing this image!... Retrying ({i + 1}/3)")
-                            await asyncio.sleep(60)
-                            continue
-                        break
-                else:
-                    try:
-                        if response:
-                            await response.edit(content="OCR Detection failed! Sending image for moderators to review!")
-                        data = None
-                    except discord.Forbidden or discord.HTTPException:
-                        pass
+            r = await self.client.http_client.get(f'https://api.ocr.space/parse/imageurl?OCREngine=2&apikey={self.client.OCR_TOKEN}&url={img.url}', endpoint='ocr.parse',
+                                           retries=2, retry_if=ocr_failed, on_retry=retrying)
+            data = r.data if r.status == 200 and not ocr_failed(r) else None
         except (asyncio.TimeoutError, aiohttp.ClientError):
+            data = None
+        if data is None:
             try:
                 if response:
                     await response.edit(content="OCR Detection failed! Sending image for moderators to review!")
-                data = None
-            except discord.Forbidden or discord.HTTPException:
+            except discord.HTTPException:
                 pass
         return data, img, response
 
@@ -222,19 +217,20 @@ class Events(commands.Cog):
                         try:
                             mem = await converter.convert(ctx, l)
                             if mem:
-                                count = await sql.get_msg_count(self.client.pool, msg.guild.id, mem.id)
-                                members.append((mem, count))
+                                members.append(mem)
                         except discord.ext.commands.BadArgument:
                             pass
                     if members:
-                        member, message_count = sorted(members, key=lambda x: x[1])[0]
+                        counts = await self.client.msg_counter.get_counts(msg.guild.id, [m.id for m in members])
+                        member = min(members, key=lambda m: counts[m.id])
+                        message_count = counts[member.id]
             elif response:
                 try:
                     return await response.delete()
                 except discord.Forbidden or discord.HTTPException:
                     pass
 
-            spam_report_channel = self.client.variables[msg.guild.id]['spam_reports']
+            spam_report_channel = self.client.variables[msg.guild.id].spam_reports
 
             detected_member_str = f"\n__User Detected:__\n{member.mention} ({member.display_name}#{member.discriminator}) - Joined (" \
                                   f"{member.joined_at.strftime('%m/%d/%Y, %H:%M:%S %Z')})\n\n# Sent Messages: **__{message_count}__**" if member \
@@ -266,8 +262,8 @@ class Events(commands.Cog):
         if payload.guild_id:
             if str(payload.emoji) in ['✅', '❌', '📝']:
                 print("DETECTED CHECK/X REACTION")
-                spam_reports_channel: discord.TextChannel = self.client.variables[payload.guild_id]['spam_reports']
-                duplicate_reports_channel: discord.TextChannel = self.client.variables[payload.guild_id]['duplicate_reports']
+                spam_reports_channel: discord.TextChannel = self.client.variables[payload.guild_id].spam_reports
+                duplicate_reports_channel: discord.TextChannel = self.client.variables[payload.guild_id].duplicate_reports
                 if (payload.channel_id == spam_reports_channel.id or payload.channel_id == duplicate_reports_channel.id) and payload.user_id != self.client.user.id:
                     is_spam = True
                     if payload.channel_id == spam_reports_channel.id:
@@ -335,22 +331,16 @@ class Events(commands.Cog):
                                         member = -1
                                         break
 
-                                    nicks = [m.display_name for m in name_msg.guild.members]
-                                    matches = difflib.get_close_matches(name_msg.content, nicks, cutoff=0.8)
-                                    mems = [(m, await sql.get_msg_count(self.client.pool, payload.guild_id, m.id)) for m in name_msg.guild.members if m.display_name in matches]
+                                    # Duplicate name reports can match many members with the same name, so allow plenty of candidates
+                                    names = self.client.member_names.get(name_msg.guild)
+                                    matches = names.fuzzy(name_msg.content, limit=25, cutoff=0.6)
+                                    mems = await self.with_msg_counts(payload.guild_id, [m for m, _ in matches])
                                     print(mems)
 
                                     if not mems:
-                                        nicks = []
-                                        map = {}
-                                        for m in name_msg.guild.members:
-                                            n = unidecode(m.name)
-                                            nicks.append(n)
-                                            map[n] = m
-                                        matches = difflib.get_close_matches(name_msg.content, nicks, cutoff=0.65)
-                                        print(f"Uni Matches: {matches}")
-                                        _ = [map.get(n) for n in matches]
-                                        mems = [(m, await sql.get_msg_count(self.client.pool, payload.guild_id, m.id)) for m in _]
+                                        matches = names.fuzzy_ascii(name_msg.content, limit=10, cutoff=0.45)
+                                        print(f"Uni Matches: {[(m.name, round(score, 2)) for m, score in matches]}")
+                                        mems = await self.with_msg_counts(payload.guild_id, [m for m, _ in matches])
                                         if not mems:
                                             await msg.channel.send(f"No members found with the input: `{name_msg.content}`! Type another name, __CANCEL__ to cancel, or __RESOLVE__ to "
                                                                    f"resolve this report.", delete_after=10)
@@ -476,14 +466,14 @@ class Events(commands.Cog):
                             embed.set_image(url=discord.Embed.Empty)
                             embed.set_footer(text="Resolved at ")
                             embed.timestamp = datetime.datetime.utcnow()
-                            log_channel = self.client.variables[payload.guild_id]['log_channel']
+                            log_channel = self.client.variables[payload.guild_id].log_channel
                             try:
                                 await log_channel.send(embed=embed)
                                 await msg.delete()
                             except discord.Forbidden or discord.HTTPException:
                                 pass
             elif payload.channel_id in [396316232124727296, 797960110310686760, 804133361378656287] and str(payload.emoji) == '♻️' and\
-                (payload.member.top_role >= self.client.variables[payload.guild_id]['min_staff_role'] or payload.user_id == 196282885601361920):
+                (payload.member.top_role >= self.client.variables[payload.guild_id].min_staff_role or payload.user_id == 196282885601361920):
                     channel = self.client.get_channel(payload.channel_id)
                     msg = await channel.fetch_message(payload.message_id)
                     await msg.remove_reaction(payload.emoji, payload.member)
@@ -495,13 +485,14 @@ class Events(commands.Cog):
     @commands.Cog.listener()
     async def on_user_update(self, before: discord.User, after: discord.User):
         if before.display_avatar != after.display_avatar:
-            if not after.display_avatar:
-                photo_hash = str(after.default_avatar)
+            if after.display_avatar == after.default_avatar:
+                photo_hash, default_avatar = None, phash.DEFAULT_AVATARS[after.default_avatar.key]
             else:
-                photo_hash = await utils.get_photo_hash(self.client, after)
+                photo_hash, default_avatar = await utils.get_photo_hash(self.client, after), None
             print(f"USER UPDATED AVATAR! (ID: {after.id}) | Hash: {photo_hash}")
-            if photo_hash:
-                await sql.update_photo_hash(self.client.pool, after.id, photo_hash, new=False)
+            if photo_hash is not None or default_avatar:
+                await sql.update_photo_hash(self.client.pool, after.id, photo_hash, new=False, default_avatar=default_avatar,
+                                           avatar_key=after.display_avatar.key)
 
 
 def setup(client):
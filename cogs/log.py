@@ -1,6 +1,5 @@
 import datetime
 import enum
-import json
 
 import discord
 from discord.ext import commands
@@ -21,16 +20,13 @@ async def send_log(client, guild, channel, embed, event: str = None, action="Not
 
     if not channel:
 
-        channel = client.variables[guild.id]['log_channel']
+        channel = client.variables[guild.id].log_channel
         if not channel:
-            with open('data/variables.json') as f:
-                data = json.load(f)
-
-                log_channel = data[str(guild.id)]['channels']['log_channel']
-                if log_channel:
-                    channel = client.get_channel(log_channel)
-                    if not channel:
-                        return
+            log_channel = client.state['variables'][str(guild.id)]['channels']['log_channel']
+            if log_channel:
+                channel = client.get_channel(log_channel)
+                if not channel:
+                    return
 
     print(f"sending log in channel: {channel.name} id: {channel.id} for guild {guild.name}")
     # Send the message
@@ -54,7 +50,7 @@ async def action_log(client: discord.Client, member: discord.Member, is_ban: boo
         embed.add_field(name="Unicode Name:", value=f"`{member.name}` - decoded: `{member.name.encode('unicode-escape')}`")
     embed.timestamp = datetime.datetime.utcnow()
 
-    log_channel = client.variables[member.guild.id]['log_channel']
+    log_channel = client.variables[member.guild.id].log_channel
     await log_channel.send(embed=embed)
 
 
@@ -74,8 +70,8 @@ async def verify_log(client: discord.Client, member: discord.Member, action: Ver
     content = f"{action.value[0]} {member.mention} – {action.value[1]}"
     if score_info is not None:
         content += f"\n{score_info}"
-    await client.variables[member.guild.id]['verify_log_channel'].send(content)
+    await client.variables[member.guild.id].verify_log_channel.send(content)
 
 async def send_custom_verify_log(client: discord.Client, guild: discord.Guild, message: str) -> None:
-    await client.variables[guild.id]['verify_log_channel'].send(message)
+    await client.variables[guild.id].verify_log_channel.send(message)
 
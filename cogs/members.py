@@ -0,0 +1,106 @@
+import datetime
+import logging
+
+import discord
+from discord.ext import commands
+
+logger = logging.getLogger('discord')
+
+
+def is_alert_level(count: int, threshold: int) -> bool:
+    """True when `count` members sharing a name should be reported: on crossing the threshold, then each time the count doubles"""
+    first = threshold + 1
+    if count < first or count % first:
+        return False
+    multiple = count // first
+    return multiple & (multiple - 1) == 0
+
+
+class Members(commands.Cog):
+    """Keeps the bot's member name index, name normalization cache & wordlist flags in step with joins, leaves & name changes"""
+
+    def __init__(self, client):
+        self.client = client
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # Index every guild up front so duplicate name counts & wordlist flags are ready before the first lookup
+        for guild in self.client.guilds:
+            self.client.member_names.get(guild)
+            for member in guild.members:
+                self.client.wordlist.is_match(member)
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild: discord.Guild):
+        self.client.member_names.get(guild)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member: discord.Member):
+        self.client.member_names.update(member)
+        await self.check_duplicate_name(member)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        if before.display_name != after.display_name:
+            self.client.normalized_names.forget(before.display_name)
+            self.client.member_names.update(after)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member: discord.Member):
+        self.client.member_names.remove(member)
+        if not member.mutual_guilds:
+            self.client.wordlist.forget(member.id)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before: discord.User, after: discord.User):
+        # Username & discriminator changes aren't member updates, so re-index the user in every shared guild
+        if before.name != after.name or before.discriminator != after.discriminator:
+            self.client.normalized_names.forget(before.name)
+            self.client.wordlist.refresh(after)
+            for guild in after.mutual_guilds:
+                member = guild.get_member(after.id)
+                if member is not None:
+                    self.client.member_names.update(member)
+                    if before.name != after.name:
+                        await self.check_duplicate_name(member)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild: discord.Guild):
+        self.client.member_names.drop(guild.id)
+        for member in guild.members:
+            if not member.mutual_guilds:
+                self.client.wordlist.forget(member.id)
+
+    async def check_duplicate_name(self, member: discord.Member):
+        """Send a DUPLICATE report when a join or rename brings a name's member count to an alert level"""
+        config = self.client.variables.get(member.guild.id)
+        if member.bot or not config or not config.duplicate_status or not config.duplicate_reports:
+            return
+        name = self.client.normalized_names.ascii(member.name)
+        members = self.client.member_names.get(member.guild).with_ascii_name(name)
+        if not is_alert_level(len(members), config.duplicate_threshold):
+            return
+
+        members.sort(key=lambda m: m.joined_at or discord.utils.utcnow(), reverse=True)
+        embed = discord.Embed(title="Possible Duplicate Name Wave!", description=f"**{len(members)}** members now share the name `{name}`.\n"
+                                                                                  f"Latest: {member.mention} ({member.name}#{member.discriminator})",
+                              color=discord.Color.teal())
+        mentions = ""
+        for m in members:
+            if len(mentions) + len(m.mention) > 1000:
+                mentions += "..."
+                break
+            mentions += m.mention
+        embed.add_field(name="Members (newest first):", value=mentions, inline=False)
+        embed.set_footer(text="Click 📝 to pick a member to ban, ❌ to ignore. | Detected")
+        embed.timestamp = datetime.datetime.utcnow()
+        try:
+            report = await config.duplicate_reports.send(content=f"DUPLICATE Report ({len(members)}x `{name}`) for UID: N/A", embed=embed)
+            await report.add_reaction('📝')
+            await report.add_reaction('❌')
+        except discord.HTTPException:
+            logger.exception(f"Failed to send duplicate name report for guild {member.guild.id}")
+
+
+def setup(client):
+    client.add_cog(Members(client))
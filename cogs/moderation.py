@@ -1,25 +1,20 @@
 import asyncio
 import datetime
-import difflib
-import json
 import logging
 import textwrap
-from collections import Counter, OrderedDict
+from collections import OrderedDict
 
-import aiohttp
 import discord
 from discord.ext import commands
-from unidecode import unidecode
 
 import checks
+import phash
 import sql
 import utils
 
 
 logger = logging.getLogger('discord')
 
-default_avatars = {'0': "blurple", '1': "gray", '2': "green", '3': "yellow", '4': "red", '5': "pink"}
-
 
 class Moderation(commands.Cog):
     """Commands for user/server management"""
@@ -67,13 +62,7 @@ class Moderation(commands.Cog):
     @commands.guild_only()
     @commands.has_permissions(administrator=True)
     async def change_prefix(self, ctx, prefix):
-        with open('data/prefixes.json', 'r') as file:
-            prefixes = json.load(file)
-
-        prefixes[str(ctx.guild.id)] = prefix
-
-        with open('data/prefixes.json', 'w') as file:
-            json.dump(prefixes, file, indent=4)
+        self.client.set_prefix(ctx.guild.id, prefix)
 
         await ctx.send(f"The prefix for this server has been changed to '{prefix}'.")
 
@@ -234,7 +223,7 @@ class Moderation(commands.Cog):
         if num < 4:
             return await ctx.send("Please specify a number higher than 3!")
 
-        duplicates = [f"{m} –– **{v}** duplicates\n" for m, v in Counter([unidecode(m.name) for m in ctx.guild.members]).items() if v > num]
+        duplicates = [f"{m} –– **{v}** duplicates\n" for m, v in self.client.member_names.get(ctx.guild).duplicates(num)]
         # for r in duplicates:
         #     similar = difflib.get_close_matches(r, duplicates, cutoff=0.75)
         #     if similar:
@@ -256,21 +245,15 @@ class Moderation(commands.Cog):
     @commands.command(usage='finduzero', description='Find members with fully unicode names.')
     @checks.is_staff_check()
     async def finduzero(self, ctx):
-        await ctx.send("".join([m.mention for m in ctx.guild.members if len(unidecode(m.name)) == 0]))
+        await ctx.send("".join([m.mention for m in ctx.guild.members if len(self.client.normalized_names.ascii(m.name)) == 0]))
 
     @commands.command(usage='finduniname <name>', description="Find member searching by unicode character replacement.")
     @checks.is_staff_check()
     async def finduniname(self, ctx, *, name):
-        nicks = []
-        map = {}
-        for m in ctx.guild.members:
-            n = unidecode(m.name)
-            nicks.append(n)
-            map[n] = m
-        matches = difflib.get_close_matches(name, nicks, cutoff=0.15)
-        print(f"Uni Matches: {matches}")
+        matches = self.client.member_names.get(ctx.guild).fuzzy_ascii(name, limit=3, cutoff=0.2)
+        print(f"Uni Matches: {[(m.name, round(score, 2)) for m, score in matches]}")
         if matches:
-            await ctx.send("".join([map.get(m).mention for m in matches]))
+            await ctx.send(" ".join([f"{m.mention} ({score:.0%})" for m, score in matches]))
         else:
             await ctx.send("No matches found!")
 
@@ -333,11 +316,11 @@ class Moderation(commands.Cog):
     @commands.guild_only()
     @checks.is_staff_check()
     async def cleanreports(self, ctx):
-        reports_channel = self.client.variables[ctx.guild.id]['spam_reports']
+        reports_channel = self.client.variables[ctx.guild.id].spam_reports
         if not reports_channel:
             return await ctx.send("Error! No configured spam reports channel!")
 
-        log_channel = self.client.variables[ctx.guild.id]['log_channel']
+        log_channel = self.client.variables[ctx.guild.id].log_channel
 
         async for message in reports_channel.history():
             if message.author == self.client.user:
@@ -368,26 +351,10 @@ class Moderation(commands.Cog):
             #             new_mems.append(m)
             #         else:
             #             mems.append(m)
-            if m.name[-1].isdigit():
-                words = m.name[:-1]
-                index = None
-
-                for i, c in enumerate(words):
-                    if c.isupper():
-                        if index is not None:
-                            index = None
-                            break
-                        index = i
-
-                if index:
-                    first_word = words[:index]
-                    second_word = words[index:].lower()
-
-                    if first_word in self.client.adjective_list and second_word in self.client.noun_list:
-                        mems.append(m)
-
-        msg_data = await sql.get_all_logs(self.client.pool)
-        msg_data = {r[sql.log_cols.uid]: r[sql.log_cols.msg_count] for r in msg_data if r[sql.log_cols.gid] == ctx.guild.id}
+            if self.client.wordlist.is_match(m):
+                mems.append(m)
+
+        msg_data = {uid: msg_count async for uid, msg_count in sql.iter_msg_counts(self.client.pool, ctx.guild.id)}
         no_messages = [m for m in mems if msg_data.get(m.id, 0) == 0]
         no_messages_12 = [m for m in new_mems if msg_data.get(m.id, 0) == 0]
         one_message = [m for m in mems if msg_data.get(m.id, 0) == 1]
@@ -501,136 +468,6 @@ class Moderation(commands.Cog):
         embed.timestamp = datetime.datetime.utcnow()
         await msg.edit(embed=embed)
 
-    async def sync_photo_hashes(self, guild: discord.Guild, channel: discord.TextChannel):
-        embed = discord.Embed(title="Fetching Photos From Discord...", description="Please wait while profile photos are retrieved from discord.\n", color=discord.Color.gold())
-        embed.add_field(name="Members to be Retrieved:", value=f"{len(guild.members)} members in the server.")
-        embed.timestamp = datetime.datetime.utcnow()
-        msg = await channel.send(embed=embed)
-
-        await guild.chunk()
-        log_data = await sql.get_all_logs(self.client.pool)
-        log_uids = {r[1] for r in log_data}
-        no_hashes = {r[1] for r in log_data if r[4] is None}
-        memlist: list[discord.Member] = [m for m in guild.members if (m.id in no_hashes or m.id not in log_uids) and m.display_avatar != m.default_avatar]
-        already_hashed = len(log_uids) - len(no_hashes)
-
-        defaults = [(guild.id, m.id, default_avatars[m.default_avatar.key]) for m in guild.members if (m.id in no_hashes or m.id not in log_uids) and m.display_avatar ==
-                    m.default_avatar]
-        print(f"Defaults: {len(defaults)} ({defaults[:1]})")
-        if len(defaults) > 0:
-            await sql.batch_update_photo_hashes(self.client.pool, defaults)
-            already_hashed += len(defaults)
-
-        if len(memlist) == 0:
-            await msg.delete()
-            return True
-
-        desc = "Please wait while member list is indexed for photo hashes.\nThis can take a long time (Est. 10m for 50,000+ members).\n"
-        embed = discord.Embed(title="Checking Image Similarities...",
-                              description=desc + utils.textProgressBar(already_hashed, len(memlist) + already_hashed, prefix="Progress: ", suffix="", decimals=2, length=13, fullisred=False),
-                              color=discord.Color.orange())
-        embed.add_field(name="Members checked:", value=f"**{already_hashed}** / {len(memlist)+already_hashed} members hashed\n__{0}__ matches found.")
-        embed.set_thumbnail(url="https://i.imgur.com/nLRgnZf.gif")
-        embed.set_footer(text='Elapsed: 0s | Est. Left: Calculating...')
-        embed.timestamp = datetime.datetime.utcnow()
-        await msg.edit(embed=embed)
-
-
-        base_url = "https://api.imagekit.io/v1/metadata?url=https://ik.imagekit.io/ugssigsf4u/avatars"
-        ext = ".webp?size=64"
-        headers = {'Authorization': f'Basic {self.client.IMAGEKIT_TOKEN}'}
-
-        async def send_request(m: discord.Member, client_session: aiohttp.ClientSession, url: str, rate_limiter: utils.SephamoreRateLimiter):
-            async with rate_limiter.throttle():
-                response = await client_session.get(url)
-
-            # Why are the following lines not included in the rate limiter context?
-            # because all we want to control is the rate of io operations
-            # and since the following lines instruct reading the response stream into memory,
-            # it shouldn't block the next requests from sending
-            # (unless you have limited memory or large files to ingest.
-            # In that case you should add it to the context
-            # but also make sure you free memory for the next requests)!
-            # so we should now release the semaphore and let the
-            # stream reading begin async while letting the rest of the requests go on sending
-            if response.status == 429:
-                rate_limiter.hit_429(response.headers)
-                data = None
-            elif response.status == 200:
-                data = await response.json()
-                data = (m.guild.id, m.id, data['pHash'])
-            else:
-                print(f"ERROR ({response.status} - {response.reason}): {response.url}")
-                data = await response.text()
-                print(f"Message: {data}")
-                data = None
-            response.release()
-
-            return m, data
-
-        sql_data: list = []
-        start_time = datetime.datetime.utcnow()
-
-        async with utils.SephamoreRateLimiter(rate_limit=10000, concurrency_limit=3000) as rate_limiter:
-            async with aiohttp.ClientSession(headers=headers) as cs:
-                i = 0
-
-                async def run_tasks(task_list, count, sql_data_list):
-                    last_update = 0
-                    failed_list = []
-
-                    for future in asyncio.as_completed(task_list):
-                        m, data = await future
-                        count += 1
-                        if data is not None:
-                            sql_data_list.append(data)
-                        else:
-                            failed_list.append(m)
-
-                        if count % 200 == 0:
-                            print(f"Updating SQL Hashes ({count})")
-                            await sql.batch_update_photo_hashes(self.client.pool, sql_data_list)
-                            sql_data_list.clear()
-
-                            elapsed_s = int((datetime.datetime.utcnow() - start_time).total_seconds())
-                            if elapsed_s - last_update > 15:
-                                last_update = elapsed_s
-                                minutes, seconds = divmod(elapsed_s, 60)
-                                l_min, l_secs = divmod(int((elapsed_s / count) * len(memlist)), 60)
-                                embed.description = desc + utils.textProgressBar(count + already_hashed, len(memlist) + already_hashed, prefix="Progress: ", suffix="", decimals=2, length=13,
-                                                                                 fullisred=False)
-                                embed.set_footer(text=f'Elapsed: {minutes}m{seconds}s | Est. Left: {l_min}m{l_secs}s')
-                                embed.set_field_at(0, name="Members hashes:", value=f"**{count + already_hashed}** / {len(memlist) + already_hashed} members checked\n{len(failed_list)} members "
-                                                                                    f"failed to be retrieved.")
-                                await msg.edit(embed=embed)
-
-                    return count, sql_data_list, failed_list
-
-                tasks = [send_request(m, client_session=cs, url=url, rate_limiter=rate_limiter) for m, url in
-                         [(m, f"{base_url}/{m.id}/{m.display_avatar.key}{ext}") for m in memlist]
-                         ]
-                i, sql_data, failed = await run_tasks(tasks, i, sql_data)
-                print("DONE.. Trying failed again.")
-
-                tasks = [send_request(m, client_session=cs, url=url, rate_limiter=rate_limiter) for m, url in
-                         [(m, f"{base_url}/{m.id}/{m.display_avatar.key}{ext}") for m in failed]
-                         ]
-                i, sql_data, failed = await run_tasks(tasks, i, sql_data)
-
-                failed =[]
-
-
-        print("Updating Final SQL Hashes")
-        await sql.batch_update_photo_hashes(self.client.pool, sql_data)
-        print("Done updating.")
-
-        await channel.send("Failed to get:\n" + "".join([m.mention for m in failed]))
-        embed = discord.Embed(title="Success!", description=f"Added **{len(memlist)}** profile hashes to the database!", color=discord.Color.blue())
-        embed.set_footer(text="©Cryptographer")
-        embed.timestamp = datetime.datetime.utcnow()
-        await msg.edit(embed=embed)
-        return True
-
     @commands.command(usage="photoblacklist <user>")
     @commands.guild_only()
     @checks.is_staff_check()
@@ -639,28 +476,23 @@ class Moderation(commands.Cog):
         if user.display_avatar == user.default_avatar:
             raise discord.ext.commands.BadArgument(message="Cannot photo-blacklist a user with a default profile photo!")
 
-        res = await self.sync_photo_hashes(ctx.guild, ctx.channel)
+        # Only avatars that changed since the last sync are rehashed
+        res = await self.client.jobs.photo_sync(ctx.guild, ctx.channel).wait()
         if not res:
             await ctx.send(f"PFP Hashing failed! Results shown may not be fully accurate! Please run `{ctx.prefix}syncphotohashes` to get accurate results.")
 
-        log_data = await sql.get_all_logs(self.client.pool)
-
-        photo_hash = next((r[4] for r in log_data if r[1] == user.id), None)
-        if not photo_hash:
+        photo_hash = await sql.get_user_photo_hash(self.client.pool, user.id)
+        if photo_hash is None:
             photo_hash = await utils.get_photo_hash(self.client, user)
-            if not photo_hash:
+            if photo_hash is None:
                 return await ctx.send(f"No PFP Hash for the specified user! Please run `{ctx.prefix}syncphotohashes` to sync this user's profile photo.")
-            elif any(r[0] == user.id for r in log_data):
-                await sql.update_photo_hash(self.client.pool, user.id, photo_hash, ctx.guild.id, new=False)
-            else:
-                await sql.update_photo_hash(self.client.pool, user.id, photo_hash, ctx.guild.id)
 
-        log_matches = {r[1] for r in log_data if r[4] and (r[4] == photo_hash or utils.hamming_distance(r[4], photo_hash) < 5)}
+        log_matches = set(await sql.find_similar_photos(self.client.pool, ctx.guild.id, photo_hash, 5))
         matches = [m for m in ctx.guild.members if m.id in log_matches]
 
         embed = discord.Embed(title="Success!", description=f"**{len(matches)}** members with identical profile photos found!\n\nTo ban all detected members & __blacklist this "
                                                             f"photo__,\nClick the ✅ to confirm.\nClick the ❌ to ignore this result.", color=discord.Color.green())
-        embed.add_field(name="Photo Hash:", value=photo_hash)
+        embed.add_field(name="Photo Hash:", value=phash.to_hex(photo_hash))
         embed.set_thumbnail(url=user.display_avatar)
         embed.set_footer(text="©Cryptographer")
         embed.timestamp = datetime.datetime.utcnow()
@@ -688,8 +520,11 @@ class Moderation(commands.Cog):
             embed.colour = discord.Color.red()
             return await msg.edit(embed=embed)
         else:
-            self.client.banned_photos.add((ctx.guild.id, photo_hash))
-            await sql.set_banned_photo(self.client.pool, ctx.guild.id, user.id, banned=True)
+            self.client.banned_photos.setdefault(ctx.guild.id, phash.MultiIndexHash()).add(photo_hash)
+            # Store the hash on this guild's row together with the flag, so the blacklist entry can be reloaded on startup
+            async with sql.transaction(self.client.pool) as tx:
+                await sql.update_photo_hash(tx, user.id, photo_hash, ctx.guild.id, avatar_key=user.display_avatar.key)
+                await sql.set_banned_photo(tx, ctx.guild.id, user.id, banned=True)
 
             matches.append(user)
 
@@ -714,12 +549,25 @@ class Moderation(commands.Cog):
             await msg.edit(embed=embed)
 
 
-    @commands.command(usage="syncphotohashes", description="Sync all photo hashes for this server.")
+    @commands.command(usage="syncphotohashes [full]", description="Sync photo hashes for this server in the background.\n"
+                                                                  "Only changed avatars are rehashed unless `full` is specified.")
     @commands.guild_only()
     @checks.is_staff_check()
-    @commands.max_concurrency(1, per=discord.ext.commands.BucketType.guild)
-    async def syncphotohashes(self, ctx):
-        await self.sync_photo_hashes(ctx.guild, ctx.channel)
+    async def syncphotohashes(self, ctx, mode: str = "changed"):
+        if ctx.guild.id in self.client.jobs.running:
+            return await ctx.send(f"A photo hash sync is already running for this server! Use `{ctx.prefix}jobs` to check its progress.")
+        self.client.jobs.photo_sync(ctx.guild, ctx.channel, changed_only=mode.lower() != "full")
+
+    @commands.command(usage="jobs", description="Show background jobs for this server.")
+    @commands.guild_only()
+    @checks.is_staff_check()
+    async def jobs(self, ctx):
+        jobs = self.client.jobs.for_guild(ctx.guild.id)
+        desc = "\n".join(job.describe() for job in reversed(jobs)) if jobs else "No background jobs have run since the last restart."
+        embed = discord.Embed(title="Background Jobs", description=desc, color=discord.Color.blue())
+        embed.set_footer(text="©Cryptographer")
+        embed.timestamp = datetime.datetime.utcnow()
+        await ctx.send(embed=embed)
 
     @commands.command(usage="creationdate <user>")
     async def creationdate(self, ctx, user:discord.User):
@@ -755,26 +603,15 @@ class Moderation(commands.Cog):
     @commands.guild_only()
     @checks.is_staff_check()
     async def photoduplicates(self, ctx):
-        await self.sync_photo_hashes(ctx.guild, ctx.channel)
-
-        data = await sql.get_all_logs(self.client.pool)
-        user_dict = {}
-
-        for r in data:
-            if r[sql.log_cols.gid] == ctx.guild.id:
-                user_dict[r[sql.log_cols.uid]] = (r[sql.log_cols.msg_count], r[sql.log_cols.photo_hash])
+        await self.client.jobs.photo_sync(ctx.guild, ctx.channel).wait()
 
         duplicates = {}
 
-        for m in ctx.guild.members:
-            if m.id in user_dict:
-                if user_dict[m.id][1] not in ["red", "orange", "grey", "green", "blurple"]:
-                    lst = duplicates.get(user_dict[m.id][1], None)
-                    if not lst:
-                        lst = [m]
-                    else:
-                        lst.append(m)
-                    duplicates[user_dict[m.id][1]] = lst
+        # Default avatars live in their own column, so every row returned here is a real photo hash
+        for uid, photo_hash in await sql.get_duplicate_photos(self.client.pool, ctx.guild.id, 3):
+            m = ctx.guild.get_member(uid)
+            if m:
+                duplicates.setdefault(photo_hash, []).append(m)
 
         duplicates = dict((k,v) for k,v in duplicates.items() if len(v) > 3)
 
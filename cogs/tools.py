@@ -51,22 +51,20 @@ class Tools(commands.Cog):
         if currency[0] == currency[1]:
             price = amount
         else:
+            async def retrying(attempt, status):
+                await msg.edit(content=f"I'm having trouble fetching current exchange rates!{f' (Status: {status})' if status else ''}... Retrying ({attempt}/2)")
+
             try:
-                async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(10)) as cs:
-                    for i in range(2):
-                        async with cs.get(f'https://pro-api.coinmarketcap.com/v1/tools/price-conversion?symbol={currency[0]}&convert={currency[1]}&amount={amount}',
-                                          headers={'X-CMC_PRO_API_KEY': self.client.CMC_TOKEN}) as r:
-                            if r.status != 200:
-                                await msg.edit(f"I'm having trouble fetching current exchange rates! (Status: {r.status})... Retrying ({i}/3)")
-                                continue
-                            data = await r.json()
-                            if data['status']['error_code'] != 0:
-                                await msg.edit(f"I'm having trouble fetching current exchange rates!... Retrying ({i+1}/3)")
-                                continue
-                            break
+                r = await self.client.http_client.get(f'https://pro-api.coinmarketcap.com/v1/tools/price-conversion?symbol={currency[0]}&convert={currency[1]}&amount={amount}',
+                                               endpoint='cmc.price-conversion', headers={'X-CMC_PRO_API_KEY': self.client.CMC_TOKEN},
+                                               retry_if=lambda r: r.get('status', 'error_code') != 0, on_retry=retrying)
             except (asyncio.TimeoutError, aiohttp.ClientError):
                 error.description = "Retrieval of exchange rates took too long! Please try running the command later."
                 return await msg.edit(content="", embed=error)
+            if r.status != 200 or r.get('status', 'error_code') != 0 or r.get('data', 'quote', currency[1], 'price') is None:
+                error.description = "Failed to fetch current exchange rates! Please try running the command later."
+                return await msg.edit(content="", embed=error)
+            data = r.data
 
             price = data['data']['quote'][currency[1]]['price']
 
@@ -86,8 +84,7 @@ class Tools(commands.Cog):
         resolved = ctx.message.reference.resolved
         content = resolved.content if resolved and resolved.content else ""
 
-        with open('data/reminders.json',) as file:
-            reminders = json.load(file, )
+        reminders = self.client.state['reminders']
 
         name = reminders[str(ctx.guild.id)]['name']
         photo = reminders[str(ctx.guild.id)]['photo']
@@ -96,9 +93,6 @@ class Tools(commands.Cog):
         if str(ctx.author.id) in reminders[str(ctx.guild.id)] and reminders[str(ctx.guild.id)][str(ctx.author.id)] is not None:
             if len(reminders[str(ctx.guild.id)][str(ctx.author.id)]) > 9:
                 return await ctx.send("You cannot have more than 10 pending reminders! Wait until one expires before creating another.")
-            reminders[str(ctx.guild.id)][str(ctx.author.id)].append(data)
-        else:
-            reminders[str(ctx.guild.id)][str(ctx.author.id)] = [data]
 
         try:
             embed = discord.Embed(title="Reminder Set!", url=ctx.message.reference.jump_url, description=f"I will be reminding you about the linked message in:\n"
@@ -110,17 +104,20 @@ class Tools(commands.Cog):
             if content:
                 embed.add_field(name="Message Content:", value=content)
             await ctx.author.send(embed=embed)
-
-            with open('data/reminders.json', 'w') as file:
-                json.dump(reminders, file, indent=4)
         except discord.Forbidden:
             await ctx.message.add_reaction("❌")
             return await ctx.send("Please enable DM's to use this command!")
         except discord.DiscordException:
             return
 
+        if reminders[str(ctx.guild.id)].get(str(ctx.author.id)):
+            reminders[str(ctx.guild.id)][str(ctx.author.id)].append(data)
+        else:
+            reminders[str(ctx.guild.id)][str(ctx.author.id)] = [data]
+        self.client.state.changed('reminders')
+
         await ctx.message.add_reaction("✅")
-        await reminder(ctx.author, ctx.guild.id, name, photo, total_seconds, ctx.message.reference.jump_url, resolved.author.name, resolved.author.display_avatar, content)
+        await reminder(self.client.state, ctx.author, ctx.guild.id, name, photo, total_seconds, ctx.message.reference.jump_url, resolved.author.name, resolved.author.display_avatar, content)
 
     @commands.command(usage='greed', description="Retrieve the current Crypto Fear & Greed Index", aliases=['fear', 'fng'])
     @commands.cooldown(1, 5, discord.ext.commands.BucketType.member)
@@ -129,21 +126,18 @@ class Tools(commands.Cog):
         msg = await ctx.send("Fetching Index data...")
         data = None
 
+        async def retrying(attempt, status):
+            await msg.edit(content=f"I'm having trouble fetching current index data!{f' (Status: {status})' if status else ''}... Retrying ({attempt}/2)")
+
         try:
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(10)) as cs:
-                for i in range(2):
-                    async with cs.get(f'https://api.alternative.me/fng/') as r:
-                        if r.status != 200:
-                            await msg.edit(f"I'm having trouble fetching current index data! (Status: {r.status})... Retrying ({i}/3)")
-                            continue
-                        data = await r.json()
-                        if not data:
-                            await msg.edit(f"I'm having trouble fetching current index data!... Retrying ({i + 1}/3)")
-                            continue
-                        break
+            r = await self.client.http_client.get('https://api.alternative.me/fng/', endpoint='fng.index', retry_if=lambda r: r.get('data', 0, 'value') is None, on_retry=retrying)
         except (asyncio.TimeoutError, aiohttp.ClientError):
             error.description = "Retrieval of index data took too long! Please try running the command later."
             return await msg.edit(content="", embed=error)
+        if r.status != 200 or r.get('data', 0, 'value') is None:
+            error.description = "Failed to fetch current index data! Please try running the command later."
+            return await msg.edit(content="", embed=error)
+        data = r.data
 
         num = int(data['data'][0]['value'])
         classification = data['data'][0]['value_classification']
@@ -195,7 +189,7 @@ def setup(client):
     client.add_cog(Tools(client))
 
 
-async def reminder(user, guild_id, guild_name, guild_icon, t_seconds, jump_url, author_name, author_pfp, content):
+async def reminder(state, user, guild_id, guild_name, guild_icon, t_seconds, jump_url, author_name, author_pfp, content):
     await asyncio.sleep(t_seconds)
 
     embed = discord.Embed(title="Link to Message (Click Me!)", url=jump_url, description=f"Message sent in {guild_name} by {author_name}", color=discord.Color.gold())
@@ -209,18 +203,15 @@ async def reminder(user, guild_id, guild_name, guild_icon, t_seconds, jump_url,
     except discord.DiscordException:
         pass
 
-    with open('data/reminders.json') as file:
-        reminders = json.load(file)
+    reminders = state['reminders']
 
-    if reminders[str(guild_id)][str(user.id)]:
-        for r in reminders[str(guild_id)][str(user.id)]:
+    pending = reminders[str(guild_id)].get(str(user.id))
+    if pending:
+        for r in pending:
             if r[1] == jump_url:
-                if reminders[str(guild_id)][str(user.id)] is None or len(reminders[str(guild_id)][str(user.id)]) == 1:
-                    data = reminders.get(str(guild_id)).copy()
-                    del data[str(user.id)]
-                    reminders[str(guild_id)] = data
+                if len(pending) == 1:
+                    del reminders[str(guild_id)][str(user.id)]
                 else:
-                    reminders[str(guild_id)][str(user.id)] = reminders[str(guild_id)][str(user.id)].remove(r)
-
-    with open('data/reminders.json', 'w') as file:
-        json.dump(reminders, file, indent=4, )
+                    pending.remove(r)
+                state.changed('reminders')
+                break
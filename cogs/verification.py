@@ -3,11 +3,13 @@ import datetime
 import json
 import logging
 from random import random
+from typing import Dict, List, Optional
 
 import discord
 from discord.ext import commands
-from unidecode import unidecode
 
+import confusables
+import phash
 import sql
 import utils
 from main import CryptoBot
@@ -15,7 +17,9 @@ from cogs.log import send_log, action_log, verify_log, VerifyAction
 from views.verify_view import VerifyView
 
 log = logging.getLogger('discord')
-default_avatars = {'0': "blurple", '1': "gray", '2': "green", '3': "yellow", '4': "red", '5': "pink"}
+
+PING_BATCH = 50  # Mentions per captcha channel message when pinging the startup backlog, well under the 2000 character limit
+PING_INTERVAL = 1.0  # Seconds between those messages, so a large backlog stays under the channel's send rate limit
 
 
 class Verification(discord.ext.commands.Cog):
@@ -27,7 +31,7 @@ class Verification(discord.ext.commands.Cog):
     @commands.command(usage="addverimsg", description="Add the verification message")
     @commands.check_any(commands.is_owner(), commands.has_permissions(manage_guild=True))
     async def addverimsg(self, ctx):
-        verified_role = self.client.variables[ctx.guild.id]['verified_role']
+        verified_role = self.client.variables[ctx.guild.id].verified_role
 
         if not verified_role:
             return await ctx.send("Please configure the verified role before setting up verification!")
@@ -50,7 +54,7 @@ class Verification(discord.ext.commands.Cog):
     @commands.command(usage="addtestveri", description="Add a temporary test verification message")
     @commands.check_any(commands.is_owner(), commands.has_permissions(manage_guild=True))
     async def addtestveri(self, ctx):
-        verified_role = self.client.variables[ctx.guild.id]['verified_role']
+        verified_role = self.client.variables[ctx.guild.id].verified_role
 
         if not verified_role:
             return await ctx.send("Please configure the verified role before setting up verification!")
@@ -79,7 +83,7 @@ class Verification(discord.ext.commands.Cog):
         if member.bot:
             return
 
-        log_channel: discord.TextChannel = self.client.variables[member.guild.id]['log_channel']
+        log_channel: discord.TextChannel = self.client.variables[member.guild.id].log_channel
 
         if await self.check_banned_name(member, log_channel):
             return
@@ -90,7 +94,7 @@ class Verification(discord.ext.commands.Cog):
         if await self.check_account_age(member, log_channel):
             return
 
-        captcha_channel: discord.TextChannel = self.client.variables[member.guild.id]['captcha_channel']
+        captcha_channel: discord.TextChannel = self.client.variables[member.guild.id].captcha_channel
         await captcha_channel.send(member.mention, delete_after=0.5)
 
         # await self.wait_for_verification(member)
@@ -104,57 +108,85 @@ class Verification(discord.ext.commands.Cog):
 
     @commands.Cog.listener()
     async def on_member_update(self, before: discord.Member, after: discord.Member):
-        temp_role: discord.Role = self.client.variables[after.guild.id]['temporary_role']
+        temp_role: discord.Role = self.client.variables[after.guild.id].temporary_role
         if before.pending and not after.pending:
             if not temp_role:
                 return await verify_log(self.client, after, VerifyAction.ERR_NO_TEMP_ROLE)
             await verify_log(self.client, after, VerifyAction.COMPLETE_SCREENING)
             await after.add_roles(temp_role)
             await self.wait_for_verification(after)
-            try:
-                self.client.pending_verification.remove(after.id)
-            except KeyError:
-                pass
-        verified_role: discord.Role = self.client.variables[after.guild.id]['verified_role']
+        verified_role: discord.Role = self.client.variables[after.guild.id].verified_role
+        if verified_role in after.roles and verified_role not in before.roles:
+            self.client.verification_timers.cancel((after.guild.id, after.id))
         if temp_role in before.roles and verified_role in after.roles:
             await after.remove_roles(temp_role)
 
-    async def recheck_verification(self, member: discord.Member) -> None:
-        await self.wait_for_verification(member)
-        try:
-            self.client.pending_verification.remove(member.id)
-        except KeyError:
-            pass
-
-    async def wait_for_verification(self, member: discord.Member) -> None:
-        captcha_channel: discord.TextChannel = self.client.variables[member.guild.id]['captcha_channel']
-        time_left = 300
-        await captcha_channel.send(member.mention, delete_after=0.5)
-
-        async def check_status():
-            if not member: return
+    @commands.Cog.listener()
+    async def on_member_remove(self, member: discord.Member):
+        self.client.verification_timers.cancel((member.guild.id, member.id))
+        self.client.pending_verification.discard(member.id)
 
-            if member.id in self.client.pending_verification:
-                await asyncio.sleep(121)  # wait to check if timed out or completed
-            # Check if member has the role yet
-            return self.client.variables[member.guild.id]['verified_role'] in member.roles
+    def start_verification_timer(self, member: discord.Member) -> None:
+        """Start the member's verification timer: a warning after 3 minutes, a kick 3 minutes later"""
+        self.client.verification_timers.schedule((member.guild.id, member.id), 180, self.verification_warning, member.guild.id, member.id)
 
-        await asyncio.sleep((time_left-120))  # sleep until there's 2m left
-        if not member or self.client.variables[member.guild.id]['verified_role'] in member.roles:
+    async def wait_for_verification(self, member: discord.Member) -> None:
+        """Ping the member in the captcha channel & start their verification timer"""
+        self.start_verification_timer(member)
+        captcha_channel: discord.TextChannel = self.client.variables[member.guild.id].captcha_channel
+        try:
+            await captcha_channel.send(member.mention, delete_after=0.5)
+        except discord.HTTPException:
+            pass  # The timer is already running, a missed ping only skips the nudge
+
+    async def ping_members(self, members: List[discord.Member]) -> None:
+        """Ping a backlog of members in their captcha channels, several mentions per message & spaced out to stay under the rate limit"""
+        mentions: Dict[discord.TextChannel, List[str]] = {}
+        for m in members:
+            mentions.setdefault(self.client.variables[m.guild.id].captcha_channel, []).append(m.mention)
+        for captcha_channel, channel_mentions in mentions.items():
+            for i in range(0, len(channel_mentions), PING_BATCH):
+                try:
+                    await captcha_channel.send(" ".join(channel_mentions[i:i + PING_BATCH]), delete_after=0.5)
+                except discord.HTTPException:
+                    pass  # The timers are already running, a missed ping only skips the nudge
+                await asyncio.sleep(PING_INTERVAL)
+
+    def _unverified_member(self, guild_id: int, member_id: int) -> Optional[discord.Member]:
+        """The member if they're still in the guild without the verified role, otherwise None (ending their verification)"""
+        guild = self.client.get_guild(guild_id)
+        member = guild.get_member(member_id) if guild else None
+        if member is None:
+            self.client.pending_verification.discard(member_id)
+            return None
+        # Verified members are removed from pending_verification by the verify view itself
+        return None if self.client.variables[guild_id].verified_role in member.roles else member
+
+    async def verification_warning(self, guild_id: int, member_id: int) -> None:
+        member = self._unverified_member(guild_id, member_id)
+        if member is None:
             return
 
-        if member.id not in self.client.pending_verification:
+        if member_id not in self.client.pending_verification:
+            captcha_channel: discord.TextChannel = self.client.variables[guild_id].captcha_channel
             await captcha_channel.send(f"{member.mention} - You will be kicked from the server in __2 minutes__ if verification has not been started before then!", delete_after=15)
+        self.client.verification_timers.schedule((guild_id, member_id), 180, self.verification_deadline, guild_id, member_id)
+
+    async def verification_deadline(self, guild_id: int, member_id: int, extended: bool = False) -> None:
+        member = self._unverified_member(guild_id, member_id)
+        if member is None:
+            return
 
-        await asyncio.sleep(180)
-        if await check_status():
+        if member_id in self.client.pending_verification and not extended:
+            # Verification in progress, give it time to complete
+            self.client.verification_timers.schedule((guild_id, member_id), 121, self.verification_deadline, guild_id, member_id, True)
             return
 
+        self.client.pending_verification.discard(member_id)
         await verify_log(self.client, member, VerifyAction.EXPIRED)
         await member.kick(reason="Timed out awaiting Verification")
 
         await action_log(self.client, member, False, "Timed out awaiting Verification")
-        return
 
 
     async def check_banned_name(self, member: discord.Member, log_channel: discord.TextChannel):
@@ -165,13 +197,14 @@ class Verification(discord.ext.commands.Cog):
         :return boolean: if the member was banned or not
         """
 
-        # First, determine if name contains unicode characters, if so - run unidecode & check against reference
-        if ((not any(ord(char) < 128 for char in member.name) and unidecode(member.name) in self.client.banned_names[str(member.guild.id)][1])
-                or member.name in self.client.banned_names[str(member.guild.id)][0]):  # Else, check if name matches name blacklist
-            log.info(f"Member joined with banned name: {member.name}")
+        # Disguised names are compared by confusable skeleton, so lookalike & zero-width characters don't evade the blacklist
+        banned = self.client.banned_skeletons.get(member.guild.id)
+        rule = None
+        if (banned and banned.matches(member.name)) or (rule := self.client.banned_patterns.match(member.guild.id, confusables.skeleton(member.name))):
+            log.info(f"Member joined with banned name: {member.name}" + (f" (pattern {rule})" if rule else ""))
 
             try:
-                await member.ban(reason="User joined with banned name!")
+                await member.ban(reason="User joined with banned name!" + (f" Matched pattern {rule}" if rule else ""))
                 await action_log(self.client, member, True, "Banned Name")
                 return True
             except discord.DiscordException:
@@ -189,17 +222,17 @@ class Verification(discord.ext.commands.Cog):
 
         # First, retrieve and store (perceptual "pHash") photo hash in DB
         if member.display_avatar == member.default_avatar:
-            photo_hash = default_avatars[member.default_avatar.key]
+            photo_hash, default_avatar = None, phash.DEFAULT_AVATARS[member.default_avatar.key]
         else:
-            photo_hash = await utils.get_photo_hash(self.client, member)
+            photo_hash, default_avatar = await utils.get_photo_hash(self.client, member), None
 
-        if photo_hash:
-            await sql.update_photo_hash(self.client.pool, member.id, photo_hash, member.guild.id)
+        if photo_hash is not None or default_avatar:
+            await sql.update_photo_hash(self.client.pool, member.id, photo_hash, member.guild.id, default_avatar=default_avatar,
+                                       avatar_key=member.display_avatar.key)
 
             # Check photo hash against blacklist or matches blacklist with 5 % similarity
-            if (member.guild.id, photo_hash) in self.client.banned_photos or \
-                    any(utils.hamming_distance(hsh, photo_hash) < 5 for gid, hsh in self.client.banned_photos if \
-                        gid == member.guild.id):
+            banned = self.client.banned_photos.get(member.guild.id)
+            if banned is not None and photo_hash is not None and banned.any_within(photo_hash):
                 log.info(f"Member joined with banned photo: {member.name} (ID: {member.id})")
 
                 try:
@@ -219,7 +252,7 @@ class Verification(discord.ext.commands.Cog):
         :return boolean: if the member was banned or not
         """
         # Check for minimum account age
-        min_account_age_seconds = self.client.variables[member.guild.id]['min_account_age_seconds']
+        min_account_age_seconds = self.client.variables[member.guild.id].min_account_age_seconds
 
         # Check the user account creation date (1 day by default)
         if min_account_age_seconds != -1:
@@ -0,0 +1,139 @@
+"""
+Confusable skeletons of names, loosely after Unicode TR39: two names that render alike get the same skeleton
+skeleton() applies NFKD (fullwidth, mathematical & enclosed letters become ASCII), drops invisible format characters (zero-width
+spaces & joiners, direction marks) & combining marks, maps homoglyphs to the letter they imitate, then casefolds. Characters
+still outside ASCII are transliterated with unidecode, & whitespace is removed.
+The built-in table covers the Cyrillic & Greek lookalikes seen in scam names. A copy of Unicode's confusables.txt at
+data/confusables.txt extends it when present.
+Skeletons are only compared for names that look disguised (any non-ASCII character, or an ASCII lookalike like | 1 0), so a plain
+ASCII name is still only banned by an exact match against the first list of data/banned_names.json, as before.
+"""
+import os
+import unicodedata
+from typing import Dict, FrozenSet, Iterable, NamedTuple, Sequence
+
+from unidecode import unidecode
+
+# Format characters (Cf: zero-width space/joiners, LRM/RLM, soft hyphen...), combining & enclosing marks
+IGNORED_CATEGORIES = frozenset(('Cf', 'Mn', 'Me'))
+
+HOMOGLYPHS = {
+    # Cyrillic
+    'А': 'A', 'В': 'B', 'Е': 'E', 'Ѕ': 'S', 'І': 'I', 'Ј': 'J', 'К': 'K', 'М': 'M', 'Н': 'H', 'О': 'O', 'Р': 'P', 'С': 'C', 'Т': 'T',
+    'Х': 'X', 'У': 'Y', 'Ԁ': 'D', 'Ԛ': 'Q', 'Ԝ': 'W', 'Ү': 'Y', 'Ӏ': 'l',
+    'а': 'a', 'е': 'e', 'о': 'o', 'р': 'p', 'с': 'c', 'у': 'y', 'х': 'x', 'ѕ': 's', 'і': 'i', 'ј': 'j', 'ԁ': 'd', 'ԛ': 'q', 'ԝ': 'w',
+    'һ': 'h', 'ү': 'y', 'ӏ': 'l', 'ь': 'b', 'п': 'n', 'г': 'r', 'т': 't', 'к': 'k', 'м': 'm', 'в': 'b', 'н': 'h',
+    # Greek
+    'Α': 'A', 'Β': 'B', 'Ε': 'E', 'Ζ': 'Z', 'Η': 'H', 'Ι': 'I', 'Κ': 'K', 'Μ': 'M', 'Ν': 'N', 'Ο': 'O', 'Ρ': 'P', 'Τ': 'T', 'Υ': 'Y',
+    'Χ': 'X', 'α': 'a', 'β': 'b', 'γ': 'y', 'ε': 'e', 'η': 'n', 'ι': 'i', 'κ': 'k', 'ν': 'v', 'ο': 'o', 'ρ': 'p', 'τ': 't', 'υ': 'u',
+    'χ': 'x', 'ω': 'w',
+    # Latin & symbols
+    'ı': 'i', 'ȷ': 'j', 'ɡ': 'g', 'ɑ': 'a', 'ℓ': 'l', 'ſ': 's', 'ꓲ': 'l', 'ǀ': 'l', '|': 'l', '∣': 'l', 'ø': 'o', 'Ø': 'O', 'ð': 'd',
+    'đ': 'd', 'ħ': 'h', 'ł': 'l', 'ß': 'ss', 'æ': 'ae', 'œ': 'oe',
+}
+# Applied after casefolding: letters that only differ from another in case (I/l) or are drawn the same as a digit
+FOLDED = str.maketrans({'i': 'l', '1': 'l', '0': 'o'})
+# ASCII characters standing in for letters, which mark an otherwise plain ASCII name as disguised
+ASCII_LOOKALIKES = frozenset('|10')
+
+_table: Dict[int, str] = str.maketrans(HOMOGLYPHS)
+
+
+def load(path: str = 'data/confusables.txt') -> int:
+    """Extend the homoglyph table from Unicode's confusables.txt (`source ; target ; type # comment`), returning the entries added"""
+    if not os.path.exists(path):
+        return 0
+    added = 0
+    with open(path, encoding='utf-8-sig') as f:
+        for line in f:
+            fields = line.split('#', 1)[0].split(';')
+            if len(fields) < 2:
+                continue
+            source = int(fields[0].strip(), 16)
+            if source not in _table:
+                _table[source] = "".join(chr(int(cp, 16)) for cp in fields[1].split())
+                added += 1
+    return added
+
+
+def skeleton(name: str) -> str:
+    text = unicodedata.normalize('NFKD', name)
+    text = "".join([c for c in text if unicodedata.category(c) not in IGNORED_CATEGORIES])
+    text = text.translate(_table).casefold()
+    if not text.isascii():
+        text = unidecode(text)
+    return "".join(text.translate(FOLDED).split())  # Whitespace is dropped, spacing out a name doesn't change it
+
+
+def is_disguised(name: str) -> bool:
+    """Whether a name uses non-ASCII characters (homoglyphs, zero-width, fullwidth...) or ASCII lookalikes of letters"""
+    return not name.isascii() or any(c in ASCII_LOOKALIKES for c in name)
+
+
+class BannedNames(NamedTuple):
+    exact: FrozenSet[str]  # The exact list, matched as written against every name
+    skeletons: FrozenSet[str]  # Skeletons of both lists, only matched against disguised names
+
+    def matches(self, name: str) -> bool:
+        return name in self.exact or (is_disguised(name) and skeleton(name) in self.skeletons)
+
+
+def skeleton_sets(banned_names: Dict[str, Sequence[Iterable[str]]]) -> Dict[int, BannedNames]:
+    """Each guild's banned names from data/banned_names.json: [exact names, unidecoded names]"""
+    return {int(gid): BannedNames(frozenset(lists[0]), frozenset(skeleton(name) for names in lists for name in names))
+            for gid, lists in banned_names.items()}
+
+
+if __name__ == '__main__':
+    # Benchmark: python confusables.py [names file, one per line] [variants per banned name]
+    import json
+    import random
+    import sys
+    import time
+
+    def main(path: str, variants: int):
+        load()
+        with open('data/banned_names.json') as f:
+            banned_names = json.load(f)
+        gid, (exact, decoded) = next(iter(banned_names.items()))
+        banned = exact + decoded
+        banned_set = skeleton_sets(banned_names)[int(gid)]
+
+        if path:
+            with open(path, encoding='utf-8') as f:
+                corpus = [line.strip() for line in f if line.strip()]
+        else:
+            # No names file given, fall back to random ASCII names
+            corpus = ["".join(random.choices("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_ ", k=random.randint(4, 16))) for _ in range(100000)]
+        random.seed(0)
+        lookalikes = {}
+        # Homoglyph / zero-width / fullwidth variants of each banned name
+        for src, target in HOMOGLYPHS.items():
+            if len(target) == 1:
+                lookalikes.setdefault(target, []).append(src)
+        evasions = []
+        for name in banned:
+            for _ in range(variants):
+                chars = [random.choice(lookalikes[c]) if c in lookalikes and random.random() < 0.5 else c for c in name]
+                if random.random() < 0.5:
+                    chars.insert(random.randrange(len(chars) + 1), random.choice(['​', '‍', '⁠', '‎']))
+                if random.random() < 0.3:
+                    chars = [chr(ord(c) + 0xFEE0) if '!' <= c <= '~' else c for c in chars]
+                evasions.append("".join(chars))
+
+        start = time.perf_counter()
+        for name in corpus:
+            skeleton(name)
+        elapsed = time.perf_counter() - start
+        print(f"skeleton(): {len(corpus)} names in {elapsed:.2f}s ({elapsed / len(corpus) * 1e6:.1f}µs / name)")
+
+        def old_check(name):
+            return name in exact or (not any(ord(c) < 128 for c in name) and unidecode(name) in decoded)
+
+        old = sum(map(old_check, evasions))
+        new = sum(map(banned_set.matches, evasions))
+        false_positives = sum(map(banned_set.matches, corpus))
+        print(f"Evasion variants caught: {new}/{len(evasions)} (exact/unidecode check: {old}/{len(evasions)})")
+        print(f"Corpus names matching a banned skeleton: {false_positives}/{len(corpus)}")
+
+    main(sys.argv[1] if len(sys.argv) > 1 else None, int(sys.argv[2]) if len(sys.argv) > 2 else 20)
@@ -0,0 +1,268 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import sql
+
+logger = logging.getLogger('discord')
+
+
+class MessageCounter:
+    """
+    Aggregates per-(guild, user) message counts in memory & upserts them into crypto.logging in batches,
+    along with the per-user totals in crypto.user_totals.
+    Every increment is appended to a local journal before it can be lost, so counts survive a crash:
+    on flush a `batch <id>` line is appended, the journal is rotated to `<journal>.flushing` and only deleted once the batch is
+    committed. The batch id is claimed in crypto.msg_count_batches in the same transaction as the counts, so a batch replayed
+    after a crash between COMMIT & the delete is recognised & skipped. Until a batch is confirmed no new one is started, so
+    there is at most one. Journal lines left over at startup are replayed: those before a batch line as that batch, the rest
+    (& journals from before batch ids) into the pending counts.
+    Reads go through a TTL cache of stored counts, which flushes keep coherent by applying their deltas to cached entries;
+    pending (unflushed) increments are added on top so reads are always current.
+    """
+
+    def __init__(self, journal_path: str = 'data/msg_counts.journal', max_pending: int = 200, max_age: float = 300.0,
+                 journal_interval: float = 1.0, retry_delay: float = 30.0, cache_ttl: float = 300.0, max_cached: int = 50000):
+        self.journal_path = journal_path
+        self.flushing_path = journal_path + '.flushing'
+        self.max_pending = max_pending
+        self.max_age = max_age
+        self.journal_interval = journal_interval
+        self.retry_delay = retry_delay
+        self.cache_ttl = cache_ttl
+        self.max_cached = max_cached
+
+        self.pending: Dict[Tuple[int, int], int] = {}
+        self.unconfirmed: Optional[Tuple[str, Dict[Tuple[int, int], int]]] = None  # (batch id, counts) rotated but not yet committed
+        self.oldest_pending: Optional[float] = None
+        self.last_flush_latency: Optional[float] = None
+        self.last_flush_size: int = 0
+        self.total_flushed: int = 0
+        self.failed_flushes: int = 0
+        self.cache_hits: int = 0
+        self.cache_misses: int = 0
+
+        self._cache: Dict[Tuple[int, int], Tuple[int, float]] = {}  # (gid, uid) -> (stored count, expiry)
+        self._flush_generation: int = 0
+
+        self._journal_buffer: List[str] = []
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pool = None
+        self._retry_at: float = 0.0
+
+        self._replay()
+
+    @property
+    def backlog(self) -> int:
+        """Number of (guild, user) keys waiting to be written"""
+        return len(self.pending) + (len(self.unconfirmed[1]) if self.unconfirmed else 0)
+
+    def _replay(self) -> None:
+        for path in (self.flushing_path, self.journal_path):
+            if not os.path.exists(path):
+                continue
+            counts: Dict[Tuple[int, int], int] = {}
+            with open(path) as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 2 and fields[0] == 'batch':
+                        if self.unconfirmed:
+                            # An earlier batch line whose rotation failed, so it was never committed & was re-batched under this id
+                            for key, n in self.unconfirmed[1].items():
+                                counts[key] = counts.get(key, 0) + n
+                        self.unconfirmed, counts = (fields[1], counts), {}
+                        continue
+                    try:
+                        gid, uid, n = (int(x) for x in fields)
+                    except ValueError:
+                        continue  # Torn final line from a crash mid-write
+                    counts[(gid, uid)] = counts.get((gid, uid), 0) + n
+            for (gid, uid), n in counts.items():
+                self._add(gid, uid, n)
+        if self.backlog:
+            logger.info(f"Replayed {self.backlog} pending message counts from journal")
+
+    def _unflushed(self, gid: int, uid: int) -> int:
+        n = self.pending.get((gid, uid), 0)
+        if self.unconfirmed:
+            n += self.unconfirmed[1].get((gid, uid), 0)
+        return n
+
+    def _add(self, gid: int, uid: int, n: int) -> None:
+        key = (gid, uid)
+        self.pending[key] = self.pending.get(key, 0) + n
+        if self.oldest_pending is None:
+            self.oldest_pending = time.monotonic()
+
+    def increment(self, gid: int, uid: int, n: int = 1) -> None:
+        self._add(gid, uid, n)
+        self._journal_buffer.append(f"{gid} {uid} {n}\n")
+
+    async def get_counts(self, gid: int, uids: Iterable[int]) -> Dict[int, int]:
+        """Current message counts for many users of a guild, fetching only uncached users (in a single query)"""
+        now = time.monotonic()
+        counts, missing = {}, []
+        for uid in uids:
+            cached = self._cache.get((gid, uid))
+            if cached is not None and cached[1] > now:
+                counts[uid] = cached[0]
+            else:
+                missing.append(uid)
+        self.cache_hits += len(counts)
+        self.cache_misses += len(missing)
+
+        if missing:
+            generation = self._flush_generation
+            stored = await sql.get_msg_counts(self._db(), gid, missing)
+            # A flush committed while the query ran may or may not be included in its result, so don't cache it
+            if generation == self._flush_generation:
+                if len(self._cache) + len(stored) > self.max_cached:
+                    self._cache = {k: v for k, v in self._cache.items() if v[1] > now}
+                expires = time.monotonic() + self.cache_ttl
+                for uid, count in stored.items():
+                    self._cache[(gid, uid)] = (count, expires)
+            counts.update(stored)
+
+        return {uid: count + self._unflushed(gid, uid) for uid, count in counts.items()}
+
+    async def get_count(self, gid: int, uid: int) -> int:
+        return (await self.get_counts(gid, [uid]))[uid]
+
+    async def get_total(self, uid: int) -> int:
+        """A user's message count across every guild, including increments not flushed yet"""
+        pending = sum(n for (gid, pending_uid), n in self.pending.items() if pending_uid == uid)
+        if self.unconfirmed:
+            pending += sum(n for (gid, pending_uid), n in self.unconfirmed[1].items() if pending_uid == uid)
+        return await sql.get_total_msg_count(self._db(), uid) + pending
+
+    def _db(self):
+        if self._pool is None:
+            raise RuntimeError("MessageCounter read before start(): the database pool isn't connected yet")
+        return self._pool
+
+    def start(self, pool) -> None:
+        self._pool = pool
+        self._flush_lock = asyncio.Lock()
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.journal_interval)
+            try:
+                await self._write_journal()
+                due = self.unconfirmed is not None or (self.pending and (len(self.pending) >= self.max_pending or time.monotonic() - self.oldest_pending >= self.max_age))
+                if due and time.monotonic() >= self._retry_at:
+                    await self.flush()
+            except Exception:
+                logger.exception("Message count aggregator iteration failed")
+
+    async def _write_journal(self) -> None:
+        if not self._journal_buffer:
+            return
+        lines, self._journal_buffer = self._journal_buffer, []
+        await asyncio.get_event_loop().run_in_executor(None, _append, self.journal_path, lines)
+
+    def _rotate_journal(self, batch_id: str) -> None:
+        # The batch line goes in before the (atomic) rename, so whichever file holds the batch's lines also holds its id
+        _append(self.journal_path, [f"batch {batch_id}\n"])
+        os.replace(self.journal_path, self.flushing_path)
+
+    async def flush(self) -> None:
+        """Upsert all pending counts now, retrying an unconfirmed batch first"""
+        if self._pool is None:
+            return
+        async with self._flush_lock:
+            if self.unconfirmed is not None:
+                await self._flush_batch()
+            if self.pending:
+                await self._flush_batch()
+
+    async def _flush_batch(self) -> None:
+        loop = asyncio.get_event_loop()
+        start = time.perf_counter()
+        try:
+            if self.unconfirmed is None:
+                # Take the snapshot & journal lines together (no await in between) so the rotated journal matches the batch
+                batch, self.pending = self.pending, {}
+                lines, self._journal_buffer = self._journal_buffer, []
+                self.oldest_pending = None
+                batch_id = uuid.uuid4().hex
+                journaled = False
+                try:
+                    await loop.run_in_executor(None, _append, self.journal_path, lines)
+                    journaled = True
+                    await loop.run_in_executor(None, self._rotate_journal, batch_id)
+                except Exception:
+                    if not journaled:
+                        self._journal_buffer[:0] = lines
+                    for (gid, uid), n in batch.items():
+                        self._add(gid, uid, n)
+                    raise
+                self.unconfirmed = (batch_id, batch)
+
+            batch_id, batch = self.unconfirmed
+            totals: Dict[int, int] = {}
+            for (gid, uid), n in batch.items():
+                totals[uid] = totals.get(uid, 0) + n
+            # One transaction with the batch id, so a replayed journal can never count a batch twice in either table
+            async with sql.transaction(self._pool) as tx:
+                applied = await sql.claim_msg_count_batch(tx, batch_id)
+                if applied:
+                    await sql.upsert_msg_counts(tx, [(gid, uid, n) for (gid, uid), n in batch.items()])
+                    await sql.upsert_user_totals(tx, list(totals.items()))
+        except Exception:
+            self.failed_flushes += 1
+            self._retry_at = time.monotonic() + self.retry_delay
+            raise
+
+        self.unconfirmed = None
+        # Keep cached stored counts in step with what was just written
+        self._flush_generation += 1
+        if applied:
+            for key, n in batch.items():
+                cached = self._cache.get(key)
+                if cached is not None:
+                    self._cache[key] = (cached[0] + n, cached[1])
+
+        await loop.run_in_executor(None, _unlink, self.flushing_path)
+        self.last_flush_latency = time.perf_counter() - start
+        self.last_flush_size = len(batch)
+        self.total_flushed += len(batch)
+        print(f"Flushed {len(batch)} message counts in {self.last_flush_latency * 1000:.1f}ms ({self.backlog} pending)"
+              + ("" if applied else f", batch {batch_id} was already committed"))
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Final message count flush failed")
+        # Anything left over is journaled & will be replayed on the next start
+        await self._write_journal()
+
+
+def _append(path: str, lines: List[str]) -> None:
+    if not lines:
+        return
+    with open(path, 'a') as f:
+        f.writelines(lines)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _unlink(path: str) -> None:
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,133 @@
+"""
+Fuzzy name search over a trigram inverted index
+Strings are scored by the Dice coefficient of their trigram sets, 2|A ∩ B| / (|A| + |B|): the shared trigram counts of every
+candidate are tallied in one numpy bincount over the query's posting lists, so a search only touches names sharing a trigram.
+"""
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+
+def trigrams(text: str) -> Set[str]:
+    """Trigrams of a lowercased string, padded so short names & word starts still produce some"""
+    padded = f"  {text.lower()} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TrigramIndex:
+    """Incrementally maintained index of strings by key (e.g. member ID), searched with `search()`"""
+
+    def __init__(self, capacity: int = 1024):
+        self.postings: Dict[str, Set[int]] = {}  # Trigram -> slots of the strings containing it
+        self._arrays: Dict[str, np.ndarray] = {}  # Posting lists as arrays, dropped whenever the posting changes
+        self._sizes = np.zeros(capacity, dtype=np.int32)  # Slot -> trigram count of its string
+        self._keys: List[Optional[int]] = []
+        self._grams: List[Optional[Set[str]]] = []
+        self._slots: Dict[int, int] = {}
+        self._free: List[int] = []
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, key: int):
+        return key in self._slots
+
+    def add(self, key: int, text: str) -> None:
+        """Index `text` under `key`, replacing any string previously indexed under it"""
+        self.remove(key)
+        grams = trigrams(text)
+        if self._free:
+            slot = self._free.pop()
+            self._keys[slot], self._grams[slot] = key, grams
+        else:
+            slot = len(self._keys)
+            self._keys.append(key)
+            self._grams.append(grams)
+            if slot == len(self._sizes):
+                self._sizes = np.concatenate((self._sizes, np.zeros(len(self._sizes), dtype=np.int32)))
+        self._sizes[slot] = len(grams)
+        self._slots[key] = slot
+        for gram in grams:
+            self.postings.setdefault(gram, set()).add(slot)
+            self._arrays.pop(gram, None)
+
+    def remove(self, key: int) -> None:
+        slot = self._slots.pop(key, None)
+        if slot is None:
+            return
+        for gram in self._grams[slot]:
+            posting = self.postings[gram]
+            posting.discard(slot)
+            if not posting:
+                del self.postings[gram]
+            self._arrays.pop(gram, None)
+        self._keys[slot] = self._grams[slot] = None
+        self._sizes[slot] = 0
+        self._free.append(slot)
+
+    def _posting(self, gram: str) -> np.ndarray:
+        array = self._arrays.get(gram)
+        if array is None:
+            posting = self.postings[gram]
+            array = self._arrays[gram] = np.fromiter(posting, dtype=np.int32, count=len(posting))
+        return array
+
+    def search(self, query: str, limit: int = 3, cutoff: float = 0.5) -> List[Tuple[int, float]]:
+        """Up to `limit` (key, score) pairs scoring at least `cutoff`, best first"""
+        grams = trigrams(query)
+        postings = [self._posting(gram) for gram in grams if gram in self.postings]
+        if not postings or limit <= 0:
+            return []
+
+        shared = np.bincount(np.concatenate(postings))
+        candidates = np.flatnonzero(shared)
+        scores = 2.0 * shared[candidates] / (len(grams) + self._sizes[candidates])
+        keep = scores >= cutoff
+        candidates, scores = candidates[keep], scores[keep]
+        if len(candidates) > limit:
+            top = np.argpartition(-scores, limit - 1)[:limit]
+            candidates, scores = candidates[top], scores[top]
+        order = np.argsort(-scores, kind='stable')
+        return [(self._keys[slot], float(score)) for slot, score in zip(candidates[order], scores[order])]
+
+
+if __name__ == '__main__':
+    # Benchmark against difflib on a synthetic guild: python fuzzy.py [names] [queries]
+    import difflib
+    import random
+    import string
+    import sys
+    import time
+
+    def main(count: int, queries: int):
+        random.seed(0)
+        syllables = ["ja", "co", "b", "crypt", "moon", "doge", "btc", "eth", "sa", "to", "shi", "lo", "mi", "ra", "ke", "x", "vs", "zz"]
+        names = ["".join(random.choices(syllables, k=random.randint(2, 5))) + random.choice(["", "", str(random.randint(0, 999))])
+                 for _ in range(count)]
+
+        start = time.perf_counter()
+        index = TrigramIndex()
+        for i, name in enumerate(names):
+            index.add(i, name)
+        print(f"Indexed {count} names in {time.perf_counter() - start:.2f}s ({len(index.postings)} trigrams)")
+
+        def typo(name):
+            i = random.randrange(len(name))
+            return name[:i] + random.choice(string.ascii_lowercase) + name[i + 1:]
+        samples = [typo(random.choice(names)) for _ in range(queries)]
+
+        start = time.perf_counter()
+        indexed = [index.search(q, limit=3, cutoff=0.5) for q in samples]
+        index_ms = (time.perf_counter() - start) / queries * 1000
+
+        difflib_samples = samples[:max(1, queries // 10)]  # difflib is far slower, time a subset
+        start = time.perf_counter()
+        expected = [difflib.get_close_matches(q, names, n=3, cutoff=0.8) for q in difflib_samples]
+        difflib_ms = (time.perf_counter() - start) / len(difflib_samples) * 1000
+
+        agreed = sum(bool(set(e) & {names[key] for key, _ in found}) for e, found in zip(expected, indexed) if e)
+        print(f"difflib.get_close_matches: {difflib_ms:.1f}ms / query")
+        print(f"TrigramIndex.search:       {index_ms:.2f}ms / query ({difflib_ms / index_ms:.0f}x faster)")
+        print(f"Top-3 overlap with difflib: {agreed}/{sum(1 for e in expected if e)} queries")
+
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000, int(sys.argv[2]) if len(sys.argv) > 2 else 200)
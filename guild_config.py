@@ -0,0 +1,89 @@
+from typing import FrozenSet, Optional
+
+import discord
+
+ROLE_KEYS = ('verified_role', 'temporary_role', 'min_staff_role')
+CHANNEL_KEYS = ('file_storage', 'log_channel', 'captcha_channel', 'spam_reports', 'duplicate_reports', 'bots_channel', 'verify_log_channel')
+SETTING_KEYS = ('maintenance_mode', 'captcha_status', 'duplicate_status', 'duplicate_threshold', 'min_account_age_seconds', 'bot_channel_only', 'verify_msg_id')
+
+
+class _Reference:
+    """Descriptor resolving a stored role/channel ID to its discord object on access.
+    The resolved object is cached on the config, and looked up again whenever the cache is empty
+    (never resolved, or invalidated because the channel/role was deleted)."""
+
+    __slots__ = ('id_attr', 'cache_attr', 'getter')
+
+    def __init__(self, name: str, getter: str):
+        self.id_attr = name + '_id'
+        self.cache_attr = '_' + name
+        self.getter = getter
+
+    def __get__(self, config, owner):
+        if config is None:
+            return self
+        obj = getattr(config, self.cache_attr)
+        if obj is None:
+            obj_id = getattr(config, self.id_attr)
+            if obj_id is not None:
+                obj = getattr(config.guild, self.getter)(obj_id)
+                setattr(config, self.cache_attr, obj)
+        return obj
+
+    def __set__(self, config, obj):
+        setattr(config, self.id_attr, obj.id if obj else None)
+        setattr(config, self.cache_attr, obj)
+
+
+class GuildConfig:
+    """Per-guild settings & resolved role/channel references built from data/variables.json"""
+
+    __slots__ = ('guild',) + SETTING_KEYS + tuple(k + '_id' for k in ROLE_KEYS + CHANNEL_KEYS) + tuple('_' + k for k in ROLE_KEYS + CHANNEL_KEYS)
+
+    verified_role: Optional[discord.Role] = _Reference('verified_role', 'get_role')
+    temporary_role: Optional[discord.Role] = _Reference('temporary_role', 'get_role')
+    min_staff_role: Optional[discord.Role] = _Reference('min_staff_role', 'get_role')
+
+    file_storage: Optional[discord.TextChannel] = _Reference('file_storage', 'get_channel')
+    log_channel: Optional[discord.TextChannel] = _Reference('log_channel', 'get_channel')
+    captcha_channel: Optional[discord.TextChannel] = _Reference('captcha_channel', 'get_channel')
+    spam_reports: Optional[discord.TextChannel] = _Reference('spam_reports', 'get_channel')
+    duplicate_reports: Optional[discord.TextChannel] = _Reference('duplicate_reports', 'get_channel')
+    bots_channel: Optional[discord.TextChannel] = _Reference('bots_channel', 'get_channel')
+    verify_log_channel: Optional[discord.TextChannel] = _Reference('verify_log_channel', 'get_channel')
+
+    def __init__(self, guild: discord.Guild, record: dict):
+        self.guild: discord.Guild = guild
+        self.maintenance_mode: bool = record.get('maintenance_mode', False)
+        self.captcha_status: bool = record.get('captcha_status', False)
+        self.duplicate_status: bool = record.get('duplicate_status', False)
+        self.duplicate_threshold: int = record.get('duplicate_threshold', 5)  # Names shared by more members than this are reported
+        self.min_account_age_seconds: int = record.get('min_account_age_seconds', -1)
+        self.bot_channel_only: FrozenSet[str] = frozenset(filter(None, record.get('bot_channel_only', [])))
+        self.verify_msg_id: int = record.get('verify_msg_id', -1)
+
+        roles = record.get('roles', {})
+        for key in ROLE_KEYS:
+            setattr(self, key + '_id', _to_id(roles.get(key)))
+            setattr(self, '_' + key, None)
+
+        channels = record.get('channels', {})
+        for key in CHANNEL_KEYS:
+            setattr(self, key + '_id', _to_id(channels.get(key)))
+            setattr(self, '_' + key, None)
+
+    def invalidate(self, obj_id: int) -> None:
+        """Drop any cached reference to a deleted role or channel so it is re-resolved on next access"""
+        for key in ROLE_KEYS + CHANNEL_KEYS:
+            if getattr(self, key + '_id') == obj_id:
+                setattr(self, '_' + key, None)
+
+    def __repr__(self):
+        return f'<GuildConfig guild={self.guild.id}>'
+
+
+def _to_id(value) -> Optional[int]:
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
@@ -0,0 +1,255 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, NamedTuple, Optional
+from urllib.parse import urlsplit, urlunsplit
+
+import aiohttp
+from multidict import CIMultiDict, CIMultiDictProxy
+
+from ratelimit import TokenBucketRateLimiter
+
+logger = logging.getLogger('discord')
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class HostConfig(NamedTuple):
+    rate: float = 10  # Requests per second (starting rate of the AIMD limiter)
+    burst: int = 10
+    max_rate: Optional[float] = None
+    connections: int = 20  # Size of the keep-alive connection pool
+    timeout: float = 30
+    retries: int = 2
+    backoff: float = 1.0  # Base delay (s) of the jittered exponential backoff
+    max_backoff: float = 60.0
+
+
+HOSTS = {
+    'api.imagekit.io': HostConfig(rate=1000, burst=200, max_rate=10000, connections=200, retries=2),
+    'cdn.discordapp.com': HostConfig(rate=500, burst=100, max_rate=2000, connections=100),
+    'api.ocr.space': HostConfig(rate=5, burst=5, connections=10, timeout=200, retries=2, backoff=5.0),
+    'pro-api.coinmarketcap.com': HostConfig(rate=5, burst=5, connections=5, timeout=10, retries=1),
+    'api.alternative.me': HostConfig(rate=5, burst=5, connections=5, timeout=10, retries=1),
+}
+
+
+class HttpResponse(NamedTuple):
+    status: int
+    headers: CIMultiDictProxy  # Case-insensitive, servers differ in how they case X-RateLimit-* headers
+    data: object  # Parsed JSON, text or bytes depending on `parse`; None when a 200 body wasn't valid JSON
+
+    def get(self, *path, default=None):
+        """Walk the parsed JSON body by keys & indexes, `default` if the body doesn't have that shape"""
+        value = self.data
+        for key in path:
+            try:
+                value = value[key]
+            except (KeyError, IndexError, TypeError):
+                return default
+        return value
+
+
+class EndpointStats:
+    __slots__ = ('requests', 'errors', 'retries', 'total_latency', 'max_latency', 'recent')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.recent = deque(maxlen=500)
+
+    def record(self, latency: float, error: bool):
+        self.requests += 1
+        self.errors += error
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        self.recent.append(latency)
+
+    @property
+    def average_latency(self) -> float:
+        return self.total_latency / self.requests if self.requests else 0.0
+
+    @property
+    def p95_latency(self) -> float:
+        if not self.recent:
+            return 0.0
+        latencies = sorted(self.recent)
+        return latencies[max(0, int(len(latencies) * 0.95) - 1)]
+
+    def __str__(self):
+        return f"{self.requests} reqs, {self.errors} errors, {self.retries} retries, avg {self.average_latency * 1000:.0f}ms (p95 {self.p95_latency * 1000:.0f}ms)"
+
+
+class HttpClient:
+    """
+    Bot-wide client for outbound API calls
+    Each host gets its own keep-alive connection pool & AIMD rate limiter (see HOSTS), failed requests are retried with
+    jittered exponential backoff, and latency/error counts are kept per endpoint.
+    HTTP_HOST_OVERRIDES (`host=http://127.0.0.1:8080,...`, or `*=...` for every host) points hosts at a local stub server.
+    """
+
+    def __init__(self, hosts: Optional[Dict[str, HostConfig]] = None, overrides: Optional[str] = None):
+        self.hosts = HOSTS if hosts is None else hosts
+        self.overrides: Dict[str, str] = {}
+        for entry in filter(None, (overrides if overrides is not None else os.getenv('HTTP_HOST_OVERRIDES', '')).split(',')):
+            host, _, target = entry.partition('=')
+            self.overrides[host.strip()] = target.strip().rstrip('/')
+        self.endpoints: Dict[str, EndpointStats] = {}
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        self._limiters: Dict[str, TokenBucketRateLimiter] = {}
+
+    def config(self, host: str) -> HostConfig:
+        return self.hosts.get(host, HostConfig())
+
+    def limiter(self, host: str) -> TokenBucketRateLimiter:
+        """The host's rate limiter, also usable for requests made outside this client (e.g. discord CDN reads)"""
+        if host not in self._limiters:
+            cfg = self.config(host)
+            self._limiters[host] = TokenBucketRateLimiter(rate=cfg.rate, burst=cfg.burst, concurrency_limit=cfg.connections, max_rate=cfg.max_rate)
+        return self._limiters[host]
+
+    def _session(self, host: str) -> aiohttp.ClientSession:
+        session = self._sessions.get(host)
+        if session is None or session.closed:
+            cfg = self.config(host)
+            session = self._sessions[host] = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=cfg.connections, ttl_dns_cache=300),
+                                                                   timeout=aiohttp.ClientTimeout(total=cfg.timeout))
+        return session
+
+    def _rewrite(self, url: str) -> str:
+        parts = urlsplit(url)
+        target = self.overrides.get(parts.hostname) or self.overrides.get('*')
+        if not target:
+            return url
+        target = urlsplit(target)
+        return urlunsplit((target.scheme, target.netloc, parts.path, parts.query, parts.fragment))
+
+    async def request(self, method: str, url: str, *, endpoint: Optional[str] = None, parse: Optional[str] = 'json', retries: Optional[int] = None,
+                      retry_if: Optional[Callable[[HttpResponse], bool]] = None, on_retry: Optional[Callable[[int, Optional[int]], Awaitable]] = None,
+                      **kwargs) -> HttpResponse:
+        """
+        Send a request through the host's pool & limiter, retrying timeouts, connection errors, 429s & 5xx responses
+        `retry_if` can flag otherwise successful responses for a retry (e.g. an API-level error in the body), `on_retry(attempt, status)`
+        is awaited before each retry. A 200 whose body isn't valid JSON is retried too & comes back with `data` None, so `retry_if`
+        & callers should read the body through `HttpResponse.get`. The last response is returned even if it wasn't successful; a
+        connection error on the last attempt is raised.
+        """
+        host = urlsplit(url).hostname
+        cfg = self.config(host)
+        limiter = self.limiter(host)
+        session = self._session(host)
+        stats = self.endpoints.setdefault(endpoint or f"{method} {host}{urlsplit(url).path}", EndpointStats())
+        retries = cfg.retries if retries is None else retries
+        url = self._rewrite(url)
+
+        for attempt in range(retries + 1):
+            start = time.perf_counter()
+            status = None
+            try:
+                async with limiter.throttle():
+                    async with session.request(method, url, **kwargs) as r:
+                        status = r.status
+                        malformed = False
+                        if parse == 'json' and r.status == 200:
+                            try:
+                                data = await r.json(content_type=None)
+                            except ValueError:
+                                data, malformed = None, True
+                        elif parse == 'bytes':
+                            data = await r.read()
+                        else:
+                            data = await r.text()
+                        response = HttpResponse(r.status, CIMultiDictProxy(CIMultiDict(r.headers)), data)
+            except (asyncio.TimeoutError, aiohttp.ClientError):
+                stats.record(time.perf_counter() - start, True)
+                if attempt == retries:
+                    raise
+                response = None
+            else:
+                failed = status in RETRY_STATUSES or (status == 200 and (malformed or (retry_if is not None and retry_if(response))))
+                stats.record(time.perf_counter() - start, status >= 400 or failed)
+                try:
+                    if status == 429:
+                        limiter.hit_429(response.headers)
+                    elif status < 400:
+                        limiter.success(response.headers)
+                except Exception:
+                    # Rate limit feedback is best effort, a header the limiter chokes on mustn't lose the response
+                    logger.exception(f"Failed to apply rate limit headers from {host}: {dict(response.headers)}")
+                if not failed or attempt == retries:
+                    return response
+
+            stats.retries += 1
+            if on_retry:
+                await on_retry(attempt + 1, status)
+            # Full jitter: spreads out retries from concurrent callers instead of having them stampede together
+            await asyncio.sleep(random.uniform(0, min(cfg.max_backoff, cfg.backoff * 2 ** attempt)))
+
+    async def get(self, url: str, **kwargs) -> HttpResponse:
+        return await self.request('GET', url, **kwargs)
+
+    def stats(self, limit: int = 5) -> str:
+        busiest = sorted(self.endpoints.items(), key=lambda item: item[1].requests, reverse=True)[:limit]
+        return "\n".join(f"`{name}`: {stats}" for name, stats in busiest) or "No requests made yet."
+
+    async def close(self) -> None:
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+
+
+if __name__ == '__main__':
+    # Benchmark against a local stub server: python http_client.py [requests] [concurrency]
+    import sys
+    from aiohttp import web
+
+    async def stub(request: web.Request):
+        await asyncio.sleep(random.uniform(0.005, 0.015))
+        if random.random() < 0.02:
+            return web.json_response({'error': 'unavailable'}, status=503)
+        return web.json_response({'pHash': f"{random.getrandbits(64):016x}"})
+
+    async def main(total: int, concurrency: int):
+        app = web.Application()
+        app.router.add_get('/{tail:.*}', stub)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        url = "https://api.imagekit.io/v1/metadata"
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def per_call_session():
+            async with semaphore:
+                async with aiohttp.ClientSession() as cs:
+                    async with cs.get(f"http://127.0.0.1:{port}/v1/metadata") as r:
+                        await r.json()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(per_call_session() for _ in range(total)))
+        elapsed = time.perf_counter() - start
+        print(f"Session per call: {total / elapsed:.0f} req/s")
+
+        client = HttpClient(hosts={'api.imagekit.io': HostConfig(rate=100000, burst=1000, connections=concurrency, backoff=0.01)},
+                            overrides=f"api.imagekit.io=http://127.0.0.1:{port}")
+
+        async def pooled():
+            async with semaphore:
+                await client.get(url, endpoint='imagekit.metadata')
+
+        start = time.perf_counter()
+        await asyncio.gather(*(pooled() for _ in range(total)))
+        elapsed = time.perf_counter() - start
+        print(f"Shared client:    {total / elapsed:.0f} req/s")
+        print(client.stats())
+        await client.close()
+        await runner.cleanup()
+
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000, int(sys.argv[2]) if len(sys.argv) > 2 else 50))
@@ -0,0 +1,287 @@
+import asyncio
+import datetime
+import logging
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+import discord
+
+import phash
+import sql
+import utils
+from ratelimit import TokenBucketRateLimiter
+
+logger = logging.getLogger('discord')
+
+IMAGEKIT_URL = "https://api.imagekit.io/v1/metadata?url=https://ik.imagekit.io/ugssigsf4u/avatars"
+
+
+class PhotoHashSync:
+    """
+    Background job hashing the profile photos of a guild's members into crypto.logging
+    Members are processed in uid order, one chunk at a time; once a chunk is written its last uid is checkpointed
+    in the `jobs` state document so a job interrupted by a restart resumes where it left off.
+    With `changed_only`, members whose avatar key matches the one stored alongside their hash are skipped.
+    """
+
+    kind = 'photo_sync'
+
+    def __init__(self, client, guild: discord.Guild, channel: discord.TextChannel, changed_only: bool = True, checkpoint: Optional[dict] = None,
+                 chunk_size: int = 500, edit_interval: float = 15.0):
+        self.client = client
+        self.guild = guild
+        self.channel = channel
+        self.changed_only = changed_only
+        self.chunk_size = chunk_size
+        self.edit_interval = edit_interval
+
+        checkpoint = checkpoint or {}
+        self.cursor: int = checkpoint.get('cursor', 0)
+        self.processed: int = checkpoint.get('processed', 0)
+        self.failed: int = checkpoint.get('failed', 0)
+        self.started: float = checkpoint.get('started', time.time())
+        self.message_id: Optional[int] = checkpoint.get('message_id')
+        self.resumed = bool(checkpoint)
+
+        self.total: int = self.processed
+        self.status = 'queued'
+        self.finished: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        self.rate_limiter: Optional[TokenBucketRateLimiter] = None
+        self._msg: Optional[discord.Message] = None
+        self._last_edit = 0.0
+        self._run_start = time.monotonic()
+        self._run_start_processed = self.processed
+
+    def checkpoint(self) -> dict:
+        return {'type': self.kind, 'channel_id': self.channel.id, 'message_id': self.message_id, 'changed_only': self.changed_only,
+                'cursor': self.cursor, 'processed': self.processed, 'failed': self.failed, 'started': self.started}
+
+    def describe(self) -> str:
+        mode = "changed avatars" if self.changed_only else "all avatars"
+        line = f"**Photo hash sync** ({mode}) - __{self.status}__: **{self.processed}** / {self.total} members, {self.failed} failed. Started <t:{int(self.started)}:R>"
+        if self.finished:
+            line += f", finished <t:{int(self.finished)}:R>"
+        if self.rate_limiter:
+            line += f"\nRate limiter: {self.rate_limiter.stats()}"
+        return line
+
+    async def wait(self) -> bool:
+        """Wait for the job to finish without cancelling it if the waiter is cancelled, True if it succeeded"""
+        await asyncio.shield(self.task)
+        return self.status == 'done'
+
+    async def run(self, manager: 'JobManager'):
+        self.status = 'running'
+        if not self.guild.chunked:
+            await self.guild.chunk()
+
+        stored = await sql.get_avatar_keys(self.client.pool, self.guild.id) if self.changed_only else {}
+        members = sorted((m for m in self.guild.members if m.id > self.cursor and stored.get(m.id) != m.display_avatar.key), key=lambda m: m.id)
+        self.total = self.processed + len(members)
+        manager.save(self)
+        await self.update_progress(force=True)
+
+        failed: List[discord.Member] = []
+        # Requests share the bot's per-host rate limiters, so the job backs off together with any other ImageKit/CDN calls
+        self.rate_limiter = self.client.http_client.limiter('cdn.discordapp.com' if phash.BACKEND == 'local' else 'api.imagekit.io')
+        for i in range(0, len(members), self.chunk_size):
+            chunk = members[i:i + self.chunk_size]
+            chunk_failed = await self.hash_members(chunk)
+            failed.extend(chunk_failed)
+            self.processed += len(chunk)
+            self.failed += len(chunk_failed)
+            self.cursor = chunk[-1].id
+            manager.save(self)
+            await self.update_progress()
+
+        if failed:
+            print(f"Photo hash sync: retrying {len(failed)} failed members")
+            retry_failed = await self.hash_members(failed)
+            self.failed -= len(failed) - len(retry_failed)
+            failed = retry_failed
+
+        self.status = 'done'
+        self.finished = time.time()
+        await self.finish(failed)
+
+    async def hash_members(self, members: List[discord.Member]) -> List[discord.Member]:
+        """Hash & store a chunk of members, returning the ones that couldn't be retrieved"""
+        cache = self.client.avatar_hashes
+        rows, to_hash, failed = [], [], []
+        for m in members:
+            key = m.display_avatar.key
+            if m.display_avatar == m.default_avatar:
+                rows.append((self.guild.id, m.id, None, phash.DEFAULT_AVATARS[m.default_avatar.key], key))
+                continue
+            # Avatars hashed before (in any guild) don't need another request
+            photo_hash = cache.get(key)
+            if photo_hash is not None:
+                rows.append((self.guild.id, m.id, photo_hash, None, key))
+            else:
+                to_hash.append(m)
+
+        fetch = self.fetch_local if phash.BACKEND == 'local' else self.fetch_imagekit
+        for m, photo_hash in await asyncio.gather(*(fetch(m) for m in to_hash)):
+            if photo_hash is None:
+                failed.append(m)
+            else:
+                cache.put(m.display_avatar.key, photo_hash)
+                rows.append((self.guild.id, m.id, photo_hash, None, m.display_avatar.key))
+
+        if rows:
+            await sql.batch_update_photo_hashes(self.client.pool, rows)
+        return failed
+
+    async def fetch_imagekit(self, m: discord.Member) -> Tuple[discord.Member, Optional[int]]:
+        self.client.avatar_hashes.miss()
+        try:
+            # Failures are retried once at the end of the job rather than inline
+            r = await self.client.http_client.get(f"{IMAGEKIT_URL}/{m.id}/{m.display_avatar.key}.webp?size=64", endpoint='imagekit.metadata', retries=0,
+                                           headers={'Authorization': f'Basic {self.client.IMAGEKIT_TOKEN}'})
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            print(f"ERROR ({e.__class__.__name__}): {m.display_avatar.key}")
+            return m, None
+        if r.status != 200:
+            if r.status != 429:
+                print(f"ERROR ({r.status}): {m.display_avatar.key} | Message: {r.data}")
+            return m, None
+        return m, phash.to_int(r.get('pHash'))
+
+    async def fetch_local(self, m: discord.Member) -> Tuple[discord.Member, Optional[int]]:
+        # Only the CDN download is throttled, hashing happens in the process pool
+        async with self.rate_limiter.throttle():
+            try:
+                image = await m.display_avatar.with_size(64).with_format(phash.AVATAR_FORMAT).read()
+            except discord.HTTPException as e:
+                print(f"ERROR ({e.status}): {m.display_avatar.url}")
+                return m, None
+        try:
+            return m, await self.client.avatar_hashes.hash_image(image)
+        except phash.HASH_ERRORS as e:
+            print(f"ERROR (hashing, {type(e).__name__}: {e}): {m.display_avatar.url}")
+            return m, None
+
+    async def get_message(self) -> discord.Message:
+        if self._msg is None and self.message_id:
+            try:
+                self._msg = await self.channel.fetch_message(self.message_id)
+            except discord.HTTPException:
+                pass
+        if self._msg is None:
+            self._msg = await self.channel.send(embed=discord.Embed(title="Checking Image Similarities...", color=discord.Color.orange()))
+            self.message_id = self._msg.id
+        return self._msg
+
+    async def update_progress(self, force: bool = False):
+        """Edit the progress embed, at most once every `edit_interval` seconds unless forced"""
+        now = time.monotonic()
+        if not force and now - self._last_edit < self.edit_interval:
+            return
+        self._last_edit = now
+
+        desc = "Profile photos are being hashed in the background.\nCheck on this job at any time with `jobs`.\n"
+        if self.resumed:
+            desc += "Resumed from the last checkpoint after a restart.\n"
+        embed = discord.Embed(title="Checking Image Similarities...",
+                              description=desc + utils.textProgressBar(self.processed, max(self.total, 1), prefix="Progress: ", suffix="", decimals=2, length=13, fullisred=False),
+                              color=discord.Color.orange())
+        embed.add_field(name="Members hashed:", value=f"**{self.processed}** / {self.total} members checked\n{self.failed} members failed to be retrieved.")
+        embed.set_thumbnail(url="https://i.imgur.com/nLRgnZf.gif")
+        elapsed_s = int(now - self._run_start)
+        done = self.processed - self._run_start_processed
+        minutes, seconds = divmod(elapsed_s, 60)
+        if done:
+            l_min, l_secs = divmod(int(elapsed_s / done * (self.total - self.processed)), 60)
+            embed.set_footer(text=f'Elapsed: {minutes}m{seconds}s | Est. Left: {l_min}m{l_secs}s')
+        else:
+            embed.set_footer(text=f'Elapsed: {minutes}m{seconds}s | Est. Left: Calculating...')
+        embed.timestamp = datetime.datetime.utcnow()
+        try:
+            msg = await self.get_message()
+            await msg.edit(embed=embed)
+        except discord.HTTPException:
+            logger.exception("Failed to update photo hash sync progress")
+
+    async def finish(self, failed: List[discord.Member]):
+        embed = discord.Embed(title="Success!", description=f"Hashed **{self.processed - self.failed}** profile photos!", color=discord.Color.blue())
+        embed.set_footer(text="©Cryptographer")
+        embed.timestamp = datetime.datetime.utcnow()
+        try:
+            msg = await self.get_message()
+            await msg.edit(embed=embed)
+            if failed:
+                await self.channel.send(f"Failed to get ({min(len(failed), 50)}/{len(failed)}):\n" + "".join([m.mention for m in failed[:50]]))
+        except discord.HTTPException:
+            logger.exception("Failed to report photo hash sync result")
+
+
+class JobManager:
+    """Runs background jobs (at most one per guild) & keeps their checkpoints in the `jobs` state document"""
+
+    def __init__(self, client, path: str = 'data/jobs.json', history: int = 10):
+        self.client = client
+        self.running: Dict[int, PhotoHashSync] = {}
+        self.history = deque(maxlen=history)
+        self.checkpoints: dict = client.state.load('jobs', path, default={})
+
+    def photo_sync(self, guild: discord.Guild, channel: discord.TextChannel, changed_only: bool = True) -> PhotoHashSync:
+        """Return the guild's running photo hash sync, starting a new one if there isn't one"""
+        job = self.running.get(guild.id)
+        if job is None:
+            job = self._start(PhotoHashSync(self.client, guild, channel, changed_only))
+        return job
+
+    def for_guild(self, guild_id: int) -> List[PhotoHashSync]:
+        jobs = [job for job in self.history if job.guild.id == guild_id]
+        if guild_id in self.running:
+            jobs.append(self.running[guild_id])
+        return jobs
+
+    def save(self, job: PhotoHashSync) -> None:
+        self.checkpoints[str(job.guild.id)] = job.checkpoint()
+        self.client.state.changed('jobs')
+
+    def resume(self) -> None:
+        """Restart jobs left unfinished by the last shutdown"""
+        for gid, checkpoint in list(self.checkpoints.items()):
+            guild = self.client.get_guild(int(gid))
+            channel = guild.get_channel(checkpoint['channel_id']) if guild else None
+            if channel is None or checkpoint.get('type') != PhotoHashSync.kind:
+                del self.checkpoints[gid]
+                self.client.state.changed('jobs')
+                continue
+            if guild.id not in self.running:
+                print(f"Resuming photo hash sync for {guild.name} ({checkpoint['processed']} members done)")
+                self._start(PhotoHashSync(self.client, guild, channel, checkpoint['changed_only'], checkpoint=checkpoint))
+
+    def _start(self, job: PhotoHashSync) -> PhotoHashSync:
+        self.running[job.guild.id] = job
+        job.task = asyncio.get_event_loop().create_task(self._run(job))
+        return job
+
+    async def _run(self, job: PhotoHashSync):
+        try:
+            await job.run(self)
+        except asyncio.CancelledError:
+            # Shutting down, the checkpoint is kept so the job resumes on the next start
+            job.status = 'interrupted'
+            raise
+        except Exception:
+            logger.exception(f"Photo hash sync failed for guild {job.guild.id}")
+            job.status = 'failed'
+            job.finished = time.time()
+        finally:
+            self.running.pop(job.guild.id, None)
+            self.history.append(job)
+            if job.status != 'interrupted':
+                self.checkpoints.pop(str(job.guild.id), None)
+                self.client.state.changed('jobs')
+
+    async def close(self) -> None:
+        tasks = [job.task for job in self.running.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
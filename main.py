@@ -1,5 +1,5 @@
 import json
-from typing import Dict, List, Set, Union
+from typing import Dict, Set
 
 import aiomysql
 import discord
@@ -7,9 +7,21 @@ import logging
 import urllib3
 import os
 import datetime
-from discord.ext import commands, tasks
+from discord.ext import commands
 from dotenv import load_dotenv
+import confusables
+import phash
 import sql
+from avatar_cache import AvatarHashCache
+from banned_patterns import BannedPatterns
+from counters import MessageCounter
+from guild_config import GuildConfig
+from http_client import HttpClient
+from jobs import JobManager
+from names import MemberNameIndex, NameNormalizer
+from state import StateStore
+from timers import TimerScheduler
+from wordlist import WordlistClassifier
 from cogs.log import verify_log, VerifyAction
 
 load_dotenv()
@@ -34,10 +46,7 @@ def get_prefix(client, message):
     if message.guild is None:
         return "!"
 
-    with open('data/prefixes.json', 'r') as f:
-        prefixes = json.load(f)
-
-    return prefixes[str(message.guild.id)]
+    return client.prefixes.get(message.guild.id, "!")
 
 class CryptoBot(commands.Bot):
 
@@ -56,32 +65,52 @@ class CryptoBot(commands.Bot):
 
         self.start_time: datetime = None
         self.pool: aiomysql.pool = None
-        self.variables: Dict[int: Dict[str: Union[bool, int, List[str], Dict[str, discord.Role], Dict[str, discord.TextChannel]]]] = {}
+        self.variables: Dict[int, GuildConfig] = {}
         self.spoken = {}
         self.soft_muted = set([])
-        self.sent_messages = {}
-        self.banned_photos = set([])
+        self.msg_counter = MessageCounter()
+        self.banned_photos: Dict[int, phash.MultiIndexHash] = {}
         self.persistent_views_added = False
+        self.prefixes: Dict[int, str] = {}
+        self.state = StateStore()
         self.pending_verification: Set[int] = set([])
-        self.adjective_list: Set[str] = set(line.strip() for line in open('data/english-adjectives.txt'))
-        self.noun_list: Set[str] = set(line.strip() for line in open('data/english-nouns.txt'))
+        self.verification_timers = TimerScheduler()  # Warning & kick deadlines of members awaiting verification, keyed by (guild id, member id)
+        with open('data/english-adjectives.txt') as adjectives, open('data/english-nouns.txt') as nouns:
+            self.wordlist = WordlistClassifier(adjectives, nouns)
+
+        # Prefixes are resolved on every message, so keep them in memory & only touch the file on change
+        self.state.load('prefixes', 'data/prefixes.json')
+        self.state.load('variables', 'data/variables.json')
+        self.state.load('reminders', 'data/reminders.json')
+        self.prefixes = {int(gid): prefix for gid, prefix in self.state['prefixes'].items()}
+        self.http_client = HttpClient()
+        self.avatar_hashes = AvatarHashCache()
+        self.jobs = JobManager(self)
+        self.normalized_names = NameNormalizer()
+        self.member_names = MemberNameIndex(self.normalized_names)
 
         with open('data/banned_names.json') as f:
             self.banned_names: dict = json.load(f)
+        confusables.load('data/confusables.txt')
+        # Disguised names are checked by skeleton, catching homoglyph, zero-width & fullwidth variants of a banned name in one set lookup
+        self.banned_skeletons: Dict[int, confusables.BannedNames] = confusables.skeleton_sets(self.banned_names)
+        self.banned_patterns = BannedPatterns('data/banned_patterns.json')
+        self.banned_patterns.load()
 
         self.warning_embed = discord.Embed(title="⚠️ Warning!", color=discord.Color.orange())
         self.error_embed = discord.Embed(title="❌ ERROR!", color=discord.Color.red())
 
-        with open('data/variables.json', 'r') as file:
-            self.maintenance_mode = json.load(file).get("maintenance_mode")
+        self.maintenance_mode = self.state['variables'].get("maintenance_mode")
 
     async def on_ready(self):
         """Wait until bot has connected to discord"""
         print("Connected to discord")
         self.start_time = datetime.datetime.now()
-        self.pool = await aiomysql.create_pool(host=os.getenv("MYSQL_HOST"), port=3306, user='jacobvs', password=os.getenv("MYSQL_PASSWORD"),
-                                               db='mysql', loop=bot.loop, connect_timeout=60)
+        self.pool = await sql.create_pool(host=os.getenv("MYSQL_HOST"), port=3306, user='jacobvs', password=os.getenv("MYSQL_PASSWORD"),
+                                               db='mysql', loop=bot.loop, connect_timeout=60, minsize=int(os.getenv("MYSQL_POOL_MIN", 1)),
+                                               maxsize=int(os.getenv("MYSQL_POOL_MAX", 10)))
         print("Connected to DB")
+        self.msg_counter.start(self.pool)  # As soon as the pool exists, message count reads before this raise a RuntimeError
 
         # Cache variables in memory & convert ID's to objects
         self.build_guild_db()
@@ -97,47 +126,46 @@ class CryptoBot(commands.Bot):
             self.persistent_views_added = True
 
         for g in bot.guilds:
-            self.spoken[g.id] = set()
+            self.spoken[g.id] = {uid async for uid, _ in sql.iter_msg_counts(bot.pool, g.id)}
+            async for photo_hash in sql.iter_banned_photo_hashes(bot.pool, g.id):
+                self.banned_photos.setdefault(g.id, phash.MultiIndexHash()).add(phash.to_int(photo_hash))
 
-        data = await sql.get_all_logs(bot.pool)
-        for record in data:
-            if record[sql.log_cols.msg_count] > 0:
-                self.spoken.get(record[sql.log_cols.gid], set()).add(record[sql.log_cols.uid])
-            if record[sql.log_cols.banned_photo]:
-                self.banned_photos.add((record[sql.log_cols.gid], record[sql.log_cols.photo_hash]))
+        self.jobs.resume()
 
         try:
             await self.cleanup()
         except BaseException:
             pass
 
-        update_msg_counts.start()
-
         # Set Presence to reflect bot status
         if self.maintenance_mode:
             await self.change_presence(status=discord.Status.idle, activity=discord.Game("IN MAINTENANCE MODE!"))
         else:
             await self.change_presence(activity=discord.Activity(type=discord.ActivityType.watching, name=f"!help"))
 
-        with open('data/reminders.json') as f:
-            reminders = json.load(f)
-            for gid in reminders:
-                name = reminders[gid]['name']
-                photo = reminders[gid]['photo']
-                for uid in reminders[gid]:
-                    if uid.isdigit():
-                        user = self.get_user(int(uid))
-                        if user and reminders[gid] and reminders[gid][uid]:
-                            for r in reminders[gid][uid]:
-                                from cogs import tools
-                                total_seconds = (datetime.datetime.utcfromtimestamp(int(r[0])) - datetime.datetime.utcnow()).total_seconds()
-                                self.loop.create_task(tools.reminder(user, gid, name, photo, total_seconds, r[1], r[2], r[3], r[4]))
+        reminders = self.state['reminders']
+        for gid in reminders:
+            name = reminders[gid]['name']
+            photo = reminders[gid]['photo']
+            for uid in reminders[gid]:
+                if uid.isdigit():
+                    user = self.get_user(int(uid))
+                    if user and reminders[gid] and reminders[gid][uid]:
+                        for r in reminders[gid][uid]:
+                            from cogs import tools
+                            total_seconds = (datetime.datetime.utcfromtimestamp(int(r[0])) - datetime.datetime.utcnow()).total_seconds()
+                            self.loop.create_task(tools.reminder(self.state, user, gid, name, photo, total_seconds, r[1], r[2], r[3], r[4]))
 
         print(f'{bot.user.name} is now online!')
 
+    def set_prefix(self, guild_id: int, prefix: str):
+        """Update the in-memory prefix for a guild, persisted by the state store's writer"""
+        self.prefixes[guild_id] = prefix
+        self.state['prefixes'][str(guild_id)] = prefix
+        self.state.changed('prefixes')
+
     def build_guild_db(self):
-        with open("data/variables.json", "r") as f:
-            data = json.load(f)
+        data = self.state['variables']
 
         for g in data:
             try:
@@ -147,33 +175,34 @@ class CryptoBot(commands.Bot):
             except ValueError:
                 continue
 
-            variables = {}
-            for record in data[g]:
-                if record == 'roles':
-                    for obj in data[g][record]:
-                        try:
-                            _role = guild.get_role(int(data[g][record][obj]))
-                        except ValueError:
-                            _role = None
-                        variables[obj] = _role
-                elif record == 'channels':
-                    for obj in data[g][record]:
-                        try:
-                            _channel = guild.get_channel(int(data[g][record][obj]))
-                        except ValueError:
-                            _channel = None
-                        variables[obj] = _channel
-                else:
-                    variables[record] = data[g][record]
-
-            self.variables[int(g)] = variables
+            self.variables[int(g)] = GuildConfig(guild, data[g])
+
+    async def on_guild_channel_delete(self, channel):
+        config = self.variables.get(channel.guild.id)
+        if config:
+            config.invalidate(channel.id)
+
+    async def on_guild_role_delete(self, role):
+        config = self.variables.get(role.guild.id)
+        if config:
+            config.invalidate(role.id)
+
+    async def close(self):
+        await self.verification_timers.close()
+        await self.jobs.close()
+        await self.msg_counter.close()
+        await self.avatar_hashes.close()
+        await self.state.close()
+        await self.http_client.close()
+        phash.shutdown()
+        await super().close()
 
     async def cleanup(self):
         for g in self.guilds:
             if g.id in self.variables:
                 data = self.variables[g.id]
                 # Cleanup captcha channel
-                captcha_channel = data['captcha_channel']
+                captcha_channel = data.captcha_channel
                 no_older_than = datetime.datetime.utcnow() - datetime.timedelta(days=14) + datetime.timedelta(seconds=1)
 
                 def check(msg):
@@ -181,22 +210,23 @@ class CryptoBot(commands.Bot):
 
                 await captcha_channel.purge(check=check, after=no_older_than, bulk=True)
 
-        from cogs.verification import Verification
-        verify_cog = Verification(self)
-        num = 0
+        verify_cog = self.get_cog('Verification')
+        unverified = []
 
         for m in self.get_all_members():
             if not m.bot:
-                temp_role: discord.Role = self.variables[m.guild.id]['temporary_role']
+                temp_role: discord.Role = self.variables[m.guild.id].temporary_role
                 if len(m.roles) == 1 and not m.pending:
                     await verify_log(self, m, VerifyAction.COMPLETE_SCREENING)
                     await m.add_roles(temp_role)
 
                 if temp_role in m.roles:
-                    num += 1
-                    self.loop.create_task(verify_cog.recheck_verification(m))
+                    unverified.append(m)
+                    verify_cog.start_verification_timer(m)
 
-        print(f"# Users without roles: {num}")
+        # Timers are all running by now, the captcha channel pings trickle out in the background
+        self.loop.create_task(verify_cog.ping_members(unverified))
+        print(f"# Users without roles: {len(unverified)}")
 
 
 bot = CryptoBot()
@@ -220,14 +250,20 @@ async def unload(ctx, extension):
     await ctx.send('{} has been unloaded.'.format(extension.capitalize()))
 
 
-@bot.command(usage="reload <cog/guilds/utils/all>")
+@bot.command(usage="reload <cog/guilds/patterns/utils/all>")
 @commands.is_owner()
 async def reload(ctx, extension):
     """Reload specified cog"""
     extension = extension.lower()
     if extension == 'guilds':
+        bot.state.reload('variables')
         bot.build_guild_db()
         extension = 'Guild Database'
+    elif extension == 'patterns':
+        bot.banned_patterns.load()
+        extension = f'{len(bot.banned_patterns)} banned name patterns'
+        if bot.banned_patterns.errors:
+            await ctx.send("Skipped invalid patterns:\n" + "\n".join(bot.banned_patterns.errors)[:1900])
     else:
         bot.reload_extension(f'cogs.{extension}')
     await ctx.send('{} has been reloaded.'.format(extension.capitalize()))
@@ -248,12 +284,8 @@ async def maintenance(ctx):
         #
         # print('Saved queue to file')
         await ctx.send("Maintenance mode has been turned on!")
-    with open("data/variables.json", 'r+') as f:
-        data = json.load(f)
-        data["maintenance_mode"] = bot.maintenance_mode
-        f.seek(0)
-        json.dump(data, f)
-        f.truncate()
+    bot.state['variables']["maintenance_mode"] = bot.maintenance_mode
+    bot.state.changed('variables')
 
 
 @bot.check
@@ -273,8 +305,8 @@ async def maintenance_mode(ctx):
 @bot.check
 async def bot_channel(ctx):
     db = ctx.bot.variables.get(ctx.guild.id)
-    if ctx.command.name in db['bot_channel_only']:
-        channel = db['bots_channel']
+    if ctx.command.name in db.bot_channel_only:
+        channel = db.bots_channel
         if channel and ctx.channel != channel:
             ctx.command.reset_cooldown(ctx)
             await ctx.send(f"This command can only be used in {channel.mention}. Please re-run the command there.", delete_after=30)
@@ -282,18 +314,5 @@ async def bot_channel(ctx):
     return True
 
 
-@tasks.loop(minutes=5)
-async def update_msg_counts():
-    print(f"Updating message counts! {len(bot.sent_messages)} new changes!")
-    data = [(v, k[0], k[1]) for k, v in bot.sent_messages.items()]
-    if len(data) > 200:
-        bot.sent_messages = {}
-        async with bot.pool.acquire() as conn:
-            async with conn.cursor() as cursor:
-                sql = "UPDATE crypto.logging SET msg_count = msg_count + %s WHERE gid = %s AND uid = %s"
-                await cursor.executemany(sql, data)
-                await conn.commit()
-
-
 print("Attempting to connect to Discord")
 bot.run(token)
@@ -0,0 +1,116 @@
+"""
+Schema migrations for the crypto database
+Usage: python migrate.py <migration>
+"""
+import asyncio
+import os
+import re
+import sys
+
+import aiomysql
+from dotenv import load_dotenv
+
+import phash
+
+load_dotenv()
+
+# Older rows stored default avatars as colour names, or as the default avatar URL
+AVATAR_NAMES = set(phash.DEFAULT_AVATARS.values()) | {"grey", "orange"}
+AVATAR_URL = re.compile(r'/embed/avatars/(\d)\.png')
+
+
+def split_photo_hash(value):
+    """Convert a legacy photo_hash value to (photo_hash, default_avatar)"""
+    if value is None:
+        return None, None
+    if value in AVATAR_NAMES:
+        return None, "gray" if value == "grey" else value
+    match = AVATAR_URL.search(value)
+    if match:
+        return None, phash.DEFAULT_AVATARS.get(match.group(1))
+    return phash.to_int(value), None
+
+
+async def photo_hash_bigint(pool: aiomysql.Pool):
+    """Store photo_hash as an indexed BIGINT UNSIGNED & move default avatar names into their own column"""
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute("ALTER TABLE crypto.logging ADD COLUMN photo_hash_int BIGINT UNSIGNED NULL AFTER photo_hash, "
+                                 "ADD COLUMN default_avatar VARCHAR(16) NULL AFTER banned_photo")
+            await conn.commit()
+
+    async with pool.acquire() as read_conn, pool.acquire() as write_conn:
+        async with read_conn.cursor(aiomysql.SSCursor) as reader, write_conn.cursor() as writer:
+            await reader.execute("SELECT gid, uid, photo_hash FROM crypto.logging WHERE photo_hash IS NOT NULL")
+            converted = 0
+            while True:
+                rows = await reader.fetchmany(1000)
+                if not rows:
+                    break
+                data = [(*split_photo_hash(photo_hash), gid, uid) for gid, uid, photo_hash in rows]
+                await writer.executemany("UPDATE crypto.logging SET photo_hash_int = %s, default_avatar = %s WHERE gid = %s AND uid = %s", data)
+                await write_conn.commit()
+                converted += len(data)
+                print(f"Converted {converted} photo hashes")
+
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute("ALTER TABLE crypto.logging DROP COLUMN photo_hash, "
+                                 "CHANGE COLUMN photo_hash_int photo_hash BIGINT UNSIGNED NULL AFTER report_count, "
+                                 "ADD INDEX gid_photo_hash (gid, photo_hash)")
+            await conn.commit()
+
+
+async def avatar_key(pool: aiomysql.Pool):
+    """Record which avatar asset each photo hash was computed from, so photo hash syncs can skip unchanged avatars
+    Existing hashes are left without a key & get refreshed by the next sync"""
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute("ALTER TABLE crypto.logging ADD COLUMN avatar_key VARCHAR(64) NULL AFTER default_avatar")
+            await conn.commit()
+
+
+async def user_totals(pool: aiomysql.Pool):
+    """Create crypto.user_totals (per-user message count over every guild) & backfill it from crypto.logging
+    Run while the bot is stopped, otherwise counts flushed during the backfill may be counted twice"""
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute("CREATE TABLE IF NOT EXISTS crypto.user_totals (uid BIGINT UNSIGNED NOT NULL PRIMARY KEY, msg_count INT UNSIGNED NOT NULL DEFAULT 0)")
+            await cursor.execute("INSERT INTO crypto.user_totals (uid, msg_count) SELECT uid, SUM(msg_count) FROM crypto.logging GROUP BY uid "
+                                 "ON DUPLICATE KEY UPDATE msg_count = VALUES(msg_count)")
+            await conn.commit()
+            print(f"Backfilled {cursor.rowcount} user totals")
+
+
+async def msg_count_batches(pool: aiomysql.Pool):
+    """Create crypto.msg_count_batches, holding the id of the last message count batch so a replayed journal isn't counted twice"""
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute("CREATE TABLE IF NOT EXISTS crypto.msg_count_batches (batch_id CHAR(32) NOT NULL PRIMARY KEY)")
+            await conn.commit()
+
+
+MIGRATIONS = {
+    'photo_hash_bigint': photo_hash_bigint,
+    'avatar_key': avatar_key,
+    'user_totals': user_totals,
+    'msg_count_batches': msg_count_batches,
+}
+
+
+async def main(name):
+    pool = await aiomysql.create_pool(host=os.getenv("MYSQL_HOST"), port=3306, user='jacobvs', password=os.getenv("MYSQL_PASSWORD"),
+                                      db='mysql', connect_timeout=60)
+    try:
+        await MIGRATIONS[name](pool)
+        print(f"Migration {name} complete.")
+    finally:
+        pool.close()
+        await pool.wait_closed()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or sys.argv[1] not in MIGRATIONS:
+        print(f"Usage: python migrate.py <{'/'.join(MIGRATIONS)}>")
+        sys.exit(1)
+    asyncio.run(main(sys.argv[1]))
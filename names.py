@@ -0,0 +1,197 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+import discord
+from unidecode import unidecode
+
+from fuzzy import TrigramIndex
+
+
+def alpha_name(name: str) -> str:
+    """Lowercased letters of a name only, e.g. 'J.a-c0b' -> 'jacb'"""
+    return "".join([c.lower() for c in name if c.isalpha()])
+
+
+class NameNormalizer:
+    """
+    LRU cache of the normalized forms of names, keyed by the raw name: (unidecoded ASCII skeleton, lowercase letters-only form)
+    Transliteration is the expensive part of every name scan, & most names are seen again by the next scan or lookup.
+    Entries for a member's old name are evicted by the Members cog when they rename.
+    """
+
+    def __init__(self, max_size: int = 250000):
+        self.max_size = max_size
+        self.entries: OrderedDict = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def normalize(self, name: str) -> Tuple[str, str]:
+        forms = self.entries.get(name)
+        if forms is not None:
+            self.hits += 1
+            self.entries.move_to_end(name)
+            return forms
+        self.misses += 1
+        forms = self.entries[name] = (unidecode(name), alpha_name(name))
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return forms
+
+    def ascii(self, name: str) -> str:
+        """ASCII transliteration of a name, e.g. 'Ｊａｃｏｂ' -> 'Jacob'"""
+        return self.normalize(name)[0]
+
+    def alpha(self, name: str) -> str:
+        return self.normalize(name)[1]
+
+    def forget(self, name: str) -> None:
+        self.entries.pop(name, None)
+
+
+class GuildNameIndex:
+    """
+    Lookup tables from a guild's member names to member IDs: lowercased display name, letters-only display name, name#discriminator
+    & unidecoded username (whose bucket sizes double as the guild's duplicate name counts)
+    Each member's current keys are remembered so an update only moves that member between buckets.
+    Fuzzy searches run on trigram indexes of display names & of unidecoded usernames, each built on its first search.
+    """
+
+    def __init__(self, guild: discord.Guild, normalizer: NameNormalizer):
+        self.guild = guild
+        self.normalizer = normalizer
+        self.complete = guild.chunked  # Built from a partial member list, rebuilt once the guild has been chunked
+        self.by_name: Dict[str, Set[int]] = {}
+        self.by_alpha: Dict[str, Set[int]] = {}
+        self.by_tag: Dict[str, Set[int]] = {}
+        self.by_ascii: Dict[str, Set[int]] = {}
+        self._keys: Dict[int, Tuple[str, ...]] = {}
+        self._display: Optional[TrigramIndex] = None
+        self._ascii: Optional[TrigramIndex] = None
+        for m in guild.members:
+            self.add(m)
+
+    @property
+    def _tables(self) -> Tuple[Dict[str, Set[int]], ...]:
+        return self.by_name, self.by_alpha, self.by_tag, self.by_ascii
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, member: discord.Member) -> None:
+        """Index a member, or re-index them after a name change"""
+        keys = (member.display_name.lower(), self.normalizer.alpha(member.display_name), f"{member.name}#{member.discriminator}",
+                self.normalizer.ascii(member.name))
+        old = self._keys.get(member.id)
+        if old == keys:
+            return
+        if old:
+            self._unlink(member.id, old)
+        self._keys[member.id] = keys
+        for table, key in zip(self._tables, keys):
+            if key:  # Names with no letters (or nothing unidecode can transliterate) aren't looked up by that form
+                table.setdefault(key, set()).add(member.id)
+        if self._display is not None:
+            self._display.add(member.id, member.display_name)
+        if self._ascii is not None and (not old or old[3] != keys[3]):
+            self._ascii.add(member.id, keys[3])
+
+    def remove(self, member_id: int) -> None:
+        keys = self._keys.pop(member_id, None)
+        if keys:
+            self._unlink(member_id, keys)
+            for index in (self._display, self._ascii):
+                if index is not None:
+                    index.remove(member_id)
+
+    def _unlink(self, member_id: int, keys: Tuple[str, ...]) -> None:
+        for table, key in zip(self._tables, keys):
+            bucket = table.get(key)
+            if bucket:
+                bucket.discard(member_id)
+                if not bucket:
+                    del table[key]
+
+    def _first(self, table: Dict[str, Set[int]], key: str) -> Optional[discord.Member]:
+        for uid in table.get(key, ()):
+            member = self.guild.get_member(uid)
+            if member is not None:
+                return member
+        return None
+
+    def find_tag(self, tag: str) -> Optional[discord.Member]:
+        """Exact (case sensitive) `name#discriminator` match"""
+        return self._first(self.by_tag, tag)
+
+    def find_name(self, name: str) -> Optional[discord.Member]:
+        """Case insensitive display name match"""
+        return self._first(self.by_name, name.lower())
+
+    def find_alpha(self, name: str) -> Optional[discord.Member]:
+        """Display name match ignoring case & anything but letters, None for a name without letters"""
+        key = alpha_name(name)
+        return self._first(self.by_alpha, key) if key else None
+
+    def with_ascii_name(self, name: str) -> List[discord.Member]:
+        """Members whose unidecoded username is exactly `name`"""
+        return [m for m in map(self.guild.get_member, self.by_ascii.get(name, ())) if m is not None]
+
+    def duplicates(self, threshold: int) -> List[Tuple[str, int]]:
+        """(unidecoded username, member count) for names shared by more than `threshold` members, most common first"""
+        return sorted(((name, len(uids)) for name, uids in self.by_ascii.items() if len(uids) > threshold), key=lambda item: item[1], reverse=True)
+
+    def _resolve(self, matches: List[Tuple[int, float]]) -> List[Tuple[discord.Member, float]]:
+        return [(member, score) for member, score in ((self.guild.get_member(uid), score) for uid, score in matches) if member is not None]
+
+    def fuzzy(self, name: str, limit: int = 3, cutoff: float = 0.5) -> List[Tuple[discord.Member, float]]:
+        """Members with display names similar to `name`, best first with their trigram similarity (0-1)"""
+        if self._display is None:
+            self._display = TrigramIndex()
+            for m in self.guild.members:
+                self._display.add(m.id, m.display_name)
+        return self._resolve(self._display.search(name, limit, cutoff))
+
+    def fuzzy_ascii(self, name: str, limit: int = 3, cutoff: float = 0.5) -> List[Tuple[discord.Member, float]]:
+        """Members whose unidecoded username is similar to `name`, catching lookalike unicode characters"""
+        if self._ascii is None:
+            self._ascii = TrigramIndex()
+            for m in self.guild.members:
+                self._ascii.add(m.id, self.normalizer.ascii(m.name))
+        return self._resolve(self._ascii.search(name, limit, cutoff))
+
+
+class MemberNameIndex:
+    """
+    Name indexes for every guild, built when the bot connects (or on first lookup) & kept current by the Members cog's
+    join/update/remove listeners. Events for guilds without an index are ignored.
+    """
+
+    def __init__(self, normalizer: NameNormalizer):
+        self.normalizer = normalizer
+        self.guilds: Dict[int, GuildNameIndex] = {}
+
+    def get(self, guild: discord.Guild) -> GuildNameIndex:
+        index = self.guilds.get(guild.id)
+        if index is None or (not index.complete and guild.chunked):
+            index = self.guilds[guild.id] = GuildNameIndex(guild, self.normalizer)
+        return index
+
+    def update(self, member: discord.Member) -> None:
+        index = self.guilds.get(member.guild.id)
+        if index is not None:
+            index.add(member)
+
+    def remove(self, member: discord.Member) -> None:
+        index = self.guilds.get(member.guild.id)
+        if index is not None:
+            index.remove(member.id)
+
+    def drop(self, guild_id: int) -> None:
+        self.guilds.pop(guild_id, None)
@@ -0,0 +1,249 @@
+import asyncio
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterable, Optional, Union
+
+import numpy as np
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+HASH_BITS = 64
+
+# "imagekit" asks the ImageKit metadata API for each avatar's pHash, "local" downloads the avatar & hashes it here
+BACKEND = os.getenv('PHOTO_HASH_BACKEND', 'imagekit').lower()
+# Format the local backend downloads 64px avatars in; ImageKit hashed the CDN's webp copy
+AVATAR_FORMAT = os.getenv('PHOTO_HASH_FORMAT', 'webp').lower()
+
+# Default avatar colours by `default_avatar.key`, stored in crypto.logging.default_avatar in place of a hash
+DEFAULT_AVATARS = {'0': "blurple", '1': "gray", '2': "green", '3': "yellow", '4': "red", '5': "pink"}
+
+if hasattr(np, 'bitwise_count'):
+    def _popcount(arr: np.ndarray) -> np.ndarray:
+        return np.bitwise_count(arr)
+else:
+    _POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def _popcount(arr: np.ndarray) -> np.ndarray:
+        # Count bits byte-by-byte through a lookup table, summed per 64-bit word
+        return _POPCOUNT_TABLE[arr.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+
+def to_int(photo_hash: Union[str, int, None]) -> Optional[int]:
+    """Convert a stored pHash (hex string or int) to an unsigned 64-bit int, None for default avatars & bad values"""
+    if photo_hash is None:
+        return None
+    if isinstance(photo_hash, int):
+        return photo_hash & 0xFFFFFFFFFFFFFFFF
+    try:
+        return int(photo_hash, 16)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_hex(photo_hash: int) -> str:
+    return f"{photo_hash:016x}"
+
+
+def hamming_distance(first: int, second: int) -> int:
+    """Scalar fast path: number of differing bits between two 64-bit hashes"""
+    return bin(first ^ second).count('1')
+
+
+def hamming_distances(target: int, hashes: np.ndarray) -> np.ndarray:
+    """Distances from `target` to every hash in a uint64 array, in a single vectorized pass"""
+    return _popcount(np.bitwise_xor(hashes, np.uint64(target)))
+
+
+def to_array(hashes: Iterable[Union[str, int, None]]) -> np.ndarray:
+    """Build a uint64 array from stored hashes, skipping default avatars & unparsable values"""
+    return np.fromiter((h for h in map(to_int, hashes) if h is not None), dtype=np.uint64)
+
+
+class MultiIndexHash:
+    """
+    Near-neighbour index for radius queries over 64-bit hashes
+    The hash is split into `max_distance` bands; by the pigeonhole principle two hashes differing in fewer than
+    `max_distance` bits share at least one band exactly, so only hashes in a matching band bucket are compared.
+    """
+
+    __slots__ = ('max_distance', '_bands', '_tables', '_members')
+
+    def __init__(self, max_distance: int = 5, hashes: Iterable[int] = ()):
+        if not 1 <= max_distance <= HASH_BITS:
+            raise ValueError('max_distance must be between 1 and 64')
+        self.max_distance = max_distance
+        self._bands = []
+        shift = 0
+        for i in range(max_distance):
+            width = HASH_BITS // max_distance + (1 if i < HASH_BITS % max_distance else 0)
+            self._bands.append((shift, (1 << width) - 1))
+            shift += width
+        self._tables = [{} for _ in self._bands]
+        self._members = set()
+        for h in hashes:
+            self.add(h)
+
+    def __len__(self):
+        return len(self._members)
+
+    def __contains__(self, photo_hash: int):
+        return photo_hash in self._members
+
+    def add(self, photo_hash: int) -> None:
+        if photo_hash in self._members:
+            return
+        self._members.add(photo_hash)
+        for (shift, mask), table in zip(self._bands, self._tables):
+            table.setdefault((photo_hash >> shift) & mask, []).append(photo_hash)
+
+    def query(self, photo_hash: int) -> set:
+        """All stored hashes strictly closer than `max_distance` bits"""
+        matches = set()
+        for (shift, mask), table in zip(self._bands, self._tables):
+            for candidate in table.get((photo_hash >> shift) & mask, ()):
+                if candidate not in matches and hamming_distance(candidate, photo_hash) < self.max_distance:
+                    matches.add(candidate)
+        return matches
+
+    def any_within(self, photo_hash: int) -> bool:
+        if photo_hash in self._members:
+            return True
+        for (shift, mask), table in zip(self._bands, self._tables):
+            for candidate in table.get((photo_hash >> shift) & mask, ()):
+                if hamming_distance(candidate, photo_hash) < self.max_distance:
+                    return True
+        return False
+
+
+# DCT-II bases for the 32x32 pHash input, only the 8 lowest frequencies are ever kept. "unnormalized" is the plain cosine
+# transform used by imagehash (scipy.fftpack.dct) & most pHash implementations. "orthonormal" also scales the DC row down by
+# sqrt(2), which changes which coefficients land above the median. phash_compat.py checks which one matches the stored
+# ImageKit hashes; PHOTO_HASH_DCT selects it.
+_DCT_SIZE = 32
+_COSINES = np.cos(np.pi * np.outer(np.arange(8), 2 * np.arange(_DCT_SIZE) + 1) / (2 * _DCT_SIZE))
+DCT_BASES = {'unnormalized': _COSINES, 'orthonormal': np.sqrt(2 / _DCT_SIZE) * _COSINES * np.where(np.arange(8) == 0, 1 / np.sqrt(2), 1)[:, None]}
+DCT = os.getenv('PHOTO_HASH_DCT', 'unnormalized').lower()
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+# What hash_image raises for an avatar that can't be hashed: undecodable or truncated images (PIL raises OSError subclasses),
+# oversized ones, & a worker process dying mid-hash
+HASH_ERRORS = (OSError, ValueError, BrokenProcessPool) + ((Image.DecompressionBombError,) if Image is not None else ())
+
+
+def compute_phash(data: bytes, dct: Optional[str] = None) -> int:
+    """
+    DCT perceptual hash of an encoded image: greyscale 32x32, 2D DCT, then one bit per coefficient of the
+    top-left 8x8 block (row-major, most significant first) set when it is above the block's median
+    Runs in a worker process, so this must stay a plain module-level function
+    """
+    basis = DCT_BASES[dct or DCT]
+    with Image.open(io.BytesIO(data)) as img:
+        pixels = np.asarray(img.convert('L').resize((_DCT_SIZE, _DCT_SIZE), Image.LANCZOS), dtype=np.float64)
+    low = basis @ pixels @ basis.T
+    bits = (low > np.median(low)).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if Image is None:
+        raise RuntimeError("The local photo hash backend requires Pillow (pip install Pillow)")
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=os.cpu_count())
+    return _executor
+
+
+async def hash_image(data: bytes) -> int:
+    """Compute the pHash of an encoded image in the process pool, keeping the decode & DCT off the event loop"""
+    executor = _get_executor()
+    try:
+        return await asyncio.get_event_loop().run_in_executor(executor, compute_phash, data)
+    except BrokenProcessPool:
+        if _executor is executor:
+            shutdown()  # A broken pool rejects everything submitted to it, start a fresh one on the next call
+        raise
+
+
+def shutdown() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+if __name__ == '__main__':
+    # Benchmarks: python phash.py <image folder> (local hashing) | python phash.py distances [hashes] (radius-5 lookups)
+    import random
+    import sys
+    import time
+
+    def bench_hashing(folder: str):
+        images = []
+        for name in sorted(os.listdir(folder)):
+            with open(os.path.join(folder, name), 'rb') as f:
+                images.append(f.read())
+        print(f"Hashing {len(images)} images")
+
+        start = time.perf_counter()
+        serial = [compute_phash(data) for data in images]
+        elapsed = time.perf_counter() - start
+        print(f"Serial:       {elapsed:.2f}s ({len(images) / elapsed:.0f} images/s)")
+
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+            pool.submit(int).result()  # Spawn the workers before timing
+            start = time.perf_counter()
+            pooled = list(pool.map(compute_phash, images, chunksize=32))
+            elapsed = time.perf_counter() - start
+        print(f"Process pool: {elapsed:.2f}s ({len(images) / elapsed:.0f} images/s, {os.cpu_count()} workers)")
+        assert pooled == serial
+
+    def bench_distances(count: int):
+        random.seed(0)
+        hashes = [random.getrandbits(HASH_BITS) for _ in range(count)]
+        target = hashes[count // 2] ^ 0b10011  # 3 bits away from a stored hash
+        hex_hashes, hex_target = [to_hex(h) for h in hashes], to_hex(target)
+
+        def string_distance(first: str, second: str) -> int:
+            # The comparison this module replaced: hex -> 64 character binary strings, compared in a lambda
+            a, b = bin(int(first, 16))[2:].zfill(64), bin(int(second, 16))[2:].zfill(64)
+            return len(list(filter(lambda x: ord(x[0]) ^ ord(x[1]), zip(a, b))))
+
+        sample = min(count, 100000)
+        start = time.perf_counter()
+        for h in hex_hashes[:sample]:
+            string_distance(h, hex_target)
+        string_rate = sample / (time.perf_counter() - start)
+        print(f"Hex string compare:      {string_rate / 1e6:.2f}M hashes/s ({count / string_rate:.2f}s per scan of {count}, timed over {sample})")
+
+        start = time.perf_counter()
+        scalar = [h for h in hashes if hamming_distance(h, target) < 5]
+        elapsed = time.perf_counter() - start
+        print(f"uint64 XOR/popcount:     {count / elapsed / 1e6:.2f}M hashes/s ({elapsed:.2f}s per scan, {count / elapsed / string_rate:.0f}x)")
+
+        array = to_array(hashes)
+        start = time.perf_counter()
+        vectorized = array[hamming_distances(target, array) < 5]
+        elapsed = time.perf_counter() - start
+        print(f"NumPy (sqlite fallback): {count / elapsed / 1e6:.0f}M hashes/s ({elapsed * 1000:.1f}ms per scan, {count / elapsed / string_rate:.0f}x)")
+        assert sorted(map(int, vectorized)) == sorted(scalar)
+
+        start = time.perf_counter()
+        index = MultiIndexHash(5, hashes)
+        print(f"MultiIndexHash:          built over {len(index)} hashes in {time.perf_counter() - start:.2f}s")
+        queries = [target] + random.sample(hashes, 999)
+        start = time.perf_counter()
+        results = [index.query(q) for q in queries]
+        elapsed = (time.perf_counter() - start) / len(queries)
+        print(f"                         {elapsed * 1e6:.0f}µs per radius-5 query ({count / elapsed / string_rate:.0f}x a string scan)")
+        assert results[0] == set(scalar)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'distances':
+        bench_distances(int(sys.argv[2]) if len(sys.argv) > 2 else 1000000)
+    else:
+        bench_hashing(sys.argv[1])
@@ -0,0 +1,68 @@
+"""
+Check the local photo hash backend against the pHashes ImageKit stored for a sample of avatars
+Usage: python phash_compat.py <guild id> [sample size]
+Samples rows hashed through ImageKit (run before switching PHOTO_HASH_BACKEND to local), downloads each avatar from the discord
+CDN as webp (the copy ImageKit fetched) & as png, & hashes both with every DCT formulation in phash.DCT_BASES. Prints how often
+each combination reproduces the stored hash exactly & within the match radius, so PHOTO_HASH_DCT / PHOTO_HASH_FORMAT can be set
+to the one that does.
+"""
+import asyncio
+import os
+import sys
+from collections import Counter
+
+from dotenv import load_dotenv
+
+import phash
+import sql
+from http_client import HttpClient
+
+load_dotenv()
+
+FORMATS = ('webp', 'png')
+MATCH_DISTANCE = 5  # Banned photo & photoblacklist matches are fewer than this many bits apart
+
+
+async def main(gid: int, samples: int):
+    pool = await sql.create_pool(host=os.getenv("MYSQL_HOST"), port=3306, user='jacobvs', password=os.getenv("MYSQL_PASSWORD"), db='mysql')
+    http = HttpClient()
+    try:
+        rows = await sql.execute(pool, 'sample_photo_hashes', "SELECT uid, avatar_key, photo_hash FROM crypto.logging WHERE gid = %s AND photo_hash IS NOT NULL "
+                                                              "AND avatar_key IS NOT NULL ORDER BY RAND() LIMIT %s", (gid, samples), fetch='all')
+        exact, close, distances = Counter(), Counter(), {}
+        compared = 0
+        for uid, key, stored in rows:
+            images = {}
+            for fmt in FORMATS:
+                r = await http.get(f"https://cdn.discordapp.com/avatars/{uid}/{key}.{fmt}?size=64", endpoint=f'cdn.avatar.{fmt}', parse='bytes')
+                if r.status == 200:
+                    images[fmt] = r.data
+            if len(images) < len(FORMATS):
+                continue  # Avatar changed or deleted since it was hashed
+            compared += 1
+            for fmt, data in images.items():
+                for dct in phash.DCT_BASES:
+                    distance = phash.hamming_distance(phash.compute_phash(data, dct), phash.to_int(stored))
+                    exact[fmt, dct] += distance == 0
+                    close[fmt, dct] += distance < MATCH_DISTANCE
+                    distances.setdefault((fmt, dct), []).append(distance)
+
+        if not compared:
+            print("No avatars could be compared.")
+            return
+        print(f"Compared {compared} of {len(rows)} sampled avatars")
+        for combination in sorted(distances, key=lambda c: (exact[c], close[c]), reverse=True):
+            fmt, dct = combination
+            print(f"PHOTO_HASH_FORMAT={fmt:<4} PHOTO_HASH_DCT={dct:<12} | exact {exact[combination] / compared:6.1%} | within {MATCH_DISTANCE - 1} bits "
+                  f"{close[combination] / compared:6.1%} | mean distance {sum(distances[combination]) / compared:.2f}")
+    finally:
+        await http.close()
+        pool.close()
+        await pool.wait_closed()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python phash_compat.py <guild id> [sample size]")
+        sys.exit(1)
+    asyncio.run(main(int(sys.argv[1]), int(sys.argv[2]) if len(sys.argv) > 2 else 200))
@@ -0,0 +1,182 @@
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Mapping, Optional
+
+MAX_PAUSE = 60.0  # Longest a 429 pauses the limiter for, whatever X-Ratelimit-Reset claims (some servers send an epoch timestamp)
+
+
+def _header_number(headers: Mapping[str, str], name: str, default: Optional[float] = None) -> Optional[float]:
+    """A numeric rate limit header, `default` when it is missing or isn't a finite number"""
+    try:
+        value = float(headers.get(name))
+    except (TypeError, ValueError):
+        return default
+    return value if math.isfinite(value) else default
+
+
+class TokenBucketRateLimiter:
+    """
+    Async token bucket: tokens refill at `rate` per second up to `burst`, with an optional cap on requests in flight
+    Waiters queue on a FIFO lock & the one at the head sleeps exactly until its token is due, so there is no polling task.
+    The rate adapts AIMD-style: each success raises it by `increase / rate` (about `increase` tokens/s per second at full
+    speed, 5% of the initial rate by default), the first 429 of a burst multiplies it by `decrease` & pauses until the window
+    resets. `X-Ratelimit-Limit` / `X-Ratelimit-Interval` headers, when present, cap the rate at what the server allows.
+    """
+
+    def __init__(self, rate: float, burst: Optional[int] = None, concurrency_limit: Optional[int] = None, min_rate: float = 1.0,
+                 max_rate: Optional[float] = None, increase: Optional[float] = None, decrease: float = 0.5, backoff_grace: float = 1.0):
+        if rate <= 0:
+            raise ValueError('rate must be a positive number')
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self.min_rate = min_rate
+        self.max_rate = max_rate or self.rate
+        self.increase = increase or max(1.0, self.rate * 0.05)
+        self.decrease = decrease
+        self.backoff_grace = backoff_grace
+
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._backoff_until = 0.0
+        self._lock = asyncio.Lock()
+        self._semaphore = asyncio.Semaphore(concurrency_limit) if concurrency_limit else None
+
+        self.acquired: int = 0
+        self.rate_limited: int = 0
+        self.total_wait: float = 0.0
+        self.max_wait: float = 0.0
+        self._recent_waits = deque(maxlen=1000)
+
+    @property
+    def average_wait(self) -> float:
+        return self.total_wait / self.acquired if self.acquired else 0.0
+
+    @property
+    def p95_wait(self) -> float:
+        if not self._recent_waits:
+            return 0.0
+        waits = sorted(self._recent_waits)
+        return waits[int(len(waits) * 0.95) - 1 if len(waits) >= 20 else -1]
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self) -> None:
+        """Wait for a token"""
+        start = time.monotonic()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    break
+                # Re-checked after waking, as a 429 may have paused or slowed the bucket meanwhile
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+        waited = time.monotonic() - start
+        self.acquired += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        self._recent_waits.append(waited)
+
+    @asynccontextmanager
+    async def throttle(self):
+        """Hold a concurrency slot & a token for the duration of a request"""
+        if self._semaphore is None:
+            await self.acquire()
+            yield
+            return
+        async with self._semaphore:
+            await self.acquire()
+            yield
+
+    def _apply_limits(self, headers: Mapping[str, str]) -> None:
+        limit, interval = _header_number(headers, 'X-Ratelimit-Limit'), _header_number(headers, 'X-Ratelimit-Interval')
+        if limit and interval and limit > 0 and interval > 0:
+            self.max_rate = max(self.min_rate, limit / (interval / 1000.0))
+            self.rate = min(self.rate, self.max_rate)
+
+    def success(self, headers: Optional[Mapping[str, str]] = None) -> None:
+        """Additive increase after a request that wasn't rate limited"""
+        if headers:
+            self._apply_limits(headers)
+        self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def hit_429(self, headers: Optional[Mapping[str, str]] = None) -> None:
+        """Multiplicative decrease & pause until the server's window resets"""
+        self.rate_limited += 1
+        now = time.monotonic()
+        if now < self._backoff_until:
+            return  # Requests already in flight when the window filled up, the backoff has been applied
+        if headers:
+            self._apply_limits(headers)
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self.tokens = 0.0
+        self.updated_at = now
+        reset = _header_number(headers, 'X-Ratelimit-Reset', 1000.0) / 1000.0 if headers else 1.0
+        reset = min(max(reset, 0.0), MAX_PAUSE)
+        self.paused_until = max(self.paused_until, now + reset)
+        self._backoff_until = self.paused_until + self.backoff_grace
+        print(f"Ratelimited! Pausing for {reset}s | New rate: {self.rate:.1f}/s (max {self.max_rate:.1f}/s)")
+
+    def stats(self) -> str:
+        return f"{self.rate:.0f}/s, avg wait {self.average_wait * 1000:.1f}ms (p95 {self.p95_wait * 1000:.1f}ms), {self.rate_limited} 429s"
+
+
+if __name__ == '__main__':
+    # Benchmark against a simulated fixed-window server: python ratelimit.py [server limit/s] [seconds]
+    import random
+    import sys
+
+    class SimulatedServer:
+        def __init__(self, limit: int, interval: float = 1.0, latency: float = 0.05):
+            self.limit, self.interval, self.latency = limit, interval, latency
+            self.window_start, self.count = time.monotonic(), 0
+            self.served = self.rejected = 0
+
+        async def get(self):
+            now = time.monotonic()
+            if now - self.window_start >= self.interval:
+                self.window_start, self.count = now, 0
+            self.count += 1
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+            headers = {'X-Ratelimit-Limit': str(self.limit), 'X-Ratelimit-Interval': str(int(self.interval * 1000)),
+                       'X-Ratelimit-Reset': str(int((self.window_start + self.interval - now) * 1000))}
+            if self.count > self.limit:
+                self.rejected += 1
+                return 429, headers
+            self.served += 1
+            return 200, headers
+
+    async def main(server_limit: int, duration: float):
+        server = SimulatedServer(server_limit)
+        # Start well above what the server allows to exercise the backoff
+        limiter = TokenBucketRateLimiter(rate=server_limit * 4, burst=server_limit // 10, concurrency_limit=500, max_rate=server_limit * 4)
+        deadline = time.monotonic() + duration
+
+        async def worker():
+            while time.monotonic() < deadline:
+                async with limiter.throttle():
+                    status, headers = await server.get()
+                if status == 429:
+                    limiter.hit_429(headers)
+                else:
+                    limiter.success(headers)
+
+        start = time.monotonic()
+        await asyncio.gather(*(worker() for _ in range(500)))
+        elapsed = time.monotonic() - start
+        print(f"Server limit: {server_limit}/s over {elapsed:.1f}s")
+        print(f"Sustained: {server.served / elapsed:.0f} req/s ({server.served / elapsed / server_limit:.0%} of the limit), {server.rejected} rejected")
+        print(f"Limiter: {limiter.stats()}, max wait {limiter.max_wait * 1000:.0f}ms")
+
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000, float(sys.argv[2]) if len(sys.argv) > 2 else 10.0))
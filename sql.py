@@ -1,97 +1,307 @@
+import bisect
 import enum
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Union
 
 import aiomysql
+import numpy as np
 
-async def get_all_logs(pool: aiomysql.Pool):
-    """Return all user data from crypto.spoken table"""
+import phash
+
+# Upper bounds (ms) of the latency histogram buckets, the last bucket catches everything slower
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+
+class LatencyHistogram:
+    __slots__ = ('counts', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS_MS, seconds * 1000)] += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    @property
+    def average(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p: float) -> float:
+        """Upper bound (ms) of the bucket containing the p-th percentile"""
+        target, seen = p * self.count, 0
+        for bound, n in zip(BUCKETS_MS + (float('inf'),), self.counts):
+            seen += n
+            if seen >= target and n:
+                return bound if bound != float('inf') else self.max * 1000
+        return 0.0
+
+    def __str__(self):
+        return f"{self.count} calls, avg {self.average * 1000:.1f}ms, p50 ≤{self.percentile(0.5):g}ms, p95 ≤{self.percentile(0.95):g}ms, max {self.max * 1000:.0f}ms"
+
+
+query_stats: Dict[str, LatencyHistogram] = {}
+pool_wait = LatencyHistogram()
+
+
+class Transaction:
+    """A connection with an open transaction, passed in place of the pool to group several statements into one commit"""
+
+    __slots__ = ('conn',)
+
+    def __init__(self, conn: aiomysql.Connection):
+        self.conn = conn
+
+
+async def create_pool(**kwargs):
+    """Connect to the configured backend: MySQL by default, or the local SQLite stand-in with DB_BACKEND=sqlite"""
+    if os.getenv('DB_BACKEND', 'mysql').lower() == 'sqlite':
+        import sqlite_backend  # aiosqlite is only needed for local runs & benchmarks
+        return await sqlite_backend.create_pool(os.getenv('SQLITE_PATH', 'data/crypto.sqlite3'))
+    return await aiomysql.create_pool(**kwargs)
+
+
+@asynccontextmanager
+async def acquire(pool: aiomysql.Pool):
+    """Acquire a pooled connection, recording how long the pool made us wait for it"""
+    start = time.perf_counter()
     async with pool.acquire() as conn:
-        async with conn.cursor() as cursor:
-            await cursor.execute("SELECT * from crypto.logging")
-            data = await cursor.fetchall()
-            return data
+        pool_wait.record(time.perf_counter() - start)
+        yield conn
+
+
+@asynccontextmanager
+async def transaction(pool: aiomysql.Pool):
+    """Run statements in one transaction: committed if the block succeeds, rolled back if it raises"""
+    async with acquire(pool) as conn:
+        await conn.begin()
+        try:
+            yield Transaction(conn)
+        except BaseException:
+            await conn.rollback()
+            raise
+        await conn.commit()
+
+
+async def execute(db: Union[aiomysql.Pool, Transaction], name: str, sql: str, args=(), fetch: Optional[str] = None, many: bool = False):
+    """
+    Run one parameterized statement, timed under `name` in `query_stats`
+    `db` is either the pool (own connection, committed straight away) or a Transaction from `transaction()`
+    `fetch` is None, 'one' or 'all'; without it the affected row count is returned
+    """
+    if isinstance(db, Transaction):
+        return await _execute(db.conn, name, sql, args, fetch, many)
+    async with acquire(db) as conn:
+        result = await _execute(conn, name, sql, args, fetch, many)
+        if fetch is None:
+            await conn.commit()
+        return result
+
+
+async def _execute(conn: aiomysql.Connection, name: str, sql: str, args, fetch: Optional[str], many: bool):
+    start = time.perf_counter()
+    async with conn.cursor() as cursor:
+        if many:
+            await cursor.executemany(sql, args)
+        else:
+            await cursor.execute(sql, args)
+        if fetch == 'one':
+            result = await cursor.fetchone()
+        elif fetch == 'all':
+            result = await cursor.fetchall()
+        else:
+            result = cursor.rowcount
+    query_stats.setdefault(name, LatencyHistogram()).record(time.perf_counter() - start)
+    return result
+
+
+async def stream(pool: aiomysql.Pool, name: str, sql: str, args=(), batch_size=1000):
+    """Yield rows of a query from a server-side cursor, fetching `batch_size` rows at a time instead of the whole result
+    Only the query itself (up to the first batch) is timed, not the time spent by the consumer"""
+    async with acquire(pool) as conn:
+        async with conn.cursor(aiomysql.SSCursor) as cursor:
+            start = time.perf_counter()
+            await cursor.execute(sql, args)
+            rows = await cursor.fetchmany(batch_size)
+            query_stats.setdefault(name, LatencyHistogram()).record(time.perf_counter() - start)
+            while rows:
+                for row in rows:
+                    yield row
+                rows = await cursor.fetchmany(batch_size)
+
+
+def stats(limit: int = 8) -> str:
+    """Busiest queries by total time spent, & pool wait times"""
+    busiest = sorted(query_stats.items(), key=lambda item: item[1].total, reverse=True)[:limit]
+    lines = [f"`{name}`: {histogram}" for name, histogram in busiest]
+    lines.append(f"**Pool wait:** {pool_wait}")
+    return "\n".join(lines)
+
+
+async def iter_msg_counts(pool: aiomysql.Pool, gid):
+    """Yield (uid, msg_count) for every user of a guild who has sent a message"""
+    async for row in stream(pool, 'iter_msg_counts', "SELECT uid, msg_count FROM crypto.logging WHERE gid = %s AND msg_count > 0", (gid,)):
+        yield row
+
+
+async def iter_banned_photo_hashes(pool: aiomysql.Pool, gid):
+    """Yield the blacklisted photo hashes of a guild"""
+    async for (photo_hash,) in stream(pool, 'iter_banned_photo_hashes', "SELECT photo_hash FROM crypto.logging WHERE gid = %s AND banned_photo = 1 AND photo_hash IS NOT NULL", (gid,)):
+        yield photo_hash
 
 
 async def set_msg_count(pool: aiomysql.Pool, client, gid, uid, msg_count=1):
-    """Return user data from rotmg.users table"""
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cursor:
-            await cursor.execute(f"SELECT * from crypto.logging WHERE gid = {gid} AND uid = {uid}")
-            data = await cursor.fetchone()
-            if not data:
-                sql = "INSERT INTO crypto.logging (gid, uid, msg_count) VALUES (%s, %s, %s)"
-                data = (gid, uid, msg_count)
-                await cursor.execute(sql, data)
-                await conn.commit()
-                client.spoken.get(gid, set()).add(uid)
-                return True
+    """Create a user's log row with an initial message count if they don't have one yet"""
+    sql = "INSERT IGNORE INTO crypto.logging (gid, uid, msg_count) VALUES (%s, %s, %s)"
+    if await execute(pool, 'set_msg_count', sql, (gid, uid, msg_count)):
+        client.spoken.get(gid, set()).add(uid)
+        return True
+
+
+async def upsert_msg_counts(db: Union[aiomysql.Pool, Transaction], data):
+    """Add message count deltas of (gid, uid, delta), creating rows for users not yet logged"""
+    sql = "INSERT INTO crypto.logging (gid, uid, msg_count) VALUES (%s, %s, %s) ON DUPLICATE KEY UPDATE msg_count = msg_count + VALUES(msg_count)"
+    await execute(db, 'upsert_msg_counts', sql, data, many=True)
+    return True
+
 
 async def get_msg_count(pool: aiomysql.Pool, gid, uid):
-    """Return user data from rotmg.users table"""
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cursor:
-            await cursor.execute(f"SELECT * from crypto.logging WHERE gid = {gid} AND uid = {uid}")
-            data = await cursor.fetchone()
-            if not data:
-                sql = "INSERT INTO crypto.logging (gid, uid, msg_count) VALUES (%s, %s, %s)"
-                data = (gid, uid, 0)
-                await cursor.execute(sql, data)
-                await conn.commit()
-                return 0
-            else:
-                return data[log_cols.msg_count]
+    """Return a user's stored message count in a guild (0 if they have no row)"""
+    return (await get_msg_counts(pool, gid, [uid]))[uid]
+
+
+async def get_msg_counts(pool: aiomysql.Pool, gid, uids):
+    """Return {uid: msg_count} for many users of a guild in one query, 0 for users without a row"""
+    uids = list(set(uids))
+    counts = dict.fromkeys(uids, 0)
+    if not uids:
+        return counts
+    sql = f"SELECT uid, msg_count FROM crypto.logging WHERE gid = %s AND uid IN ({', '.join(['%s'] * len(uids))})"
+    counts.update(await execute(pool, 'get_msg_counts', sql, (gid, *uids), fetch='all'))
+    return counts
+
+
+async def claim_msg_count_batch(tx: Transaction, batch_id: str) -> bool:
+    """Record a message count batch as applied, False if it already was (its journal replayed after the commit)
+    Only the latest batch can be replayed, so older ids are dropped"""
+    claimed = await execute(tx, 'claim_msg_count_batch', "INSERT IGNORE INTO crypto.msg_count_batches (batch_id) VALUES (%s)", (batch_id,)) == 1
+    await execute(tx, 'prune_msg_count_batches', "DELETE FROM crypto.msg_count_batches WHERE batch_id <> %s", (batch_id,))
+    return claimed
+
+
+async def upsert_user_totals(db: Union[aiomysql.Pool, Transaction], data):
+    """Add (uid, delta) message count deltas to the per-user totals in crypto.user_totals"""
+    sql = "INSERT INTO crypto.user_totals (uid, msg_count) VALUES (%s, %s) ON DUPLICATE KEY UPDATE msg_count = msg_count + VALUES(msg_count)"
+    await execute(db, 'upsert_user_totals', sql, data, many=True)
+    return True
 
 
 async def get_total_msg_count(pool: aiomysql.Pool, uid):
-    """Return user data from rotmg.users table"""
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cursor:
-            await cursor.execute(f"SELECT * from crypto.logging WHERE uid = {uid}")
-            data = await cursor.fetchall()
-            if not data:
-                return 0
-            else:
-                return sum(r[log_cols.msg_count] for r in data)
+    """Return a user's message count summed over every guild, kept up to date in crypto.user_totals"""
+    row = await execute(pool, 'get_total_msg_count', "SELECT msg_count FROM crypto.user_totals WHERE uid = %s", (uid,), fetch='one')
+    return row[0] if row else 0
 
 
-async def update_photo_hash(pool: aiomysql.Pool, uid, hash, gid=None, new=True):
-    """Update photo hash for a user"""
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cursor:
-            if new:
-                sql = "INSERT INTO crypto.logging (gid, uid, photo_hash) VALUES (%s, %s, %s) ON DUPLICATE KEY UPDATE photo_hash = values(photo_hash)"
-                await cursor.execute(sql, (gid, uid, hash))
-            else:
-                sql = "UPDATE crypto.logging SET photo_hash = %s WHERE uid = %s"
-                await cursor.execute(sql, (hash, uid))
-            await conn.commit()
-            return True
+async def update_photo_hash(db: Union[aiomysql.Pool, Transaction], uid, hash, gid=None, new=True, default_avatar=None, avatar_key=None):
+    """Update photo hash (unsigned 64-bit int) for a user, or the default avatar colour if they have none
+    `avatar_key` records which avatar asset was hashed, so syncs can skip unchanged avatars"""
+    if new:
+        sql = "INSERT INTO crypto.logging (gid, uid, photo_hash, default_avatar, avatar_key) VALUES (%s, %s, %s, %s, %s) " \
+              "ON DUPLICATE KEY UPDATE photo_hash = values(photo_hash), default_avatar = values(default_avatar), avatar_key = values(avatar_key)"
+        await execute(db, 'update_photo_hash', sql, (gid, uid, hash, default_avatar, avatar_key))
+    else:
+        sql = "UPDATE crypto.logging SET photo_hash = %s, default_avatar = %s, avatar_key = %s WHERE uid = %s"
+        await execute(db, 'update_photo_hash_all_guilds', sql, (hash, default_avatar, avatar_key, uid))
+    return True
 
 
-async def batch_update_photo_hashes(pool: aiomysql.Pool, data):
-    """Bulk update photo hashes"""
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cursor:
-            sql = "INSERT INTO crypto.logging (gid, uid, photo_hash) VALUES (%s, %s, %s) ON DUPLICATE KEY UPDATE photo_hash = values(photo_hash)"
-            await cursor.executemany(sql, data)
-            await conn.commit()
-            return True
+async def batch_update_photo_hashes(db: Union[aiomysql.Pool, Transaction], data):
+    """Bulk update photo hashes from (gid, uid, photo_hash, default_avatar, avatar_key) rows"""
+    sql = "INSERT INTO crypto.logging (gid, uid, photo_hash, default_avatar, avatar_key) VALUES (%s, %s, %s, %s, %s) " \
+          "ON DUPLICATE KEY UPDATE photo_hash = values(photo_hash), default_avatar = values(default_avatar), avatar_key = values(avatar_key)"
+    await execute(db, 'batch_update_photo_hashes', sql, data, many=True)
+    return True
 
 
-async def set_banned_photo(pool: aiomysql.Pool, gid, uid, banned:bool):
-    """Update banned photos"""
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cursor:
-            sql = "INSERT INTO crypto.logging (gid, uid, banned_photo) VALUES (%s, %s, %s) ON DUPLICATE KEY UPDATE banned_photo = values(banned_photo)"
-            await cursor.execute(sql, (gid, uid, banned))
-            await conn.commit()
-            return True
+async def get_avatar_keys(pool: aiomysql.Pool, gid):
+    """Return {uid: avatar_key} for every user in a guild with a stored photo hash or default avatar"""
+    sql = "SELECT uid, avatar_key FROM crypto.logging WHERE gid = %s AND (photo_hash IS NOT NULL OR default_avatar IS NOT NULL)"
+    return dict(await execute(pool, 'get_avatar_keys', sql, (gid,), fetch='all'))
+
+
+async def get_user_photo_hash(pool: aiomysql.Pool, uid):
+    """Return a stored photo hash for a user from any guild, or None"""
+    sql = "SELECT photo_hash FROM crypto.logging WHERE uid = %s AND photo_hash IS NOT NULL LIMIT 1"
+    data = await execute(pool, 'get_user_photo_hash', sql, (uid,), fetch='one')
+    return data[0] if data else None
+
+
+async def find_similar_photos(pool: aiomysql.Pool, gid, photo_hash, max_distance=5):
+    """Return uids in a guild whose photo hash differs from `photo_hash` by fewer than `max_distance` bits"""
+    if not getattr(pool, 'bit_count', True):
+        # Backend can't compute the distances (see sqlite_backend.create_pool), scan the guild's hashes in one NumPy pass instead
+        sql = "SELECT uid, photo_hash FROM crypto.logging WHERE gid = %s AND photo_hash IS NOT NULL"
+        rows = await execute(pool, 'find_similar_photos', sql, (gid,), fetch='all')
+        distances = phash.hamming_distances(photo_hash, phash.to_array(r[1] for r in rows))
+        return [rows[i][0] for i in np.flatnonzero(distances < max_distance)]
+    sql = "SELECT uid FROM crypto.logging WHERE gid = %s AND photo_hash IS NOT NULL AND BIT_COUNT(photo_hash ^ %s) < %s"
+    return [r[0] for r in await execute(pool, 'find_similar_photos', sql, (gid, photo_hash, max_distance), fetch='all')]
+
+
+async def get_duplicate_photos(pool: aiomysql.Pool, gid, min_count):
+    """Return (uid, photo_hash) rows in a guild for every photo hash shared by more than `min_count` users"""
+    sql = "SELECT uid, photo_hash FROM crypto.logging WHERE gid = %s AND photo_hash IN " \
+          "(SELECT photo_hash FROM crypto.logging WHERE gid = %s AND photo_hash IS NOT NULL GROUP BY photo_hash HAVING COUNT(*) > %s)"
+    return await execute(pool, 'get_duplicate_photos', sql, (gid, gid, min_count), fetch='all')
 
 
+async def set_banned_photo(db: Union[aiomysql.Pool, Transaction], gid, uid, banned: bool):
+    """Update banned photos"""
+    sql = "INSERT INTO crypto.logging (gid, uid, banned_photo) VALUES (%s, %s, %s) ON DUPLICATE KEY UPDATE banned_photo = values(banned_photo)"
+    await execute(db, 'set_banned_photo', sql, (gid, uid, banned))
+    return True
+
 
 class log_cols(enum.IntEnum):
     gid: int = 0
     uid: int = 1
     msg_count: int = 2
     report_count: int = 3
-    photo_hash: str = 4
+    photo_hash: int = 4
     banned_photo: bool = 5
+    default_avatar: str = 6
+    avatar_key: str = 7
+
+
+if __name__ == '__main__':
+    # Benchmark total message count lookups, summing crypto.logging vs reading crypto.user_totals: python sql.py [samples]
+    import asyncio
+    import random
+    import sys
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    async def main(samples: int):
+        pool = await create_pool(host=os.getenv("MYSQL_HOST"), port=3306, user='jacobvs', password=os.getenv("MYSQL_PASSWORD"), db='mysql')
+        uids = [uid for (uid,) in await execute(pool, 'sample', "SELECT uid FROM crypto.user_totals", fetch='all')]
+        uids = random.sample(uids, min(samples, len(uids)))
+        for name, sql in (('sum_logging', "SELECT COALESCE(SUM(msg_count), 0) FROM crypto.logging WHERE uid = %s"),
+                          ('user_totals', "SELECT msg_count FROM crypto.user_totals WHERE uid = %s")):
+            for uid in uids:
+                await execute(pool, name, sql, (uid,), fetch='one')
+            histogram = query_stats[name]
+            print(f"{name}: p50 ≤{histogram.percentile(0.5):g}ms, p99 ≤{histogram.percentile(0.99):g}ms ({histogram})")
+        pool.close()
+        await pool.wait_closed()
+
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000))
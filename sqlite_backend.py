@@ -0,0 +1,248 @@
+"""
+SQLite stand-in for the MySQL `crypto` database, for running & benchmarking the data paths offline
+Selected with DB_BACKEND=sqlite (database file from SQLITE_PATH, default data/crypto.sqlite3).
+Exposes the small part of the aiomysql pool/connection/cursor API that sql.py uses & translates its MySQL dialect:
+%s placeholders, ON DUPLICATE KEY UPDATE, INSERT IGNORE and BIT_COUNT(a ^ b).
+"""
+import asyncio
+import re
+import sqlite3
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+import aiosqlite
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS crypto.logging (gid INTEGER NOT NULL, uid INTEGER NOT NULL, msg_count INTEGER NOT NULL DEFAULT 0, "
+    "report_count INTEGER NOT NULL DEFAULT 0, photo_hash INTEGER, banned_photo INTEGER NOT NULL DEFAULT 0, default_avatar TEXT, avatar_key TEXT, "
+    "PRIMARY KEY (gid, uid))",
+    "CREATE INDEX IF NOT EXISTS crypto.gid_photo_hash ON logging (gid, photo_hash)",
+    "CREATE INDEX IF NOT EXISTS crypto.logging_uid ON logging (uid)",
+    "CREATE TABLE IF NOT EXISTS crypto.user_totals (uid INTEGER NOT NULL PRIMARY KEY, msg_count INTEGER NOT NULL DEFAULT 0)",
+    "CREATE TABLE IF NOT EXISTS crypto.msg_count_batches (batch_id TEXT NOT NULL PRIMARY KEY)",
+)
+
+# Conflict targets for ON DUPLICATE KEY UPDATE, i.e. each table's primary key
+PRIMARY_KEYS = {'logging': '(gid, uid)', 'user_totals': '(uid)'}
+
+UINT64_MASK = 0xFFFFFFFFFFFFFFFF
+INT64_MAX = 0x7FFFFFFFFFFFFFFF
+
+_INSERT_TABLE = re.compile(r'INSERT\s+(?:IGNORE\s+)?INTO\s+crypto\.(\w+)', re.I)
+_ON_DUPLICATE = re.compile(r'ON DUPLICATE KEY UPDATE', re.I)
+_VALUES_REF = re.compile(r'VALUES\((\w+)\)', re.I)
+_BIT_COUNT_XOR = re.compile(r'BIT_COUNT\((\w+)\s*\^\s*%s\)', re.I)
+
+
+def translate(sql: str) -> str:
+    """Rewrite a MySQL statement from sql.py into SQLite's dialect"""
+    sql = _BIT_COUNT_XOR.sub(r'bit_count_xor(\1, %s)', sql)
+    match = _ON_DUPLICATE.search(sql)
+    if match:
+        table = _INSERT_TABLE.search(sql).group(1)
+        update = _VALUES_REF.sub(r'excluded.\1', sql[match.end():])
+        sql = f"{sql[:match.start()]}ON CONFLICT{PRIMARY_KEYS[table]} DO UPDATE SET{update}"
+    sql = re.sub(r'INSERT\s+IGNORE', 'INSERT OR IGNORE', sql, flags=re.I)
+    return sql.replace('%s', '?')
+
+
+# SQLite integers are signed 64-bit, so unsigned photo hashes are stored as their two's complement.
+# Every other column is non-negative, which makes the conversion back on read unambiguous.
+def _to_sqlite(value):
+    return value - (1 << 64) if isinstance(value, int) and value > INT64_MAX else value
+
+
+def _from_sqlite(row):
+    if row is None:
+        return None
+    return tuple(v & UINT64_MASK if isinstance(v, int) and v < 0 else v for v in row)
+
+
+def _bit_count_xor(a: Optional[int], b: Optional[int]) -> Optional[int]:
+    if a is None or b is None:
+        return None
+    return bin((a ^ b) & UINT64_MASK).count('1')
+
+
+async def _implicit_begin(conn: aiosqlite.Connection):
+    # Like aiomysql (autocommit off), statements run in a transaction that lasts until commit()
+    if not conn.in_transaction:
+        await conn.execute("BEGIN")
+
+
+class Cursor:
+    def __init__(self, conn: aiosqlite.Connection):
+        self._conn = conn
+        self._cursor: Optional[aiosqlite.Cursor] = None
+        self.rowcount = -1
+
+    async def execute(self, sql: str, args=()):
+        await _implicit_begin(self._conn)
+        self._cursor = await self._conn.execute(translate(sql), tuple(map(_to_sqlite, args)))
+        self.rowcount = self._cursor.rowcount
+
+    async def executemany(self, sql: str, args):
+        await _implicit_begin(self._conn)
+        self._cursor = await self._conn.executemany(translate(sql), [tuple(map(_to_sqlite, row)) for row in args])
+        self.rowcount = self._cursor.rowcount
+
+    async def fetchone(self):
+        return _from_sqlite(await self._cursor.fetchone())
+
+    async def fetchmany(self, size: int):
+        return [_from_sqlite(row) for row in await self._cursor.fetchmany(size)]
+
+    async def fetchall(self):
+        return [_from_sqlite(row) for row in await self._cursor.fetchall()]
+
+    async def close(self):
+        if self._cursor is not None:
+            await self._cursor.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+
+class Connection:
+    def __init__(self, conn: aiosqlite.Connection):
+        self._conn = conn
+
+    def cursor(self, cursor_class=None) -> Cursor:
+        # Rows are always fetched lazily from SQLite, so the server-side cursor class needs no counterpart
+        return Cursor(self._conn)
+
+    async def begin(self):
+        await _implicit_begin(self._conn)
+
+    async def commit(self):
+        if self._conn.in_transaction:
+            await self._conn.execute("COMMIT")
+
+    async def rollback(self):
+        if self._conn.in_transaction:
+            await self._conn.execute("ROLLBACK")
+
+
+class Pool:
+    """Fixed set of connections to one database file (attached as `crypto`), handed out like aiomysql's pool"""
+
+    def __init__(self, connections: List[aiosqlite.Connection], bit_count: bool = True):
+        self._connections = connections
+        self.bit_count = bit_count  # Whether BIT_COUNT(a ^ b) can be evaluated in SQL, sql.py scans the hashes itself otherwise
+        self._free: asyncio.Queue = asyncio.Queue()
+        for conn in connections:
+            self._free.put_nowait(Connection(conn))
+        self.minsize = self.maxsize = len(connections)
+
+    @property
+    def size(self) -> int:
+        return len(self._connections)
+
+    @property
+    def freesize(self) -> int:
+        return self._free.qsize()
+
+    @asynccontextmanager
+    async def acquire(self):
+        conn = await self._free.get()
+        try:
+            yield conn
+        finally:
+            await conn.rollback()  # Uncommitted work is discarded on release, also ending read snapshots
+            self._free.put_nowait(conn)
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        for conn in self._connections:
+            await conn.close()
+
+
+async def create_pool(path: str = 'data/crypto.sqlite3', size: int = 4) -> Pool:
+    connections = []
+    bit_count = True
+    for _ in range(size):
+        # Transactions are managed here rather than by the sqlite3 module, see _implicit_begin()
+        conn = await aiosqlite.connect(':memory:', isolation_level=None)
+        await conn.execute("ATTACH DATABASE ? AS crypto", (path,))
+        await conn.execute("PRAGMA crypto.journal_mode = WAL")
+        await conn.execute("PRAGMA busy_timeout = 5000")
+        try:
+            await conn.create_function('bit_count_xor', 2, _bit_count_xor, deterministic=True)
+        except sqlite3.NotSupportedError:
+            bit_count = False  # SQLite older than 3.8.3 can't register deterministic functions
+        connections.append(conn)
+    for statement in SCHEMA:
+        await connections[0].execute(statement)
+    return Pool(connections, bit_count)
+
+
+if __name__ == '__main__':
+    # Benchmark the bot's data paths against a scratch database: python sqlite_backend.py [users] [guilds]
+    import os
+    import random
+    import sys
+    import tempfile
+    import time
+    from contextlib import contextmanager
+
+    import sql
+
+    async def bench(pool: Pool, users: int, guilds: int):
+        gids = [random.getrandbits(60) for _ in range(guilds)]
+        uids = [random.getrandbits(60) for _ in range(users)]
+
+        @contextmanager
+        def timed(label, count):
+            start = time.perf_counter()
+            yield
+            elapsed = time.perf_counter() - start
+            print(f"{label}: {elapsed * 1000:.0f}ms ({count / elapsed:,.0f} rows/s)")
+
+        counts = [(random.choice(gids), uid, random.randint(1, 20)) for uid in uids]
+        with timed("Message count flush (2 passes)", len(counts) * 2):
+            for _ in range(2):
+                for i in range(0, len(counts), 200):
+                    batch = counts[i:i + 200]
+                    async with sql.transaction(pool) as tx:
+                        await sql.upsert_msg_counts(tx, batch)
+                        await sql.upsert_user_totals(tx, [(uid, n) for _, uid, n in batch])
+
+        hashes = [(gid, uid, random.getrandbits(64), None, f"key{uid}") for gid, uid, _ in counts]
+        with timed("Photo hash batch update", len(hashes)):
+            for i in range(0, len(hashes), 500):
+                await sql.batch_update_photo_hashes(pool, hashes[i:i + 500])
+
+        scanned = 0
+        with timed("Guild scans (iter_msg_counts)", users):
+            for gid in gids:
+                async for _ in sql.iter_msg_counts(pool, gid):
+                    scanned += 1
+
+        with timed("Similar photo search (per guild)", users):
+            for gid in gids:
+                await sql.find_similar_photos(pool, gid, random.getrandbits(64))
+
+        with timed("Total message count reads", 1000):
+            for uid in random.sample(uids, min(1000, users)):
+                await sql.get_total_msg_count(pool, uid)
+
+        assert scanned == users
+        sample_gid, sample_uid, sample_hash, _, _ = hashes[0]
+        assert sample_uid in await sql.find_similar_photos(pool, sample_gid, sample_hash)
+        print(sql.stats())
+
+    async def main(users: int, guilds: int):
+        pool = await create_pool(os.path.join(tempfile.mkdtemp(), 'bench.sqlite3'))
+        try:
+            await bench(pool, users, guilds)
+        finally:
+            # aiosqlite's connection threads aren't daemons, an unclosed pool would keep the process alive
+            pool.close()
+            await pool.wait_closed()
+
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000, int(sys.argv[2]) if len(sys.argv) > 2 else 10))
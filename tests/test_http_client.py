@@ -0,0 +1,72 @@
+import unittest
+from unittest import mock
+
+from aiohttp import web
+
+from http_client import HostConfig, HttpClient
+
+MALFORMED_HEADERS = [
+    {'X-Ratelimit-Limit': '1.5', 'X-Ratelimit-Interval': '0', 'X-Ratelimit-Reset': ''},
+    {'X-Ratelimit-Limit': 'ten', 'X-Ratelimit-Interval': '-1000', 'X-Ratelimit-Reset': 'soon'},
+    {'X-Ratelimit-Limit': '', 'X-Ratelimit-Interval': 'nan', 'X-Ratelimit-Reset': '1700000000000'},
+]
+
+
+class MalformedRateLimitHeadersTest(unittest.IsolatedAsyncioTestCase):
+    """Requests to a stub server answering with unparseable X-Ratelimit-* headers are still retried & returned"""
+
+    async def asyncSetUp(self):
+        self.responses = []
+        self.requests = 0
+
+        async def handler(request: web.Request):
+            self.requests += 1
+            status, headers = self.responses.pop(0)
+            return web.json_response({'pHash': "0f0f0f0f0f0f0f0f"}, status=status, headers=headers)
+
+        app = web.Application()
+        app.router.add_get('/{tail:.*}', handler)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.client = HttpClient(hosts={'api.example.com': HostConfig(rate=1000, burst=100, backoff=0.001, retries=2)},
+                                 overrides=f"api.example.com=http://127.0.0.1:{port}")
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.runner.cleanup()
+
+    async def test_success_is_returned(self):
+        for headers in MALFORMED_HEADERS:
+            with self.subTest(headers=headers):
+                self.responses = [(200, headers)]
+                r = await self.client.get("https://api.example.com/v1/metadata")
+                self.assertEqual(r.status, 200)
+                self.assertEqual(r.get('pHash'), "0f0f0f0f0f0f0f0f")
+
+    async def test_429_is_retried(self):
+        for headers in MALFORMED_HEADERS:
+            with self.subTest(headers=headers):
+                self.responses, self.requests = [(429, headers), (200, headers)], 0
+                with mock.patch('ratelimit.MAX_PAUSE', 0.05):  # Shorten the 1s default & clamped epoch resets
+                    r = await self.client.get("https://api.example.com/v1/metadata")
+                self.assertEqual(r.status, 200)
+                self.assertEqual(self.requests, 2)
+
+    async def test_limiter_errors_dont_lose_the_response(self):
+        limiter = self.client.limiter('api.example.com')
+
+        def broken(headers=None):
+            raise ValueError("unparseable header")
+
+        limiter.success = limiter.hit_429 = broken
+        self.responses, self.requests = [(429, {}), (200, {})], 0
+        r = await self.client.get("https://api.example.com/v1/metadata")
+        self.assertEqual(r.status, 200)
+        self.assertEqual(self.requests, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
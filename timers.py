@@ -0,0 +1,143 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional
+
+logger = logging.getLogger('discord')
+
+
+class _Timer:
+    __slots__ = ('deadline', 'seq', 'key', 'callback', 'args', 'active')
+
+    def __init__(self, deadline: float, seq: int, key: Hashable, callback: Callable[..., Awaitable], args: tuple):
+        self.deadline = deadline
+        self.seq = seq
+        self.key = key
+        self.callback = callback
+        self.args = args
+        self.active = True
+
+    def __lt__(self, other: '_Timer'):
+        return (self.deadline, self.seq) < (other.deadline, other.seq)
+
+
+class TimerScheduler:
+    """
+    Delayed callbacks kept in one heap & fired by a single task, instead of a sleeping task per timer
+    Timers are keyed (e.g. by (guild_id, member_id)) so they only hold IDs, & scheduling a key again replaces its timer.
+    Cancelled timers are only marked inactive & dropped when they reach the top of the heap.
+    """
+
+    def __init__(self):
+        self._heap: List[_Timer] = []
+        self._timers: Dict[Hashable, _Timer] = {}
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.fired: int = 0
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, key: Hashable):
+        return key in self._timers
+
+    def schedule(self, key: Hashable, delay: float, callback: Callable[..., Awaitable], *args) -> None:
+        """Await `callback(*args)` in `delay` seconds, replacing any timer already scheduled under `key`"""
+        self.cancel(key)
+        loop = asyncio.get_event_loop()
+        timer = self._timers[key] = _Timer(loop.time() + delay, next(self._seq), key, callback, args)
+        heapq.heappush(self._heap, timer)
+
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+        elif self._heap[0] is timer:
+            self._wakeup.set()  # New earliest deadline, the runner is sleeping until a later one
+
+    def cancel(self, key: Hashable) -> bool:
+        timer = self._timers.pop(key, None)
+        if timer is None:
+            return False
+        timer.active = False
+        return True
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            while self._heap and not self._heap[0].active:
+                heapq.heappop(self._heap)
+            timeout = max(0.0, self._heap[0].deadline - loop.time()) if self._heap else None
+            if timeout != 0.0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                    continue  # Rescheduled, recompute the earliest deadline
+                except asyncio.TimeoutError:
+                    pass
+
+            now = loop.time()
+            while self._heap and self._heap[0].deadline <= now:
+                timer = heapq.heappop(self._heap)
+                if not timer.active:
+                    continue
+                del self._timers[timer.key]
+                self.fired += 1
+                loop.create_task(self._fire(timer))
+
+    @staticmethod
+    async def _fire(timer: _Timer):
+        try:
+            await timer.callback(*timer.args)
+        except Exception:
+            logger.exception(f"Timer {timer.key} failed")
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._heap.clear()
+        self._timers.clear()
+
+
+if __name__ == '__main__':
+    # Compare against one sleeping task per timer: python timers.py [timers]
+    import sys
+    import time
+    import tracemalloc
+
+    async def main(count: int):
+        fired = 0
+
+        async def callback(_):
+            nonlocal fired
+            fired += 1
+
+        async def sleeper(i):
+            await asyncio.sleep(1 + i % 100 / 100)
+            await callback(i)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        tasks = [asyncio.get_event_loop().create_task(sleeper(i)) for i in range(count)]
+        print(f"Task per timer: scheduled {count} in {(time.perf_counter() - start) * 1000:.0f}ms, {tracemalloc.get_traced_memory()[0] / 2 ** 20:.1f}MiB")
+        await asyncio.gather(*tasks)
+        del tasks
+        tracemalloc.stop()
+
+        scheduler = TimerScheduler()
+        fired = 0
+        tracemalloc.start()
+        start = time.perf_counter()
+        for i in range(count):
+            scheduler.schedule((0, i), 1 + i % 100 / 100, callback, i)
+        for i in range(0, count, 10):
+            scheduler.cancel((0, i))
+        print(f"Scheduler:      scheduled {count} in {(time.perf_counter() - start) * 1000:.0f}ms, {tracemalloc.get_traced_memory()[0] / 2 ** 20:.1f}MiB, "
+              f"{len(scheduler)} pending after cancelling every 10th")
+        await asyncio.sleep(2.5)
+        print(f"Fired {fired} ({scheduler.fired} counted)")
+        await scheduler.close()
+
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000))
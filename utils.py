@@ -1,10 +1,7 @@
 import asyncio
 import datetime
-import difflib
-import math
+import logging
 import re
-import time
-from contextlib import asynccontextmanager
 from enum import Enum
 import random
 from typing import Union
@@ -16,6 +13,10 @@ import numpy as np
 from discord.embeds import _EmptyEmbed
 from discord.ext.commands import BadArgument, Converter
 
+import phash
+
+logger = logging.getLogger('discord')
+
 
 class MemberLookupConverter(discord.ext.commands.MemberConverter):
     async def convert(self, ctx, mem, guild: discord.Guild = None) -> discord.Member:
@@ -23,24 +24,20 @@ class MemberLookupConverter(discord.ext.commands.MemberConverter):
             ctx.guild = guild
 
         if not mem.isdigit():
+            names = ctx.bot.member_names.get(ctx.guild)
             if isinstance(mem, str):
-                members = ctx.guild.members
                 if len(mem) > 5 and mem[-5] == '#':
                     # The 5 length is checking to see if #0000 is in the string,
                     # as a#0000 has a length of 6, the minimum for a potential
                     # discriminator lookup.
-                    potential_discriminator = mem[-4:]
 
                     # do the actual lookup and return if found
                     # if it isn't found then we'll do a full name lookup below.
-                    result = discord.utils.get(members, name=mem[:-5], discriminator=potential_discriminator)
+                    result = names.find_tag(mem)
                     if result is not None:
                         return result
 
-                def pred(m):
-                    return "".join([m.lower() for m in m.display_name if m.isalpha()]) == mem
-
-                res = discord.utils.find(pred, members)
+                res = names.find_name(mem) or names.find_alpha(mem)
                 if res is not None:
                     return res
 
@@ -50,16 +47,9 @@ class MemberLookupConverter(discord.ext.commands.MemberConverter):
             except discord.ext.commands.BadArgument:
                 pass
 
-            nicks = []
-            mems = []
-            for m in ctx.guild.members:
-                nicks.append(m.display_name.lower())
-                mems.append(m)
-
-            res = difflib.get_close_matches(mem.lower(), nicks, n=1, cutoff=0.8)
+            res = names.fuzzy(mem, limit=1, cutoff=0.6)
             if res:
-                index = nicks.index(res[0])
-                return mems[index]
+                return res[0][0]
 
             desc = f"No members found with the name: {mem}. "
             raise BadArgument(desc)
@@ -173,194 +163,47 @@ class EmbedPaginator:
         except discord.NotFound:
             pass
 
-class SephamoreRateLimiter:
-    def __init__(self,
-                 rate_limit: int,
-                 concurrency_limit: int) -> None:
-        if not rate_limit or rate_limit < 1:
-            raise ValueError('rate limit must be non zero positive number')
-        if not concurrency_limit or concurrency_limit < 1:
-            raise ValueError('concurrent limit must be non zero positive number')
-
-        self.PAUSED = False
-        self.PAUSE_UNTIL = None
-        self.consumption_rate = 1 / rate_limit
-        self.tokens_queue = asyncio.Queue(rate_limit)
-        self.tokens_consumer_task = asyncio.get_event_loop().create_task(self.consume_tokens())
-        self.semaphore = asyncio.Semaphore(concurrency_limit)
-
-    async def add_token(self) -> None:
-        await self.tokens_queue.put(1)
-        return None
-
-    async def resume_later(self):
-        print(f"Ratelimited! Pausing for {self.PAUSE_UNTIL - time.monotonic()}s")
-        await asyncio.sleep(self.PAUSE_UNTIL - time.monotonic())
-        self.PAUSED = False
-        print("Resuming requests")
-
-    async def consume_tokens(self):
-        try:
-
-            last_consumption_time = 0
-
-            while True:
-                if self.PAUSED:
-                    await asyncio.sleep(self.PAUSE_UNTIL - time.monotonic())
-
-                if self.tokens_queue.empty():
-                    await asyncio.sleep(self.consumption_rate)
-                    continue
-
-                current_consumption_time = time.monotonic()
-                total_tokens = self.tokens_queue.qsize()
-                tokens_to_consume = self.get_tokens_amount_to_consume(
-                    self.consumption_rate,
-                    current_consumption_time,
-                    last_consumption_time,
-                    total_tokens
-                )
-
-                for i in range(0, tokens_to_consume):
-                    self.tokens_queue.get_nowait()
-
-                last_consumption_time = time.monotonic()
-
-                await asyncio.sleep(self.consumption_rate)
-        except asyncio.CancelledError:
-            # you can ignore the error here and deal with closing this task later but this is not advised
-            raise
-        except Exception as e:
-            # do something with the error and re-raise
-            raise
-
-    def hit_429(self, headers):
-        rate_limit = int(headers.get("X-Ratelimit-Limit", "1000"))
-        self.tokens_queue = asyncio.Queue(rate_limit)
-        while not self.tokens_queue.full():
-            self.tokens_queue.put(1)
-        interval = int(headers.get("X-Ratelimit-Interval", "1000")) / 1000.0
-        print(f"New limits | rate-limit: {rate_limit} / interval: {interval}s")
-
-        self.consumption_rate = rate_limit / interval
-        self.PAUSED = True
-        self.PAUSE_UNTIL = time.monotonic() + (int(headers.get("X-Ratelimit-Reset", "1000")) / 1000.0)
-
-        asyncio.get_event_loop().create_task(self.resume_later())
-
-
-    @staticmethod
-    def get_tokens_amount_to_consume(consumption_rate, current_consumption_time, last_consumption_time, total_tokens):
-        time_from_last_consumption = current_consumption_time - last_consumption_time
-        calculated_tokens_to_consume = math.floor(time_from_last_consumption / consumption_rate)
-        tokens_to_consume = min(total_tokens, calculated_tokens_to_consume)
-        return tokens_to_consume
-
-    @asynccontextmanager
-    async def throttle(self):
-        if self.PAUSED:
-            await asyncio.sleep(self.PAUSE_UNTIL - time.monotonic())
-        await self.semaphore.acquire()
-        await self.add_token()
-        try:
-            yield
-        finally:
-            self.semaphore.release()
-
-    async def __aenter__(self):
-        return self
-
-    async def __aexit__(self, exc_type, exc_val, exc_tb):
-        if exc_type:
-            print("EXEPTION in aexit!")
-            print(exc_type)
-            print(exc_tb)
-            print(exc_val)
 
-        await self.close()
-
-    async def close(self) -> None:
-        if self.tokens_consumer_task and not self.tokens_consumer_task.cancelled():
-            try:
-                self.tokens_consumer_task.cancel()
-                await self.tokens_consumer_task
-            except asyncio.CancelledError:
-                # we ignore this exception but it is good to log and signal the task was cancelled
-                pass
-            except Exception as e:
-                # log here and deal with the exception
-                raise
-
-
-class RateLimiter:
-    """
-    Ratelimiting Subclass of aiohttp.ClientSession
-    Implements standard token bucket & handles 429 rate-limit headers
-    """
+async def get_photo_hash(client, member: Union[discord.User, discord.Member]):
+    key = member.display_avatar.key
+    photo_hash = client.avatar_hashes.get(key)
+    if photo_hash is not None:
+        return photo_hash
 
-    MAX_TOKENS = 100
-    PAUSED = False
-    INTERVAL = 0.25
-
-    def __init__(self, client: aiohttp.ClientSession):
-        self.client: aiohttp.ClientSession = client
-        self.tokens = self.MAX_TOKENS
-        self.updated_at = time.monotonic()
-        self.PAUSE_S = 0.0
-
-    async def get(self, url, **kwargs):
-        await self.wait_for_token()
-        return self.client.get(url=url, **kwargs)
-
-    async def wait_for_token(self):
-        if self.PAUSED:
-            await asyncio.sleep(self.PAUSE_S)
-            self.PAUSED = False
-        while self.tokens <= 1:
-            self.add_new_tokens()
-            await asyncio.sleep(self.INTERVAL)
-        self.tokens -= 1
-
-    def add_new_tokens(self):
-        now = time.monotonic()
-        time_since_update = now - self.updated_at
-        new_tokens = time_since_update * self.MAX_TOKENS
-        if self.tokens + new_tokens >= 1:
-            self.tokens = min(self.tokens + new_tokens, self.MAX_TOKENS)
-            self.updated_at = now
-
-    def hit_429(self, resp: aiohttp.ClientResponse):
-        self.tokens = 0
-        self.PAUSED = True
-        self.PAUSE_S = int(resp.headers.get("X-Ratelimit-Reset", "1000")) / 1000.0
-        print(f"Ratelimited! Pausing for {self.PAUSE_S}s")
-        self.MAX_TOKENS = int(resp.headers.get("X-Ratelimit-Limit", "1000"))
-        self.INTERVAL = int(resp.headers.get("X-Ratelimit-Interval", "1000")) / 1000.0
-        print(f"New limits | TOKENS: {self.MAX_TOKENS} / INTERVAL: {self.INTERVAL}s")
+    if phash.BACKEND == 'local':
+        photo_hash = await get_local_photo_hash(client, member)
+    else:
+        photo_hash = await get_imagekit_photo_hash(client, member)
+    if photo_hash is not None:
+        client.avatar_hashes.put(key, photo_hash)
+    return photo_hash
 
 
-async def get_photo_hash(client, member: Union[discord.User, discord.Member]):
+async def get_imagekit_photo_hash(client, member: Union[discord.User, discord.Member]):
     base_url = "https://api.imagekit.io/v1/metadata?url=https://ik.imagekit.io/ugssigsf4u/avatars"
     ext = ".webp?size=64"
     headers = {'Authorization': f'Basic {client.IMAGEKIT_TOKEN}'}
 
-    async with aiohttp.ClientSession(headers=headers) as cs:
-        async with cs.get(url=f"{base_url}/{member.id}/{member.display_avatar.key}{ext}", headers=headers) as r:
-            if r.status == 200:
-                data = await r.json()
-                return data['pHash']
-            return None
+    client.avatar_hashes.miss()
+    try:
+        r = await client.http_client.get(f"{base_url}/{member.id}/{member.display_avatar.key}{ext}", endpoint='imagekit.metadata', headers=headers)
+    except (asyncio.TimeoutError, aiohttp.ClientError):
+        return None
+    return phash.to_int(r.get('pHash')) if r.status == 200 else None
 
 
-def hamming_distance(first: str, second: str) -> int:
-    """Calculate Hamming Distance between to hex string
-    """
+async def get_local_photo_hash(client, member: Union[discord.User, discord.Member]):
+    """Download the 64px avatar from the discord CDN & hash it in the process pool"""
     try:
-        a = bin(int(first, 16))[2:].zfill(64)
-        b = bin(int(second, 16))[2:].zfill(64)
-    except (TypeError, ValueError):
-        return 999
-    return len(list(filter(lambda x: ord(x[0]) ^ ord(x[1]), zip(a, b))))
+        data = await member.display_avatar.with_size(64).with_format(phash.AVATAR_FORMAT).read()
+    except discord.HTTPException:
+        return None
+    try:
+        return await client.avatar_hashes.hash_image(data)
+    except phash.HASH_ERRORS:
+        logger.exception(f"Failed to hash the avatar of {member.id}: {member.display_avatar.url}")
+        return None
+
 
 class Card:
     """Class that represents a normal playing card."""
@@ -6,7 +6,6 @@ from typing import Optional, Dict, Any, List, Tuple
 import discord
 import numpy as np
 from discord.webhook.async_ import async_context
-import sql
 from cogs.log import verify_log, VerifyAction
 from main import CryptoBot
 
@@ -221,7 +220,7 @@ class VerifyView(discord.ui.View):
         self.add_item(VerifyButton())
 
     def get_verify_role(self, guild_id: int):
-        return self.client.variables[guild_id]['verified_role']
+        return self.client.variables[guild_id].verified_role
 
 
 async def get_bot_chance_score(client: discord.Client, member: discord.Member) -> Tuple[float, bool, bool, float, float, float]:
@@ -244,7 +243,7 @@ async def get_bot_chance_score(client: discord.Client, member: discord.Member) -
     creation_score = max(0, 28 - (discord.utils.utcnow() - member.created_at).days) * 2.63
     all_flags: list[str] = [k for k, v in iter(member.public_flags) if v]
     flags = 11.11 if member.public_flags.value == 0 else 0
-    messages = 34.92 if await sql.get_total_msg_count(client.pool, member.id) < 20 else 0
+    messages = 34.92 if await client.msg_counter.get_total(member.id) < 20 else 0
 
     if messages == 0 or member.premium_since or (flags == 0 and any([flag for flag in all_flags if not "hype" in flag])):
         print(all_flags)
@@ -268,25 +267,7 @@ def check_wordlist(client, user: discord.User):
     :param user: discord.User
     :return boolean: True if match, False otherwise
     """
-    if user.name[-1].isdigit():
-        words = user.name[:-1]
-        index = None
-
-        for i, c in enumerate(words):
-            if c.isupper():
-                if index is not None:
-                    index = None
-                    break
-                index = i
-
-        if index:
-            first_word = words[:index]
-            second_word = words[index:].lower()
-
-            if first_word in client.adjective_list and second_word in client.noun_list:
-                return True
-
-    return False
+    return client.wordlist.is_match(user)
 
 
 async def complete_verification(client: CryptoBot, member: discord.Member, verify_role: discord.Role):
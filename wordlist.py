@@ -0,0 +1,58 @@
+import re
+from typing import Dict, Iterable, Optional, Tuple
+
+import discord
+
+# Two words, optionally separated, followed by a number: FancyCat1234, fancy_cat42, Fancy.Cat-7
+WORDLIST_NAME = re.compile(r'([A-Za-z]+)[ _.\-]?([A-Za-z]*)[ _.\-]?(\d+)')
+_END = ''  # Trie key marking the end of an adjective
+
+
+class WordlistClassifier:
+    """
+    Detects `AdjectiveNoun1234` style names generated from the adjective & noun wordlists
+    The adjectives are stored in a trie, so every adjective prefix of a name is found in one walk & the rest checked against the nouns.
+    Results are cached per user alongside the name they were computed for, & refreshed by the Members cog when a user renames.
+    """
+
+    def __init__(self, adjectives: Iterable[str], nouns: Iterable[str]):
+        self.trie: dict = {}
+        for word in adjectives:
+            word = word.strip().lower()
+            if word:
+                node = self.trie
+                for c in word:
+                    node = node.setdefault(c, {})
+                node[_END] = True
+        self.nouns = frozenset(word.strip().lower() for word in nouns if word.strip())
+        self.flags: Dict[int, Tuple[str, bool]] = {}
+
+    def split(self, name: str) -> Optional[Tuple[str, str, str]]:
+        """(adjective, noun, number) if the name follows the wordlist pattern, otherwise None"""
+        match = WORDLIST_NAME.fullmatch(name)
+        if not match:
+            return None
+        letters = (match.group(1) + match.group(2)).lower()
+        node = self.trie
+        for i, c in enumerate(letters):
+            node = node.get(c)
+            if node is None:
+                return None
+            if _END in node and letters[i + 1:] in self.nouns:
+                return letters[:i + 1], letters[i + 1:], match.group(3)
+        return None
+
+    def is_match(self, user: discord.abc.User) -> bool:
+        """Whether the user's name follows the wordlist pattern, cached until they rename"""
+        cached = self.flags.get(user.id)
+        if cached is not None and cached[0] == user.name:
+            return cached[1]
+        return self.refresh(user)
+
+    def refresh(self, user: discord.abc.User) -> bool:
+        result = self.split(user.name) is not None
+        self.flags[user.id] = (user.name, result)
+        return result
+
+    def forget(self, user_id: int) -> None:
+        self.flags.pop(user_id, None)